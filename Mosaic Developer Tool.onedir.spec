@@ -0,0 +1,47 @@
+# -*- mode: python ; coding: utf-8 -*-
+# 起動時間を優先した構成 (onedir)。onefile のように起動のたびに一時フォルダへ展開せず、
+# UPX の展開も行わないので、ウィンドウが表示されるまでが速い。配布は dist/Mosaic Developer Tool フォルダごと行う。
+
+
+a = Analysis(
+    ['gui_runner.py'],
+    pathex=[],
+    binaries=[],
+    datas=[],
+    hiddenimports=[],
+    hookspath=[],
+    hooksconfig={},
+    runtime_hooks=[],
+    excludes=[],
+    noarchive=False,
+    optimize=0,
+)
+pyz = PYZ(a.pure)
+
+exe = EXE(
+    pyz,
+    a.scripts,
+    [],
+    exclude_binaries=True,
+    name='Mosaic Developer Tool',
+    debug=False,
+    bootloader_ignore_signals=False,
+    strip=False,
+    upx=False,
+    console=False,
+    disable_windowed_traceback=False,
+    argv_emulation=False,
+    target_arch=None,
+    codesign_identity=None,
+    entitlements_file=None,
+    icon='mosaictool.ico',
+)
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.datas,
+    strip=False,
+    upx=False,
+    upx_exclude=[],
+    name='Mosaic Developer Tool',
+)
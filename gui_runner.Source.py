@@ -1,21 +1,4306 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox
+import time
+
+# 起動時間の計測の基準。ウィンドウを最初に表示するまでに読み込むのは以下の軽いモジュールだけにし、
+# tkinter は GUI を開くとき、それ以外 (concurrent.futures, urllib, logging, multiprocessing, numpy, PIL, yaml など) は使う処理の中で読み込む
+_MODULE_STARTED = time.perf_counter()
+
 import os
 import subprocess
 import sys
-import platform
 import shutil
-import random
-import time
 import threading
-from tkinter.font import Font
-from pathlib import Path
-import io
+import errno
+import glob
+import json
+import math
+import warnings
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from queue import SimpleQueue
+
+tk = filedialog = messagebox = Font = None
+
+CLONE_STRATEGIES = ("auto", "reflink", "hardlink", "symlink", "copy")
+# 出力が元のファイルと同じ実体を指す方式。出力を編集すると元データも変わるので、明示された場合だけ使う
+_SHARED_CLONE_STRATEGIES = ("hardlink", "symlink")
+
+# 複製方式ごとの試行順。最後は必ず通常コピーにフォールバックする (auto は元データと実体を共有しない方式だけ)
+_CLONE_FALLBACKS = {
+    "auto": ("reflink", "copy"),
+    "reflink": ("reflink", "copy"),
+    "hardlink": ("hardlink", "copy"),
+    "symlink": ("symlink", "copy"),
+    "copy": ("copy",),
+}
+
+DEFAULT_IO_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+IMAGE_EXTS = (".jpg", ".jpeg", ".png")
+
+ENV_LOCK_NAME = "mosaic-env.lock.json"
+# conda_env に構築する内容。変更するとロックファイルと一致しなくなり、必要な手順だけが再実行される
+ENV_SPEC = {
+    "python": "3.10.9",
+    "conda_dependencies": ["numpy", "pandas", "psycopg2", "pyyaml"],
+    "pip_packages": ["label-studio"],
+}
+BOOTSTRAP_STEPS = ("create_env", "pip_upgrade", "conda_deps", "label_studio")
+# 各手順が完了を待つ手順。pip のアップグレードと conda の依存パッケージは環境の作成後に並行して進める
+BOOTSTRAP_DEPENDENCIES = {
+    "create_env": (),
+    "pip_upgrade": ("create_env",),
+    "conda_deps": ("create_env",),
+    "label_studio": ("pip_upgrade", "conda_deps"),
+}
+BOOTSTRAP_LABELS = {
+    "create_env": "Conda環境の作成",
+    "pip_upgrade": "pipのアップグレード",
+    "conda_deps": "依存パッケージのインストール",
+    "label_studio": "label-studio のインストール",
+}
+
+# ネットワークなしで conda_env を用意するための成果物 (conda-pack のアーカイブ、またはローカルチャンネルと wheelhouse)
+OFFLINE_DIR_NAME = "offline_env"
+OFFLINE_PACK_NAME = "conda_env.tar.gz"
+OFFLINE_CHANNEL_DIR = "channel"
+OFFLINE_WHEELHOUSE_DIR = "wheelhouse"
+OFFLINE_MANIFEST_NAME = "offline-env.json"
+# repodata.json に書き出す conda-meta のフィールド
+_REPODATA_FIELDS = ("name", "version", "build", "build_number", "depends", "constrains", "license", "md5", "sha256", "size",
+                    "subdir", "timestamp", "noarch", "track_features")
+
+LOG_DIR_NAME = "logs"
+LOG_FILE_NAME = "mosaic.log"
+# 画面用に保持するログの行数と、ログファイルをローテーションするサイズ
+LOG_RING_CAPACITY = 2000
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 3
+
+# 画面の更新はワーカーから直接行わず、この間隔でまとめて反映する
+UI_TICK_MS = 50
+UI_MAX_CALLS_PER_TICK = 200
+UI_ANIMATION_INTERVAL = 0.5
+UI_LATENCY_SAMPLES = 2000
+
+# Label Studio のインスタンスごとに、この番号から空いているポートを割り当てる
+LABEL_STUDIO_BASE_PORT = 8081
+LABEL_STUDIO_PORT_RANGE = 100
+LABEL_STUDIO_HEALTH_PATH = "/health"
+LABEL_STUDIO_READY_TIMEOUT = 300
+# 一括登録 (ls-import) の API トークンの環境変数、1 リクエストのタスク数、再試行の回数と間隔
+LABEL_STUDIO_API_KEY_ENV = "LABEL_STUDIO_API_KEY"
+LS_IMPORT_BATCH_SIZE = 500
+LS_IMPORT_STATE_PREFIX = ".label_studio_import_"
+LS_API_TIMEOUT = 120
+LS_API_RETRIES = 5
+LS_API_BACKOFF_BASE = 0.5
+LS_API_BACKOFF_MAX = 30.0
+# ストレージの同期 (バックグラウンド) の完了を待つ上限 (秒)
+LS_STORAGE_SYNC_TIMEOUT = 1800
+LS_LOCAL_FILES_ENV = ("LABEL_STUDIO_LOCAL_FILES_SERVING_ENABLED", "LOCAL_FILES_DOCUMENT_ROOT")
+# 異常終了したインスタンスの再起動。待ち時間は 1, 2, 4 ... 秒で上限あり、この秒数以上動いていれば回数をリセットする
+RESTART_BACKOFF_BASE = 1.0
+RESTART_BACKOFF_MAX = 60.0
+RESTART_MAX_ATTEMPTS = 5
+RESTART_STABLE_SECONDS = 120
+
+IndexedFile = namedtuple("IndexedFile", "path size mtime")
+DatasetPair = namedtuple("DatasetPair", "base ext image label")
+
+MANIFEST_SUFFIX = ".manifest.json"
+REPORT_SUFFIX = ".report.json"
+# 指定するとこのフォルダに Prometheus の textfile (*.prom) も書き出す (node_exporter の textfile collector 向け)
+METRICS_DIR_ENV = "MOSAIC_METRICS_DIR"
+# 指定するとウィンドウを最初に表示した時刻をこのファイルに書き出して終了する (bench-startup が使う)
+STARTUP_PROBE_ENV = "MOSAIC_STARTUP_PROBE"
+# ウィンドウ表示の時点で読み込まれていれば遅延読み込みが崩れている、という目安のモジュール
+STARTUP_HEAVY_MODULES = ("logging", "multiprocessing", "urllib.request", "socket", "hashlib", "random", "argparse", "yaml", "numpy", "PIL")
+LABEL_CACHE_SUFFIX = ".labelcache"
+VALIDATION_CACHE_SUFFIX = ".validation.json"
+# 検査で不正と判定したペアは <出力先>/<フォルダ名>_quarantine に元の相対位置のまま複製し、分割から外す (元のファイルはそのまま)
+QUARANTINE_SUFFIX = "_quarantine"
+QUARANTINE_REPORT_NAME = "quarantine.json"
+# 検査するファイルがこれより少なければプロセスを起動せずその場で検査する
+VALIDATION_POOL_MIN_FILES = 256
+# ボックスが画像の外にはみ出しているとみなす許容量 (正規化座標)
+LABEL_BOX_TOLERANCE = 1e-3
+# ラベルのキャッシュはクラス ID を int16 で持つ。これを超える ID の行は不正として扱う
+LABEL_CLASS_ID_MAX = 32767
+PHASH_CACHE_SUFFIX = ".phash.json"
+DUPLICATES_REPORT_SUFFIX = ".duplicates.json"
+# 知覚ハッシュ (64 bit の dHash) のハミング距離がこれ以下の画像を近似重複とみなす。連続したフレームはおおむね 0〜4 に収まる
+DUPLICATE_HAMMING_DISTANCE = 4
+
+# 変換後の train/val を少数の大きなファイルにまとめて書き出す (tar: WebDataset 形式 / packed: 連結したバイナリ + オフセットの索引)
+SHARD_FORMATS = ("tar", "packed")
+SHARD_DIR_NAME = "shards"
+SHARD_INDEX_NAME = "shards.json"
+SHARD_MAX_BYTES = 256 * 1024 * 1024
+
+# 前処理 (縮小・レターボックス) の結果は <出力先>/<フォルダ名>_done.preprocess/<方式>-<サイズ>/ に内容ハッシュごとに置く
+PREPROCESS_SUFFIX = ".preprocess"
+PREPROCESS_MODES = ("letterbox", "fit")
+PREPROCESS_JPEG_QUALITY = 90
+# レターボックスの余白の色 (YOLO の学習時と同じ灰色)
+LETTERBOX_COLOR = (114, 114, 114)
+# Label Studio の JSON 書き出しの読み込み単位 (文字数) と、変換先のデータセットに置く目印
+LS_EXPORT_CHUNK_CHARS = 1024 * 1024
+LS_IMPORT_MARKER = "label_studio_import.json"
+LS_LABEL_KEYS = ("rectanglelabels", "polygonlabels", "labels")
+# 複数データセットの統合。統合先に結果と画像の内容ハッシュのキャッシュを置く
+MERGE_MARKER = "merge.json"
+MERGE_HASH_CACHE_NAME = "merge_hashes.json"
+# 小さいファイルはスレッドの受け渡しの方が重いので、スレッドプールにはこの件数ずつまとめて渡す
+FILE_JOB_BATCH = 64
+# この件数のペアを配置するごとにジャーナルへ完了を記録する
+MANIFEST_BATCH_SIZE = 2000
+# 監視モード: 変更が止まってから変換するまでの秒数、保存が続くときに待つ上限、ポーリング間隔、停止要求を確認する間隔
+WATCH_DEBOUNCE_SECONDS = 1.0
+WATCH_MAX_DELAY = 10.0
+WATCH_POLL_INTERVAL = 1.0
+WATCH_IDLE_TIMEOUT = 1.0
+WATCH_BACKENDS = ("auto", "inotify", "poll")
+# ベンチマーク用の合成データセット
+SYNTH_SPEC_NAME = "synth.json"
+# ベンチマークで比較する段階。ベースラインより許容率と最小差の両方を超えて遅くなったら劣化とみなす
+BENCH_DEFAULT_SIZES = (1000, 10000)
+BENCH_TOLERANCE = 0.25
+BENCH_MIN_DELTA = 0.05
+
+
+def format_bytes(num):
+    if num < 1024:
+        return f"{num} B"
+    for unit in ("KB", "MB", "GB", "TB"):
+        num /= 1024
+        if num < 1024 or unit == "TB":
+            return f"{num:.1f} {unit}"
+
+
+def peak_rss_bytes(children=False):
+    """このプロセス (children=True なら終了した子プロセス) の最大常駐メモリ。取得できなければ None"""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+    if resource is not None:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+        # macOS はバイト、Linux は KB 単位
+        return usage.ru_maxrss if sys.platform == "darwin" else usage.ru_maxrss * 1024
+    if os.name == "nt" and not children:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in ("PeakWorkingSetSize", "WorkingSetSize", "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                                                     "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage", "PagefileUsage", "PeakPagefileUsage")]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32 = ctypes.windll.kernel32
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        if ctypes.windll.psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+def _prometheus_labels(labels):
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items())) + "}"
+
+
+class RunMetrics:
+    """1 回の処理について段階ごとの所要時間 (span)、カウンター、ピークメモリを集める
+
+    report() の内容を JSON の実行レポートとして、必要なら Prometheus の textfile としても書き出す。
+    """
+
+    def __init__(self, run, **labels):
+        self.run = run
+        self.labels = labels
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.counters = {}
+        self.status = None
+        self.seconds = None
+        self.lock = threading.Lock()
+        self._stage = None
+
+    def add_span(self, name, seconds, offset=None, **labels):
+        if offset is None:
+            offset = time.perf_counter() - self.started - seconds
+        span = {"name": name, "offset": round(offset, 6), "seconds": round(seconds, 6)}
+        if labels:
+            span["labels"] = labels
+        with self.lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, time.perf_counter() - start, start - self.started, **labels)
+
+    def stage(self, name):
+        """直前の段階を閉じて name の計測を始める。None なら閉じるだけ"""
+        now = time.perf_counter()
+        if self._stage is not None:
+            previous, start = self._stage
+            self.add_span(previous, now - start, start - self.started)
+        self._stage = (name, now) if name else None
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self, status="ok"):
+        self.stage(None)
+        self.status = status
+        self.seconds = round(time.perf_counter() - self.started, 6)
+
+    def stage_totals(self):
+        totals = {}
+        for span in self.spans:
+            totals[span["name"]] = totals.get(span["name"], 0.0) + span["seconds"]
+        return totals
+
+    def report(self):
+        return {
+            "run": self.run,
+            "labels": self.labels,
+            "status": self.status,
+            "started_at": self.started_at,
+            "seconds": self.seconds if self.seconds is not None else round(time.perf_counter() - self.started, 6),
+            "peak_rss_bytes": peak_rss_bytes(),
+            "children_peak_rss_bytes": peak_rss_bytes(children=True),
+            "stages": {name: round(seconds, 6) for name, seconds in self.stage_totals().items()},
+            "spans": list(self.spans),
+            "counters": dict(self.counters),
+        }
+
+    def write_json(self, path):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def write_prometheus(self, metrics_dir):
+        """metrics_dir/mosaic_<run>[_<labels>].prom を書き出す。textfile collector が途中の内容を読まないよう置き換えで更新する"""
+        import re
+
+        report = self.report()
+        base = dict(self.labels, run=self.run)
+        suffix = "_".join(re.sub(r"[^A-Za-z0-9_.-]", "_", str(value)) for _, value in sorted(self.labels.items()))
+        path = os.path.join(metrics_dir, f"mosaic_{self.run}{'_' + suffix if suffix else ''}.prom")
+        lines = [
+            "# HELP mosaic_run_seconds Wall time of the run.",
+            "# TYPE mosaic_run_seconds gauge",
+            f"mosaic_run_seconds{_prometheus_labels(base)} {report['seconds']}",
+            "# HELP mosaic_run_success 1 if the run finished with status ok.",
+            "# TYPE mosaic_run_success gauge",
+            f"mosaic_run_success{_prometheus_labels(base)} {1 if report['status'] in ('ok', 'skipped') else 0}",
+            "# HELP mosaic_run_timestamp_seconds Unix time the run started.",
+            "# TYPE mosaic_run_timestamp_seconds gauge",
+            f"mosaic_run_timestamp_seconds{_prometheus_labels(base)} {report['started_at']:.3f}",
+            "# HELP mosaic_stage_seconds Total wall time per stage.",
+            "# TYPE mosaic_stage_seconds gauge",
+        ]
+        lines += [f"mosaic_stage_seconds{_prometheus_labels(dict(base, stage=name))} {seconds}" for name, seconds in report["stages"].items()]
+        lines += ["# HELP mosaic_run_count Counters collected during the run.", "# TYPE mosaic_run_count gauge"]
+        lines += [f"mosaic_run_count{_prometheus_labels(dict(base, name=name))} {value}" for name, value in sorted(report["counters"].items())]
+        for key in ("peak_rss_bytes", "children_peak_rss_bytes"):
+            if report[key] is not None:
+                lines += [f"# TYPE mosaic_{key} gauge", f"mosaic_{key}{_prometheus_labels(base)} {report[key]}"]
+        os.makedirs(metrics_dir, exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8", newline="\n") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+        return path
+
+
+def _reflink_file(src, dst):
+    """copy-on-write でデータブロックを共有したままファイルを複製する"""
+    if sys.platform.startswith("linux"):
+        import fcntl
+        FICLONE = 0x40049409
+        with open(src, "rb") as fsrc:
+            fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+            try:
+                fcntl.ioctl(fd, FICLONE, fsrc.fileno())
+            except OSError:
+                os.close(fd)
+                os.remove(dst)
+                raise
+            os.close(fd)
+        shutil.copystat(src, dst)
+    elif sys.platform == "darwin":
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if libc.clonefile(os.fsencode(src), os.fsencode(dst), 0) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dst)
+    else:
+        raise OSError(errno.EOPNOTSUPP, "reflink はこのプラットフォームでは使用できません", dst)
+
+
+class FileCloner:
+    """指定された複製方式でファイルを配置し、実際に使われた方式と書き込み量を記録する"""
+
+    def __init__(self, strategy="auto"):
+        if strategy not in _CLONE_FALLBACKS:
+            raise ValueError(f"不明な複製方式です: {strategy}")
+        self.strategy = strategy
+        self.counts = {}
+        self.bytes_written = 0
+        # ファイルシステムが対応していなかった方式は以降のファイルで試さない
+        self._disabled = set()
+        self._lock = threading.Lock()
+
+    def clone(self, src, dst, size=None):
+        """src を dst に配置し、ファイルサイズを返す"""
+        if size is None:
+            size = os.stat(src).st_size
+        if os.path.lexists(dst):
+            os.remove(dst)
+        for method in _CLONE_FALLBACKS[self.strategy]:
+            if method in self._disabled:
+                continue
+            try:
+                written = self._clone_with(method, src, dst, size)
+            except OSError as e:
+                if method == "copy" or e.errno == errno.ENOENT:
+                    raise
+                with self._lock:
+                    self._disabled.add(method)
+                continue
+            with self._lock:
+                self.counts[method] = self.counts.get(method, 0) + 1
+                self.bytes_written += written
+            return size
+
+    def _clone_with(self, method, src, dst, size):
+        if method == "reflink":
+            _reflink_file(src, dst)
+            return 0
+        if method == "hardlink":
+            os.link(src, dst)
+            return 0
+        if method == "symlink":
+            os.symlink(os.path.abspath(src), dst)
+            return 0
+        shutil.copy2(src, dst)
+        return size
+
+    def summary(self):
+        used = ", ".join(f"{method} {count}件" for method, count in sorted(self.counts.items())) or "なし"
+        return f"方式: {used} / 書き込み量: {format_bytes(self.bytes_written)}"
+
+
+class FileTransferEngine:
+    """FileCloner による配置をスレッドプールで並列実行し、失敗したファイルとスループットを記録する"""
+
+    def __init__(self, cloner, max_workers=None):
+        self.cloner = cloner
+        self.max_workers = max(1, max_workers or DEFAULT_IO_WORKERS)
+        self.errors = []
+        self.files = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+        # 1 ファイル終わるごとに処理済みの件数 (失敗を含む) で呼ばれる
+        self.progress = None
+
+    def run(self, jobs):
+        """(src, dst[, size]) の列を処理する。投入済みで未完了のジョブ数は max_workers の数倍までに抑える"""
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        start = time.perf_counter()
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for job in jobs:
+                pending[pool.submit(self.cloner.clone, *job)] = job[0]
+                if len(pending) >= self.max_workers * 4:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect(done, pending)
+            self._collect(list(pending), pending)
+        self.elapsed += time.perf_counter() - start
+
+    def _collect(self, futures, pending):
+        for future in futures:
+            src = pending.pop(future)
+            try:
+                size = future.result()
+            except Exception as e:
+                self.errors.append((src, e))
+            else:
+                self.files += 1
+                self.bytes += size
+            if self.progress:
+                self.progress(self.files + len(self.errors))
+
+    def summary(self):
+        elapsed = max(self.elapsed, 1e-9)
+        return (f"{self.files}件 / {self.elapsed:.2f}秒 "
+                f"({self.files / elapsed:.0f} files/s, {self.bytes / elapsed / 1024 ** 2:.1f} MB/s, {self.max_workers} threads)")
+
+
+class DatasetIndex:
+    """os.scandir による 1 回の走査で、フォルダ構成・画像とラベルのペア・サイズ・更新時刻を収集する
+
+    images/labels は両方を直下に持つ最も浅いフォルダを優先し、無ければ最初に見つかったものを使う。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.dirs = []
+        self.files = {}
+        self.images_dir = None
+        self.labels_dir = None
+        self.pairs = []
+        self.unpaired_images = []
+        self._scan()
+        self._pair()
+
+    @staticmethod
+    def _scan_dir(current):
+        subdirs = []
+        files = []
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    st = entry.stat()
+                    files.append(IndexedFile(entry.path, st.st_size, st.st_mtime))
+        return subdirs, files
+
+    def _scan(self):
+        first_images = first_labels = None
+        # 幅優先で走査し、浅い階層の images/labels を先に見つける
+        queue = deque([self.root])
+        while queue:
+            current = queue.popleft()
+            try:
+                subdirs, files = self._scan_dir(current)
+            except OSError:
+                continue
+            self.dirs.append(current)
+            self.files[current] = files
+            if self.images_dir is None and "images" in subdirs and "labels" in subdirs:
+                self.images_dir = os.path.join(current, "images")
+                self.labels_dir = os.path.join(current, "labels")
+            if first_images is None and "images" in subdirs:
+                first_images = os.path.join(current, "images")
+            if first_labels is None and "labels" in subdirs:
+                first_labels = os.path.join(current, "labels")
+            queue.extend(os.path.join(current, name) for name in sorted(subdirs))
+        if self.images_dir is None:
+            self.images_dir, self.labels_dir = first_images, first_labels
+
+    def refresh(self, dirs):
+        """変更のあったフォルダ (走査時と同じ形のパス) だけを読み直してペアを作り直す
+
+        フォルダが増えた・消えた場合は images/labels の選び方が変わりうるので、全体を走査し直す。
+        """
+        rescan = False
+        for current in set(dirs):
+            try:
+                if current not in self.files:
+                    raise OSError
+                subdirs, files = self._scan_dir(current)
+            except OSError:
+                rescan = True
+                break
+            children = {os.path.join(current, name) for name in subdirs}
+            if children != {d for d in self.files if d != current and os.path.dirname(d) == current}:
+                rescan = True
+                break
+            self.files[current] = files
+        if rescan:
+            self.dirs = []
+            self.files = {}
+            self.images_dir = self.labels_dir = None
+            self._scan()
+        self.pairs = []
+        self.unpaired_images = []
+        self._pair()
+        return rescan
+
+    def _pair(self):
+        if not self.images_dir or not self.labels_dir:
+            return
+        labels = {}
+        for f in self.files.get(self.labels_dir, ()):
+            base, ext = os.path.splitext(os.path.basename(f.path))
+            if ext.lower() == ".txt":
+                labels[base] = f
+        for f in self.files.get(self.images_dir, ()):
+            base, ext = os.path.splitext(os.path.basename(f.path))
+            if ext.lower() not in IMAGE_EXTS:
+                continue
+            if base in labels:
+                self.pairs.append(DatasetPair(base, ext, f, labels[base]))
+            else:
+                self.unpaired_images.append(f)
+        # scandir の順序はファイルシステム依存なので、振り分け前に並びを固定する
+        self.pairs.sort()
+
+    def without(self, keys):
+        """keys のペアを、ペアとしてもそれ以外のファイルとしても含まない写しを返す (この索引は変えない)"""
+        import copy
+
+        excluded = {path for pair in self.pairs if pair.base + pair.ext in keys for path in (pair.image.path, pair.label.path)}
+        index = copy.copy(self)
+        index.files = {root: [f for f in files if f.path not in excluded] for root, files in self.files.items()}
+        index.pairs = [pair for pair in self.pairs if pair.image.path not in excluded]
+        return index
+
+    def iter_files(self):
+        for files in self.files.values():
+            yield from files
+
+    @property
+    def total_bytes(self):
+        return sum(f.size for f in self.iter_files())
+
+
+def hash_file(*paths):
+    """ファイルの内容ハッシュ (複数なら連結した内容のハッシュ)。読み込めない場合は None"""
+    import hashlib
+
+    digest = hashlib.blake2b(digest_size=16)
+    try:
+        for path in paths:
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def hash_pair(pair):
+    """画像とラベルの内容ハッシュ。読み込めない場合は None"""
+    return hash_file(pair.image.path, pair.label.path)
+
+
+def hash_pairs(pairs, max_workers=None):
+    from concurrent.futures import ThreadPoolExecutor
+
+    hashes = {}
+    with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_IO_WORKERS) as pool:
+        for start in range(0, len(pairs), 1024):
+            chunk = pairs[start:start + 1024]
+            for pair, digest in zip(chunk, pool.map(hash_pair, chunk)):
+                hashes[pair.base + pair.ext] = digest
+    return hashes
+
+
+def content_hashes(files, cache, max_workers=None):
+    """ファイル (IndexedFile) の内容ハッシュを返す。キャッシュにないものだけをスレッドプールで計算し、読めないものは None"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = {f.path: cache.lookup(f) for f in files}
+    todo = [f for f in files if results[f.path] is None]
+    batches = [todo[start:start + FILE_JOB_BATCH] for start in range(0, len(todo), FILE_JOB_BATCH)]
+    with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_IO_WORKERS) as pool:
+        for batch, digests in zip(batches, pool.map(lambda batch: [hash_file(f.path) for f in batch], batches)):
+            for f, digest in zip(batch, digests):
+                if digest is not None:
+                    results[f.path] = digest
+                    cache.store(f, digest, digest)
+    cache.prune(results.keys())
+    return results, len(todo)
+
+
+def index_classes(index):
+    """走査済みの DatasetIndex で最も浅い位置にある classes.txt のクラス一覧。無い・読めない場合は None"""
+    for root in index.dirs:
+        for f in index.files[root]:
+            if os.path.basename(f.path) == "classes.txt":
+                try:
+                    with open(f.path, "r", encoding="utf-8") as classes_file:
+                        return [line.strip() for line in classes_file if line.strip()]
+                except OSError:
+                    return None
+    return None
+
+
+class ConversionManifest:
+    """変換結果のマニフェスト。ペアごとのパス・サイズ・更新時刻・内容ハッシュ・振り分け先を記録する
+
+    配置の完了はジャーナルに追記していき、save() でマニフェスト本体へ反映する。
+    中断された場合は次回 load() 時にジャーナルから完了状態を復元して続きから再開する。
+    """
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.layout = {}
+        self.pairs = {}
+        self.extras = {}
+        self.kfold = 0
+
+    @classmethod
+    def load(cls, path):
+        manifest = cls(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return manifest
+        if data.get("version") != cls.VERSION:
+            return manifest
+        manifest.layout = data.get("layout", {})
+        manifest.pairs = data.get("pairs", {})
+        manifest.extras = data.get("extras", {})
+        manifest.kfold = data.get("kfold", 0)
+        try:
+            with open(manifest.journal_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    entry = manifest.pairs.get(line.rstrip("\n"))
+                    if entry is not None:
+                        entry["done"] = True
+        except OSError:
+            pass
+        return manifest
+
+    def record(self, key, pair, root, digest, subset):
+        self.pairs[key] = {
+            "image": os.path.relpath(pair.image.path, root).replace("\\", "/"),
+            "image_size": pair.image.size,
+            "image_mtime": pair.image.mtime,
+            "label": os.path.relpath(pair.label.path, root).replace("\\", "/"),
+            "label_size": pair.label.size,
+            "label_mtime": pair.label.mtime,
+            "hash": digest,
+            "subset": subset,
+            "done": False,
+        }
+
+    @staticmethod
+    def stat_matches(entry, pair):
+        return (entry["image_size"] == pair.image.size and entry["image_mtime"] == pair.image.mtime
+                and entry["label_size"] == pair.label.size and entry["label_mtime"] == pair.label.mtime)
+
+    def mark_done(self, keys):
+        if not keys:
+            return
+        for key in keys:
+            self.pairs[key]["done"] = True
+        with open(self.journal_path, "a", encoding="utf-8") as f:
+            f.write("".join(key + "\n" for key in keys))
+
+    def subset_counts(self):
+        counts = {"train": 0, "val": 0}
+        for entry in self.pairs.values():
+            counts[entry["subset"]] = counts.get(entry["subset"], 0) + 1
+        return counts
+
+    def save(self):
+        data = {"version": self.VERSION, "layout": self.layout, "pairs": self.pairs, "extras": self.extras, "kfold": self.kfold}
+        tmp_path = self.path + ".tmp"
+        # json.dump はファイルへ書きながら Python 実装のエンコーダを使うので、C 実装の dumps で一度に文字列にする
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+        os.replace(tmp_path, self.path)
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def digest(self):
+        import hashlib
+
+        digest = hashlib.blake2b(digest_size=16)
+        for key in sorted(self.pairs):
+            digest.update(f"{key}\0{self.pairs[key]['hash']}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+
+def _read_bytes(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return b""
+
+
+def _parse_label_row(tokens):
+    """1 行分のラベル (空白で区切った列) を (class, x, y, w, h) にする。ポリゴン形式は外接矩形に変換し、不正な行は None"""
+    try:
+        values = [float(token) for token in tokens]
+    except ValueError:
+        return None
+    if not values or not all(map(math.isfinite, values)) or not (values[0].is_integer() and 0 <= values[0] <= LABEL_CLASS_ID_MAX):
+        return None
+    if len(values) == 5:
+        return values
+    if len(values) >= 7 and len(values) % 2 == 1:
+        xs, ys = values[1::2], values[2::2]
+        return [values[0], (min(xs) + max(xs)) / 2, (min(ys) + max(ys)) / 2, max(xs) - min(xs), max(ys) - min(ys)]
+    return None
+
+
+def parse_yolo_labels(blobs):
+    """ラベルファイルの中身 (bytes) の列をまとめて解析し、(ファイルごとの行数, class_id, boxes, 不正な行数) を返す
+
+    すべての行が 5 列の有限な数値で、クラス ID が 0〜LABEL_CLASS_ID_MAX の整数の場合は NumPy で一括変換し、
+    そうでなければ 1 行ずつ解析して不正な行を除く。
+    """
+    import numpy as np
+
+    file_rows = [[tokens for tokens in map(bytes.split, blob.splitlines()) if tokens] for blob in blobs]
+    counts = [len(rows) for rows in file_rows]
+    total = sum(counts)
+    table = None
+    if total and all(len(tokens) == 5 for rows in file_rows for tokens in rows):
+        try:
+            table = np.array([token for rows in file_rows for tokens in rows for token in tokens], dtype=np.float32).reshape(-1, 5)
+        except ValueError:
+            table = None
+        if table is not None:
+            class_ids = table[:, 0]
+            if (not np.isfinite(table).all()
+                    or not ((class_ids >= 0) & (class_ids <= LABEL_CLASS_ID_MAX) & (class_ids == np.floor(class_ids))).all()):
+                table = None
+    invalid = 0
+    if table is None:
+        parsed = []
+        for i, rows in enumerate(file_rows):
+            kept = [values for values in map(_parse_label_row, rows) if values is not None]
+            invalid += len(rows) - len(kept)
+            counts[i] = len(kept)
+            parsed.extend(kept)
+        table = np.array(parsed, dtype=np.float32).reshape(-1, 5)
+    return counts, table[:, 0].astype(np.int16), np.ascontiguousarray(table[:, 1:]), invalid
+
+
+def stratified_split(matrix, split_ratio, seed=None, fixed=None):
+    """クラス別ラベル数行列 (画像数, クラス数) から、反復層化で train に入れる画像を決める
+
+    サンプルが少ないクラスから順に、そのクラスを含む未割当の画像をまとめて train/val に配る。
+    配る割合は各クラスの train/val の残り必要数から決める。fixed は 1=train, 0=val, -1=未割当で、
+    割当済みの画像はそのまま残し、必要数の計算にだけ使う。
+    """
+    import numpy as np
+
+    rng = np.random.default_rng(seed)
+    n = matrix.shape[0]
+    assign = np.full(n, -1, dtype=np.int8) if fixed is None else np.asarray(fixed, dtype=np.int8).copy()
+    total = matrix.sum(axis=0, dtype=np.int64)
+    desired_train = total * split_ratio - matrix[assign == 1].sum(axis=0, dtype=np.int64)
+    desired_val = total * (1 - split_ratio) - matrix[assign == 0].sum(axis=0, dtype=np.int64)
+    size_train = n * split_ratio - np.count_nonzero(assign == 1)
+    remaining = matrix[assign == -1].sum(axis=0, dtype=np.int64)
+
+    while True:
+        open_classes = np.flatnonzero(remaining > 0)
+        if not open_classes.size:
+            break
+        cls = open_classes[np.argmin(remaining[open_classes])]
+        idx = rng.permutation(np.flatnonzero((assign == -1) & (matrix[:, cls] > 0)))
+        want_train = max(desired_train[cls], 0)
+        want_val = max(desired_val[cls], 0)
+        share = want_train / (want_train + want_val) if want_train + want_val > 0 else split_ratio
+        weights = matrix[idx, cls]
+        to_train = np.cumsum(weights) - weights / 2 < share * weights.sum()
+        assign[idx[to_train]] = 1
+        assign[idx[~to_train]] = 0
+        desired_train -= matrix[idx[to_train]].sum(axis=0, dtype=np.int64)
+        desired_val -= matrix[idx[~to_train]].sum(axis=0, dtype=np.int64)
+        size_train -= np.count_nonzero(to_train)
+        remaining -= matrix[idx].sum(axis=0, dtype=np.int64)
+
+    # ラベルが 1 つも無い画像は全体の比率が合うように配る
+    rest = rng.permutation(np.flatnonzero(assign == -1))
+    n_train = int(np.clip(round(size_train), 0, rest.size))
+    assign[rest[:n_train]] = 1
+    assign[rest[n_train:]] = 0
+    return assign == 1
+
+
+class LabelStore:
+    """全ラベルを列指向の NumPy 配列で保持する
+
+    keys[i] のラベル行は classes/boxes の offsets[i]:offsets[i + 1] にあり、boxes は (x, y, w, h) の float32。
+    キャッシュはマニフェストのダイジェストごとに .npy で保存し、mmap で読み込む。
+    """
+
+    ARRAYS = ("keys", "hashes", "offsets", "classes", "boxes")
+    # 解析の規則を変えたら上げる。古い版のキャッシュは再利用せずに解析し直す
+    VERSION = 2
+
+    def __init__(self, keys, hashes, offsets, classes, boxes, invalid_rows=0):
+        self.keys = keys
+        self.hashes = hashes
+        self.offsets = offsets
+        self.classes = classes
+        self.boxes = boxes
+        self.invalid_rows = invalid_rows
+
+    @classmethod
+    def load(cls, cache_dir):
+        import numpy as np
+        arrays = {name: np.load(os.path.join(cache_dir, name + ".npy"), mmap_mode="r") for name in cls.ARRAYS}
+        return cls(**arrays)
+
+    def save(self, cache_dir):
+        import numpy as np
+        tmp_dir = cache_dir + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in self.ARRAYS:
+            np.save(os.path.join(tmp_dir, name + ".npy"), getattr(self, name))
+        os.rename(tmp_dir, cache_dir)
+
+    @classmethod
+    def load_or_build(cls, cache_root, manifest, pairs, max_workers=None):
+        """マニフェストが同じならキャッシュを返す。変わっていれば内容ハッシュが同じファイルの行は前回分を再利用する"""
+        from concurrent.futures import ThreadPoolExecutor
+        import numpy as np
+
+        prefix = f"v{cls.VERSION}-"
+        cache_dir = os.path.join(cache_root, prefix + manifest.digest())
+        if os.path.isdir(cache_dir):
+            try:
+                return cls.load(cache_dir)
+            except (OSError, ValueError):
+                shutil.rmtree(cache_dir, ignore_errors=True)
+
+        previous = None
+        reuse = {}
+        if os.path.isdir(cache_root):
+            for name in os.listdir(cache_root):
+                if not name.startswith(prefix):
+                    continue
+                try:
+                    previous = cls.load(os.path.join(cache_root, name))
+                    break
+                except (OSError, ValueError):
+                    continue
+        if previous is not None:
+            for i, (key, digest) in enumerate(zip(previous.keys.tolist(), previous.hashes.tolist())):
+                entry = manifest.pairs.get(key)
+                if entry is not None and entry["hash"] is not None and entry["hash"] == digest:
+                    reuse[key] = i
+
+        keys = sorted(pairs)
+        to_parse = [key for key in keys if key not in reuse]
+        blobs = []
+        with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_IO_WORKERS) as pool:
+            for start in range(0, len(to_parse), 1024):
+                blobs.extend(pool.map(_read_bytes, [pairs[key].label.path for key in to_parse[start:start + 1024]]))
+        counts, classes, boxes, invalid = parse_yolo_labels(blobs)
+        parsed_offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+        parsed_pos = {key: i for i, key in enumerate(to_parse)}
+
+        # 前回分と今回解析した分を 1 本につなげ、ペアごとの行範囲をまとめて集める (ペアごとに mmap を切り出さない)
+        if previous is not None:
+            all_classes = np.concatenate((np.asarray(previous.classes, dtype=np.int16), classes))
+            all_boxes = np.concatenate((np.asarray(previous.boxes, dtype=np.float32).reshape(-1, 4), boxes))
+            previous_offsets = previous.offsets.tolist()
+            shift = len(previous.classes)
+        else:
+            all_classes, all_boxes, previous_offsets, shift = classes, boxes, [], 0
+        new_offsets = parsed_offsets.tolist()
+        starts, row_counts = [], []
+        for key in keys:
+            if key in reuse:
+                i = reuse[key]
+                starts.append(previous_offsets[i])
+                row_counts.append(previous_offsets[i + 1] - previous_offsets[i])
+            else:
+                i = parsed_pos[key]
+                starts.append(new_offsets[i] + shift)
+                row_counts.append(new_offsets[i + 1] - new_offsets[i])
+        starts = np.array(starts, dtype=np.int64)
+        row_counts = np.array(row_counts, dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(row_counts, dtype=np.int64)))
+        rows = np.repeat(starts - offsets[:-1], row_counts) + np.arange(offsets[-1], dtype=np.int64)
+
+        store = cls(
+            keys=np.array(keys, dtype=str),
+            hashes=np.array([str(manifest.pairs[key]["hash"]) for key in keys], dtype=str),
+            offsets=offsets,
+            classes=all_classes[rows].astype(np.int16, copy=False),
+            boxes=all_boxes[rows].astype(np.float32, copy=False).reshape(-1, 4),
+            invalid_rows=invalid,
+        )
+        # 古いキャッシュは消して、最新の 1 つだけを残す (mmap を先に解放しておく)
+        del previous, all_classes, all_boxes
+        if os.path.isdir(cache_root):
+            for name in os.listdir(cache_root):
+                shutil.rmtree(os.path.join(cache_root, name), ignore_errors=True)
+        os.makedirs(cache_root, exist_ok=True)
+        store.save(cache_dir)
+        return store
+
+    def class_ids(self):
+        import numpy as np
+        return np.unique(self.classes).tolist()
+
+    def class_matrix(self):
+        """(ファイル数, クラス数) のクラス別ラベル数行列と、各列のクラス ID"""
+        import numpy as np
+
+        if getattr(self, "_class_matrix", None) is None:
+            class_ids, columns = np.unique(self.classes, return_inverse=True)
+            rows = np.repeat(np.arange(len(self.keys)), np.diff(self.offsets))
+            matrix = np.zeros((len(self.keys), len(class_ids)), dtype=np.int32)
+            np.add.at(matrix, (rows, columns.reshape(-1)), 1)
+            self._class_matrix = (matrix, class_ids.tolist())
+        return self._class_matrix
+
+    def class_counts(self):
+        import numpy as np
+        ids, counts = np.unique(self.classes, return_counts=True)
+        return dict(zip(ids.tolist(), counts.tolist()))
+
+
+def _image_header(data):
+    """PNG/JPEG のヘッダから (形式, 幅, 高さ) を読む。壊れている・途中で切れている場合は ValueError"""
+    import struct
+
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        if len(data) < 24 or data[12:16] != b"IHDR":
+            raise ValueError("PNG のヘッダ (IHDR) がありません")
+        width, height = struct.unpack(">II", data[16:24])
+        if b"IEND" not in data[-12:]:
+            raise ValueError("PNG の末尾 (IEND) がありません (途中で切れています)")
+        return "PNG", width, height
+    if data[:2] == b"\xff\xd8":
+        pos = 2
+        while pos + 4 <= len(data):
+            if data[pos] != 0xFF:
+                raise ValueError("JPEG のマーカーが壊れています")
+            marker = data[pos + 1]
+            if marker == 0xFF:
+                pos += 1
+                continue
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+                pos += 2
+                continue
+            if marker in (0xD9, 0xDA):
+                break
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                if pos + 9 > len(data):
+                    raise ValueError("JPEG のヘッダ (SOF) が途中で切れています")
+                height, width = struct.unpack(">HH", data[pos + 5:pos + 9])
+                # 圧縮データ中の 0xFF は必ずエスケープされるので、SOF より後の FFD9 は画像の終端 (EOI)
+                if data.find(b"\xff\xd9", pos) == -1:
+                    raise ValueError("JPEG の終端 (EOI) がありません (途中で切れています)")
+                return "JPEG", width, height
+            pos += 2 + struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        raise ValueError("JPEG に画像サイズ (SOF) がありません")
+    raise ValueError("PNG/JPEG として認識できません")
+
+
+def check_image_bytes(data):
+    """画像を検査する。ヘッダの寸法を読み、Pillow があれば最後までデコードできるかも確かめる"""
+    if not data:
+        return {"error": "0 バイトのファイルです"}
+    try:
+        fmt, width, height = _image_header(data)
+    except ValueError as e:
+        return {"error": str(e)}
+    if not width or not height:
+        return {"error": f"画像サイズが不正です ({width}x{height})"}
+    try:
+        import io
+        from PIL import Image
+    except ImportError:
+        return {"format": fmt, "width": width, "height": height, "error": None}
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            if image.size != (width, height):
+                return {"error": f"ヘッダとデコード結果の画像サイズが一致しません ({width}x{height} / {image.size[0]}x{image.size[1]})"}
+            image.load()
+    except Exception as e:
+        return {"error": f"デコードできません: {e}"}
+    return {"format": fmt, "width": width, "height": height, "error": None}
+
+
+def check_label_bytes(data):
+    """YOLO 形式のラベルを検査し、行数・使われているクラス ID・最初の数件の不正箇所を返す (空のファイルは背景画像として正常)"""
+    try:
+        text = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        return {"error": "UTF-8 として読めません"}
+    errors = []
+    classes = set()
+    rows = 0
+    for lineno, row in enumerate(text.splitlines(), 1):
+        tokens = row.split()
+        if not tokens:
+            continue
+        rows += 1
+        if len(tokens) != 5 and not (len(tokens) >= 7 and len(tokens) % 2 == 1):
+            errors.append(f"{lineno} 行目: 列数が不正です ({len(tokens)} 列)")
+        else:
+            try:
+                values = [float(token) for token in tokens]
+            except ValueError:
+                errors.append(f"{lineno} 行目: 数値でない値があります")
+                values = None
+            if values is not None:
+                class_id, coords = values[0], values[1:]
+                if not class_id.is_integer() or not 0 <= class_id <= LABEL_CLASS_ID_MAX:
+                    errors.append(f"{lineno} 行目: クラス ID が不正です ({tokens[0]})")
+                else:
+                    classes.add(int(class_id))
+                if not all(0 <= value <= 1 for value in coords):
+                    errors.append(f"{lineno} 行目: 座標が 0〜1 の範囲外です")
+                elif len(coords) == 4:
+                    x, y, w, h = coords
+                    if w <= 0 or h <= 0:
+                        errors.append(f"{lineno} 行目: 幅または高さが 0 以下です")
+                    elif (x - w / 2 < -LABEL_BOX_TOLERANCE or x + w / 2 > 1 + LABEL_BOX_TOLERANCE
+                          or y - h / 2 < -LABEL_BOX_TOLERANCE or y + h / 2 > 1 + LABEL_BOX_TOLERANCE):
+                        errors.append(f"{lineno} 行目: ボックスが画像の外にはみ出しています")
+        if len(errors) >= 5:
+            break
+    return {"rows": rows, "classes": sorted(classes), "error": "; ".join(errors) or None}
+
+
+def _validate_file(job):
+    """プロセスプールのワーカーで 1 ファイルを読み、(内容ハッシュ, 検査結果) を返す。読めなければハッシュは None"""
+    import hashlib
+
+    kind, path = job
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return None, {"error": f"読み込めません: {e}"}
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    return digest, check_image_bytes(data) if kind == "image" else check_label_bytes(data)
+
+
+class ValidationCache:
+    """検査結果のキャッシュ
+
+    結果はファイル内容のハッシュごとに持ち、サイズと更新時刻が前回と同じファイルはハッシュも計算し直さない。
+    クラス ID が classes.txt の範囲内かは検査結果のクラス一覧から毎回判定するので、classes.txt を変えても作り直す必要はない。
+    知覚ハッシュのキャッシュにも同じ形式を使う。
+    """
+
+    VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.results = {}
+
+    @classmethod
+    def load(cls, path):
+        cache = cls(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return cache
+        if data.get("version") == cls.VERSION:
+            cache.files = data.get("files", {})
+            cache.results = data.get("results", {})
+        return cache
+
+    def lookup(self, indexed_file):
+        entry = self.files.get(indexed_file.path)
+        if entry is None or entry[0] != indexed_file.size or entry[1] != indexed_file.mtime:
+            return None
+        return self.results.get(entry[2])
+
+    def store(self, indexed_file, digest, result):
+        self.files[indexed_file.path] = [indexed_file.size, indexed_file.mtime, digest]
+        self.results[digest] = result
+
+    def prune(self, paths):
+        """paths 以外のファイルと、どのファイルからも参照されなくなった結果を捨てる"""
+        self.files = {path: entry for path, entry in self.files.items() if path in paths}
+        used = {entry[2] for entry in self.files.values()}
+        self.results = {digest: result for digest, result in self.results.items() if digest in used}
+
+    def save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"version": self.VERSION, "files": self.files, "results": self.results}, ensure_ascii=False, separators=(",", ":")))
+        os.replace(tmp_path, self.path)
+
+
+def _run_file_jobs(func, jobs, max_workers=None):
+    """ファイル単位の CPU 処理を実行する。件数が少なければプロセスを起動せずその場で処理する"""
+    workers = max_workers or os.cpu_count() or 1
+    if len(jobs) >= VALIDATION_POOL_MIN_FILES and workers > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            return list(pool.map(func, jobs, chunksize=max(1, min(256, len(jobs) // (workers * 4)))))
+    return [func(job) for job in jobs]
+
+
+def validate_pairs(pairs, cache, class_count=None, max_workers=None):
+    """ペアの画像とラベルを検査し、({ペアのキー: 不正の理由のリスト}, 新たに検査したファイル数) を返す
+
+    キャッシュにないファイルだけをプロセスプールで検査する。class_count があればクラス ID がその範囲内かも確かめる。
+    """
+    files = [("image", pair.image) for pair in pairs] + [("label", pair.label) for pair in pairs]
+    results = {f.path: cache.lookup(f) for _, f in files}
+    todo = [(kind, f) for kind, f in files if results[f.path] is None]
+    jobs = [(kind, f.path) for kind, f in todo]
+    outcomes = _run_file_jobs(_validate_file, jobs, max_workers)
+    for (kind, f), (digest, result) in zip(todo, outcomes):
+        results[f.path] = result
+        # 読み込みに失敗したものは一時的な原因もあり得るのでキャッシュしない。
+        # 0 バイトの画像と空のラベルのように内容が同じでも検査内容は違うので、種類ごとに分けて持つ
+        if digest is not None:
+            cache.store(f, f"{kind}:{digest}", result)
+    cache.prune(results.keys())
+
+    bad = {}
+    for pair in pairs:
+        image, label = results[pair.image.path], results[pair.label.path]
+        reasons = []
+        if image["error"]:
+            reasons.append(f"画像: {image['error']}")
+        if label["error"]:
+            reasons.append(f"ラベル: {label['error']}")
+        elif class_count is not None:
+            unknown = [class_id for class_id in label["classes"] if class_id >= class_count]
+            if unknown:
+                reasons.append(f"ラベル: classes.txt にないクラス ID があります ({', '.join(map(str, unknown))})")
+        if reasons:
+            bad[pair.base + pair.ext] = reasons
+    return bad, len(jobs)
+
+
+def _perceptual_hash_file(path):
+    """プロセスプールのワーカーで画像の dHash (64 bit) を計算し、(内容ハッシュ, 結果) を返す。読めなければ内容ハッシュは None"""
+    import hashlib
+    import io
+    from PIL import Image
+
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError as e:
+        return None, {"phash": None, "error": f"読み込めません: {e}"}
+    digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEG は縮小した解像度で直接デコードさせる
+            image.draft("L", (64, 64))
+            pixels = image.convert("L").resize((9, 8)).tobytes()
+    except Exception as e:
+        return digest, {"phash": None, "error": f"デコードできません: {e}"}
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return digest, {"phash": value, "error": None}
+
+
+def perceptual_hashes(files, cache, max_workers=None):
+    """画像 (IndexedFile) の知覚ハッシュを返す。キャッシュにないものだけをプロセスプールで計算する"""
+    results = {f.path: cache.lookup(f) for f in files}
+    todo = [f for f in files if results[f.path] is None]
+    for f, (digest, result) in zip(todo, _run_file_jobs(_perceptual_hash_file, [f.path for f in todo], max_workers)):
+        results[f.path] = result
+        if digest is not None:
+            cache.store(f, digest, result)
+    cache.prune(results.keys())
+    return {path: result["phash"] for path, result in results.items()}, len(todo)
+
+
+if hasattr(int, "bit_count"):
+    _popcount = int.bit_count
+else:
+    def _popcount(value):
+        return bin(value).count("1")
+
+
+def find_near_duplicates(hashes, max_distance=DUPLICATE_HAMMING_DISTANCE):
+    """{キー: 64 bit ハッシュ} から、ハミング距離 max_distance 以内でつながる画像のクラスタ (2 件以上) を返す
+
+    multi-index hashing で候補を絞る。ハッシュを max_distance + 1 個の部分に分けると、距離が max_distance 以内の組は
+    鳩の巣原理でどれかの部分が完全に一致するので、部分ごとのバケットの中だけを比べれば取りこぼしはない。
+    同じハッシュの画像は先にまとめ、比較は異なるハッシュの間だけで行う。
+    """
+    by_value = {}
+    for key, value in hashes.items():
+        if value is not None:
+            by_value.setdefault(value, []).append(key)
+    values = list(by_value)
+    parent = list(range(len(values)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    if max_distance > 0:
+        parts = max_distance + 1
+        for part in range(parts):
+            low, high = 64 * part // parts, 64 * (part + 1) // parts
+            mask = (1 << (high - low)) - 1
+            buckets = {}
+            for i, value in enumerate(values):
+                buckets.setdefault((value >> low) & mask, []).append(i)
+            for members in buckets.values():
+                for a, i in enumerate(members):
+                    value = values[i]
+                    for j in members[a + 1:]:
+                        if _popcount(value ^ values[j]) <= max_distance:
+                            root_i, root_j = find(i), find(j)
+                            if root_i != root_j:
+                                parent[root_j] = root_i
+
+    clusters = {}
+    for i, value in enumerate(values):
+        clusters.setdefault(find(i), []).extend(by_value[value])
+    return sorted((sorted(keys) for keys in clusters.values() if len(keys) > 1), key=lambda keys: keys[0])
+
+
+class ShardWriter:
+    """サンプルを上限サイズごとのシャードに順に書き込み、各パートの (シャード番号, オフセット, サイズ) を返す
+
+    tar は ustar のヘッダを自前で書くので、中身のオフセットがそのまま分かる (WebDataset でも tarfile でも読める)。
+    """
+
+    def __init__(self, directory, prefix, fmt, max_bytes=SHARD_MAX_BYTES):
+        self.directory = directory
+        self.prefix = prefix
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.names = []
+        self.file = None
+        self.bytes = 0
+
+    def _open_next(self):
+        self._close_current()
+        name = f"{self.prefix}-{len(self.names):05d}.{'tar' if self.fmt == 'tar' else 'bin'}"
+        self.file = open(os.path.join(self.directory, name), "wb")
+        self.names.append(name)
+
+    def add(self, name, parts):
+        """parts は (拡張子, bytes) の列。tar では <name>.<拡張子> のメンバーとして書く"""
+        import tarfile
+
+        if self.fmt == "tar":
+            # ヘッダとブロック単位の詰め物、閉じるときの終端とレコードの詰め物の分も見込む
+            size = sum(tarfile.BLOCKSIZE * (1 + -(-len(data) // tarfile.BLOCKSIZE)) for _, data in parts)
+            size += 2 * tarfile.BLOCKSIZE + tarfile.RECORDSIZE
+        else:
+            size = sum(len(data) for _, data in parts)
+        if self.file is None or (self.file.tell() and self.file.tell() + size > self.max_bytes):
+            self._open_next()
+        locations = []
+        for ext, data in parts:
+            if self.fmt == "tar":
+                info = tarfile.TarInfo(f"{name}.{ext}")
+                info.size = len(data)
+                info.mode = 0o644
+                info.mtime = int(time.time())
+                self.file.write(info.tobuf(tarfile.USTAR_FORMAT))
+            locations.append((len(self.names) - 1, self.file.tell(), len(data)))
+            self.file.write(data)
+            if self.fmt == "tar" and len(data) % tarfile.BLOCKSIZE:
+                self.file.write(b"\0" * (tarfile.BLOCKSIZE - len(data) % tarfile.BLOCKSIZE))
+            self.bytes += len(data)
+        return locations
+
+    def _close_current(self):
+        import tarfile
+
+        if self.file is None:
+            return
+        if self.fmt == "tar":
+            # 終端の 2 ブロックを書き、レコード単位に切りそろえる
+            self.file.write(b"\0" * (2 * tarfile.BLOCKSIZE))
+            if self.file.tell() % tarfile.RECORDSIZE:
+                self.file.write(b"\0" * (tarfile.RECORDSIZE - self.file.tell() % tarfile.RECORDSIZE))
+        self.file.close()
+        self.file = None
+
+    def close(self):
+        self._close_current()
+        return self.names
+
+
+def export_shards(source_dir, manifest, shard_dir, fmt="tar", max_bytes=SHARD_MAX_BYTES, seed=None, max_workers=None, paths=None):
+    """マニフェストの train/val を shard_dir にシャードとして書き出し、索引 (shards.json) の中身を返す
+
+    各 subset の中は seed で並びを混ぜてから詰める。読み込みはスレッドで先読みし、書き込みは順に行う。
+    paths (キー -> (画像, ラベル) のパス) を渡すと元のファイルの代わりにそれを読む (前処理済みの画像など)。
+    読み込めないファイルがあれば空のサンプルは詰めずに、すべて読み終えてから件数と例を添えて OSError を送出する。
+    """
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+
+    failed = []
+
+    def read(path):
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError as e:
+            failed.append(f"{path}: {e.strerror or e}")
+            return None
+
+    rng = random.Random(seed)
+    index = {"version": 1, "format": fmt, "digest": manifest.digest(), "seed": seed, "max_bytes": max_bytes, "subsets": {}}
+    with ThreadPoolExecutor(max_workers=max_workers or DEFAULT_IO_WORKERS) as pool:
+        for subset in ("train", "val"):
+            keys = sorted(key for key, entry in manifest.pairs.items() if entry["subset"] == subset)
+            rng.shuffle(keys)
+            writer = ShardWriter(shard_dir, subset, fmt, max_bytes)
+            samples = []
+            for start in range(0, len(keys), 1024):
+                chunk = keys[start:start + 1024]
+                if paths is None:
+                    files = [os.path.join(source_dir, manifest.pairs[key][part]) for key in chunk for part in ("image", "label")]
+                else:
+                    files = [path for key in chunk for path in paths(key)]
+                blobs = list(pool.map(read, files))
+                for i, key in enumerate(chunk):
+                    if blobs[2 * i] is None or blobs[2 * i + 1] is None:
+                        continue
+                    image_ext = os.path.splitext(key)[1].lstrip(".").lower()
+                    (shard, image_offset, image_size), (_, label_offset, label_size) = writer.add(
+                        f"{start + i:08d}", [(image_ext, blobs[2 * i]), ("txt", blobs[2 * i + 1])])
+                    samples.append([key, shard, image_offset, image_size, label_offset, label_size])
+            index["subsets"][subset] = {"shards": writer.close(), "bytes": writer.bytes, "samples": samples}
+    if failed:
+        raise OSError(f"読み込めないファイルが {len(failed)}件あります ({'; '.join(failed[:5])})")
+    return index
+
+
+def _shard_pattern(names):
+    """WebDataset の brace 記法でシャードの一覧を表す (例: train-{00000..00003}.tar)"""
+    if len(names) <= 1:
+        return f"{SHARD_DIR_NAME}/{names[0]}" if names else ""
+    prefix, ext = names[0].rsplit("-", 1)[0], os.path.splitext(names[0])[1]
+    return f"{SHARD_DIR_NAME}/{prefix}-{{00000..{len(names) - 1:05d}}}{ext}"
+
+
+class ShardReader:
+    """export_shards で書き出したシャードを mmap で読む。read(subset, i) と read_key(key) は (画像, ラベル) の bytes を返す"""
+
+    def __init__(self, index_path):
+        with open(index_path, "r", encoding="utf-8") as f:
+            self.index = json.load(f)
+        self.directory = os.path.dirname(index_path)
+        self.samples = {subset: info["samples"] for subset, info in self.index["subsets"].items()}
+        self.positions = {sample[0]: (subset, i) for subset, samples in self.samples.items() for i, sample in enumerate(samples)}
+        self.maps = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def keys(self, subset=None):
+        subsets = [subset] if subset else list(self.samples)
+        return [sample[0] for name in subsets for sample in self.samples[name]]
+
+    def _map(self, subset, shard):
+        import mmap
+
+        view = self.maps.get((subset, shard))
+        if view is None:
+            with self.lock:
+                view = self.maps.get((subset, shard))
+                if view is None:
+                    with open(os.path.join(self.directory, self.index["subsets"][subset]["shards"][shard]), "rb") as f:
+                        # 中身がすべて空のシャードは mmap できないので空の bytes で代用する
+                        view = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+                    self.maps[(subset, shard)] = view
+        return view
+
+    def read(self, subset, i):
+        _, shard, image_offset, image_size, label_offset, label_size = self.samples[subset][i]
+        view = self._map(subset, shard)
+        return view[image_offset:image_offset + image_size], view[label_offset:label_offset + label_size]
+
+    def read_key(self, key):
+        return self.read(*self.positions[key])
+
+    def __iter__(self):
+        """subset ごとに書き込んだ順 (シャードの先頭から) に (キー, 画像, ラベル) を返す"""
+        for subset, samples in self.samples.items():
+            for i, sample in enumerate(samples):
+                yield (sample[0],) + self.read(subset, i)
+
+    def close(self):
+        with self.lock:
+            for view in self.maps.values():
+                if view:
+                    view.close()
+            self.maps.clear()
+
+
+def benchmark_shard_reads(index_path, source_dir, manifest, samples=5000, threads=1, repeat=1, seed=0):
+    """同じサンプルをランダムな順で、元のファイル (1 サンプルにつき 2 ファイル) とシャードから読み、読み込み速度を比べる"""
+    import random
+    from concurrent.futures import ThreadPoolExecutor
+
+    results = []
+    with ShardReader(index_path) as reader:
+        keys = reader.keys()
+        keys = random.Random(seed).sample(keys, min(samples, len(keys)))
+
+        def read_loose(key):
+            entry = manifest.pairs[key]
+            return len(_read_bytes(os.path.join(source_dir, entry["image"]))) + len(_read_bytes(os.path.join(source_dir, entry["label"])))
+
+        def read_shard(key):
+            image, label = reader.read_key(key)
+            return len(image) + len(label)
+
+        for run in range(1, repeat + 1):
+            for layout, read in (("loose", read_loose), ("shards", read_shard)):
+                started = time.perf_counter()
+                with ThreadPoolExecutor(max_workers=threads) as pool:
+                    total = sum(pool.map(read, keys, chunksize=64))
+                seconds = max(time.perf_counter() - started, 1e-9)
+                results.append({"run": run, "layout": layout, "samples": len(keys), "bytes": total, "seconds": round(seconds, 4),
+                                "samples_per_second": round(len(keys) / seconds, 1), "mb_per_second": round(total / seconds / 1e6, 2)})
+    return results
+
+
+def _letterbox_labels(data, scale_x, scale_y, offset_x, offset_y):
+    """YOLO のラベル (bytes) の正規化座標を x * scale_x + offset_x, y * scale_y + offset_y に変換する。解析できない行はそのまま残す"""
+    rows = []
+    for row in data.decode("utf-8-sig", errors="replace").splitlines():
+        tokens = row.split()
+        try:
+            values = [float(token) for token in tokens[1:]]
+        except ValueError:
+            values = None
+        # ボックス (4 値) とポリゴン (3 点以上) だけを変換する。列数の不正な行は検査 (check_label_bytes) に任せる
+        if values is None or not (len(values) == 4 or (len(values) >= 6 and len(values) % 2 == 0)):
+            rows.append(row)
+            continue
+        if len(values) == 4:
+            x, y, w, h = values
+            values = [x * scale_x + offset_x, y * scale_y + offset_y, w * scale_x, h * scale_y]
+        else:
+            values = [value * scale_x + offset_x if i % 2 == 0 else value * scale_y + offset_y for i, value in enumerate(values)]
+        rows.append(" ".join([tokens[0]] + [f"{value:.6f}" for value in values]))
+    return "".join(row + "\n" for row in rows).encode("utf-8")
+
+
+def _preprocess_pair(job):
+    """プロセスプールのワーカーで画像を縮小 (fit) またはレターボックス化し、ラベルと一緒に書き出す。失敗したらその理由を返す
+
+    ラベルは EXIF の回転を適用した後の画像に対する座標とみなし、画像も回転を適用してから書き出す。
+    """
+    import io
+    from PIL import Image, ImageOps
+
+    src_image, src_label, dst_image, dst_label, size, mode = job
+    try:
+        with open(src_image, "rb") as f:
+            data = f.read()
+        with open(src_label, "rb") as f:
+            label = f.read()
+        with Image.open(io.BytesIO(data)) as image:
+            # 目標は正方形なので、縮小率は EXIF の回転によらず長辺で決まる
+            scale = size / max(image.size)
+            if mode == "fit":
+                scale = min(scale, 1.0)
+            orientation = image.getexif().get(0x0112, 1)
+            if mode == "fit" and scale == 1.0 and orientation == 1:
+                output = data
+            else:
+                target = (max(1, round(image.size[0] * scale)), max(1, round(image.size[1] * scale)))
+                # JPEG は必要な大きさ以上を保つ範囲で、縮小した解像度で直接デコードさせる
+                image.draft("RGB", target)
+                if orientation in (5, 6, 7, 8):
+                    target = target[::-1]
+                resized = ImageOps.exif_transpose(image).convert("RGB")
+                if resized.size != target:
+                    resized = resized.resize(target, Image.BILINEAR)
+                if mode == "letterbox":
+                    pad_x, pad_y = (size - target[0]) // 2, (size - target[1]) // 2
+                    canvas = Image.new("RGB", (size, size), LETTERBOX_COLOR)
+                    canvas.paste(resized, (pad_x, pad_y))
+                    resized = canvas
+                    label = _letterbox_labels(label, target[0] / size, target[1] / size, pad_x / size, pad_y / size)
+                buffer = io.BytesIO()
+                if dst_image.lower().endswith(".png"):
+                    resized.save(buffer, "PNG")
+                else:
+                    resized.save(buffer, "JPEG", quality=PREPROCESS_JPEG_QUALITY)
+                output = buffer.getvalue()
+        # 画像を最後に置くので、画像があればラベルも揃っている
+        for path, content in ((dst_label, label), (dst_image, output)):
+            with open(path + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(path + ".tmp", path)
+    except Exception as e:
+        return f"{os.path.basename(src_image)}: {e}"
+    return None
+
+
+def preprocess_cache_paths(cache_dir, key, digest):
+    """前処理結果の (画像, ラベル) のパス。images/labels に分けて置くので、YOLO のラベル探索 (images -> labels の置換) がそのまま使える"""
+    return (os.path.join(cache_dir, "images", digest + os.path.splitext(key)[1].lower()),
+            os.path.join(cache_dir, "labels", digest + ".txt"))
+
+
+def _shard_source_paths(preprocess_cache, source_dir, manifest, key):
+    """シャードに詰める (画像, ラベル) のパス。前処理済みの画像があればそれを、無ければ元の画像とラベルを使う"""
+    cached = preprocess_cache_paths(preprocess_cache, key, manifest.pairs[key]["hash"])
+    if os.path.isfile(cached[0]):
+        return cached
+    return os.path.join(source_dir, manifest.pairs[key]["image"]), os.path.join(source_dir, manifest.pairs[key]["label"])
+
+
+def iter_json_array(path, chunk_chars=LS_EXPORT_CHUNK_CHARS):
+    """JSON 配列を先頭から 1 要素ずつ返す。メモリに載るのは読み込み中のチャンクと要素 1 個分だけなので、数 GB のファイルでも読める"""
+    decoder = json.JSONDecoder()
+    with open(path, "r", encoding="utf-8-sig") as f:
+        buffer, pos, eof, started = "", 0, False, False
+        while True:
+            while pos < len(buffer) and buffer[pos] in (" \t\r\n," if started else " \t\r\n"):
+                pos += 1
+            if pos >= len(buffer):
+                if eof:
+                    raise ValueError(f"JSON が途中で終わっています: {path}")
+                buffer, pos = f.read(chunk_chars), 0
+                eof = not buffer
+                continue
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"JSON の配列ではありません: {path}")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+                after = end
+                while after < len(buffer) and buffer[after] in " \t\r\n":
+                    after += 1
+            except json.JSONDecodeError:
+                after = len(buffer)
+            # 要素の後ろに "," か "]" が見えるまでは、チャンクの境目で切れている (数値は途中でも読めてしまう) とみなして続きを読む
+            if after >= len(buffer) or buffer[after] not in ",]":
+                if eof:
+                    raise ValueError(f"JSON を解析できません: {path}")
+                more = f.read(chunk_chars)
+                eof = not more
+                buffer, pos = buffer[pos:] + more, 0
+                continue
+            yield item
+            pos = end
+            if pos >= chunk_chars:
+                buffer, pos = buffer[pos:], 0
+
+
+def _ls_label_name(value):
+    for key in LS_LABEL_KEYS:
+        names = value.get(key)
+        if isinstance(names, list) and names:
+            return str(names[0])
+    return None
+
+
+def _ls_region_to_yolo(value, width=None, height=None):
+    """Label Studio の領域 (座標は画像に対する %) を YOLO の正規化座標の列にする。矩形は [xc, yc, w, h]、ポリゴンは頂点の列"""
+    def clip(v):
+        return min(1.0, max(0.0, v))
+
+    if "points" in value:
+        coords = []
+        for point in value["points"]:
+            coords += [clip(float(point[0]) / 100), clip(float(point[1]) / 100)]
+        return coords if len(coords) >= 6 else None
+    if not all(key in value for key in ("x", "y", "width", "height")):
+        return None
+    x, y, w, h = (float(value[key]) / 100 for key in ("x", "y", "width", "height"))
+    rotation = float(value.get("rotation") or 0)
+    if rotation % 360:
+        import math
+
+        # 回転は左上の頂点を中心に行われる。縦横比を保つため、元画像の大きさが分かればピクセル単位で回す
+        sx, sy = float(width or 1), float(height or 1)
+        c, s = math.cos(math.radians(rotation)), math.sin(math.radians(rotation))
+        xs, ys = [], []
+        for dx, dy in ((0, 0), (w * sx, 0), (w * sx, h * sy), (0, h * sy)):
+            xs.append((x * sx + dx * c - dy * s) / sx)
+            ys.append((y * sy + dx * s + dy * c) / sy)
+        x, y, w, h = min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys)
+    x0, y0, x1, y1 = clip(x), clip(y), clip(x + w), clip(y + h)
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return [(x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0]
+
+
+def _ls_image_ref(data):
+    image = data.get("image")
+    if isinstance(image, str) and image:
+        return image
+    for value in data.values():
+        if isinstance(value, str) and os.path.splitext(value.split("?", 1)[0])[1].lower() in IMAGE_EXTS:
+            return value
+    return None
+
+
+def _ls_task_regions(task, use_predictions=False):
+    """タスク 1 件 (JSON / JSON-MIN のどちらでも) から (画像の参照, 領域の列) を取り出す。未アノテーションなら領域は None
+
+    JSON では取り消されていない最新のアノテーションを使い、無ければ use_predictions のときだけ予測を使う。
+    """
+    if isinstance(task.get("data"), dict):
+        image = _ls_image_ref(task["data"])
+        annotations = [a for a in task.get("annotations") or () if not a.get("was_cancelled")]
+        if not annotations and use_predictions:
+            annotations = list(task.get("predictions") or ())
+        if not annotations:
+            return image, None
+        latest = max(annotations, key=lambda a: (str(a.get("updated_at") or ""), a.get("id") or 0))
+        return image, [(r.get("value") or {}, r.get("original_width"), r.get("original_height")) for r in latest.get("result") or ()
+                       if isinstance(r, dict)]
+    # JSON-MIN: from_name ごとのキーに領域の配列が入る。annotation_id があれば領域 0 件でもアノテーション済み
+    image = _ls_image_ref(task)
+    regions = [] if "annotation_id" in task or "annotator" in task else None
+    for value in task.values():
+        if isinstance(value, list) and value and all(isinstance(item, dict) for item in value) \
+                and any("x" in item or "points" in item for item in value):
+            regions = (regions or []) + [(item, item.get("original_width"), item.get("original_height")) for item in value]
+    return image, regions
+
+
+def _ls_image_source(ref, media_roots):
+    """画像の参照 (/data/upload/..., /data/local-files/?d=..., URL, パス) から、ファイル名と探すローカルパスの候補を返す"""
+    from urllib.parse import parse_qs, unquote, urlsplit
+
+    candidates = []
+    if "://" in ref or ref.startswith("/data/"):
+        parts = urlsplit(ref)
+        if "local-files" in parts.path:
+            rel = parse_qs(parts.query).get("d", [""])[0]
+        else:
+            rel = unquote(parts.path)
+            if "/data/" in rel:
+                rel = rel.split("/data/", 1)[1]
+    elif os.path.isabs(ref) or (len(ref) > 2 and ref[1] == ":" and ref[2] in "\\/"):
+        candidates.append(ref)
+        rel = ref.replace("\\", "/").rsplit("/", 1)[-1]
+    else:
+        rel = ref
+    rel = rel.replace("\\", "/").lstrip("/")
+    name = rel.rsplit("/", 1)[-1]
+    # アップロードしたファイルは "<8 桁の 16 進>-<元の名前>" で保存される
+    stripped = name[9:] if len(name) > 9 and name[8] == "-" and all(ch in "0123456789abcdef" for ch in name[:8]) else None
+    for root in media_roots:
+        candidates += [os.path.join(root, rel), os.path.join(root, "media", rel)]
+        if rel != name:
+            candidates.append(os.path.join(root, name))
+        if stripped:
+            candidates.append(os.path.join(root, stripped))
+    return name, candidates
+
+
+def _ls_default_media_roots(export_path):
+    """書き出した JSON のフォルダ、LOCAL_FILES_DOCUMENT_ROOT、Label Studio の既定のデータフォルダ"""
+    roots = [os.path.dirname(os.path.abspath(export_path))]
+    if os.environ.get("LOCAL_FILES_DOCUMENT_ROOT"):
+        roots.append(os.environ["LOCAL_FILES_DOCUMENT_ROOT"])
+    if os.environ.get("LABEL_STUDIO_BASE_DATA_DIR"):
+        roots.append(os.environ["LABEL_STUDIO_BASE_DATA_DIR"])
+    elif os.name == "nt":
+        roots.append(os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "label-studio", "label-studio"))
+    else:
+        roots.append(os.path.join(os.path.expanduser("~"), ".local", "share", "label-studio"))
+    return roots
+
+
+def _ls_write_pair(cloner, candidates, image_dst, label_path, text):
+    """画像を探して配置し、ラベルを書き出す。同じ画像・同じ内容がすでにあれば書き直さない (分割側の差分判定を崩さない)"""
+    src = next((path for path in candidates if os.path.isfile(path)), None)
+    if src is None:
+        raise FileNotFoundError("画像が見つかりません")
+    st = os.stat(src)
+    try:
+        dst = os.stat(image_dst)
+        placed = dst.st_size == st.st_size and (os.path.samefile(src, image_dst) or int(dst.st_mtime) == int(st.st_mtime))
+    except OSError:
+        placed = False
+    if not placed:
+        cloner.clone(src, image_dst, st.st_size)
+    data = text.encode("utf-8")
+    try:
+        with open(label_path, "rb") as f:
+            if f.read() == data:
+                return
+    except OSError:
+        pass
+    with open(label_path + ".tmp", "wb") as f:
+        f.write(data)
+    os.replace(label_path + ".tmp", label_path)
+
+
+def import_label_studio_export(export_path, dataset_dir, media_roots=None, classes_path=None, clone_strategy="auto", io_workers=None,
+                               use_predictions=False, log=print):
+    """Label Studio の JSON / JSON-MIN 書き出しを読みながら、dataset_dir に images/labels/classes.txt の YOLO データセットを作る
+
+    タスクは 1 件ずつ読み、画像の配置とラベルの書き出しはスレッドプールで並列に行う (未完了のジョブは io_workers の数倍まで)。
+    クラス ID は classes_path (無ければ dataset_dir の既存の classes.txt) の順に振り、載っていないクラスは出現順に追加する。
+    dataset_dir をこの処理で作った場合は、書き出しから消えたタスクの画像とラベルも削除する。
+    """
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    started = time.perf_counter()
+    images_dir = os.path.join(dataset_dir, "images")
+    labels_dir = os.path.join(dataset_dir, "labels")
+    marker_path = os.path.join(dataset_dir, LS_IMPORT_MARKER)
+    owned = not os.path.exists(images_dir) or os.path.isfile(marker_path)
+    os.makedirs(images_dir, exist_ok=True)
+    os.makedirs(labels_dir, exist_ok=True)
+    if media_roots is None:
+        media_roots = _ls_default_media_roots(export_path)
+
+    classes = []
+    for path in (classes_path, os.path.join(dataset_dir, "classes.txt")):
+        if path and os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                classes = [line.strip() for line in f if line.strip()]
+            break
+    class_ids = {name: cls_id for cls_id, name in enumerate(classes)}
+
+    counts = dict.fromkeys(("tasks", "annotated", "unlabeled", "regions", "ignored_regions", "missing_images", "unsupported_images"), 0)
+    # 出力名の重複を避けるため、書き出した名前だけはタスク数ぶん保持する
+    names = set()
+    missing = []
+    cloner = FileCloner(clone_strategy)
+    workers = max(1, io_workers or DEFAULT_IO_WORKERS)
+    pending = {}
+
+    def collect(futures):
+        for future in futures:
+            ref = pending.pop(future)
+            try:
+                future.result()
+            except OSError as e:
+                counts["missing_images"] += 1
+                if len(missing) < 20:
+                    missing.append(f"{ref}: {e}")
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for task in iter_json_array(export_path):
+            counts["tasks"] += 1
+            if not isinstance(task, dict):
+                continue
+            ref, regions = _ls_task_regions(task, use_predictions)
+            if regions is None or not ref:
+                counts["unlabeled"] += 1
+                continue
+            name, candidates = _ls_image_source(ref, media_roots)
+            base, ext = os.path.splitext(name)
+            if ext.lower() not in IMAGE_EXTS:
+                counts["unsupported_images"] += 1
+                continue
+            if base in names:
+                # 同名の画像はタスク ID を前に付け、それでも重なる場合は連番を足して別の名前にする
+                renamed = f"{task.get('id', counts['tasks'])}_{base}"
+                suffix = 2
+                while renamed in names:
+                    renamed = f"{task.get('id', counts['tasks'])}_{base}_{suffix}"
+                    suffix += 1
+                base = renamed
+            names.add(base)
+
+            rows = []
+            for value, width, height in regions:
+                label = _ls_label_name(value)
+                coords = _ls_region_to_yolo(value, width, height) if label is not None else None
+                if coords is None:
+                    counts["ignored_regions"] += 1
+                    continue
+                if label not in class_ids:
+                    class_ids[label] = len(classes)
+                    classes.append(label)
+                rows.append(" ".join([str(class_ids[label])] + [f"{v:.6f}" for v in coords]))
+            counts["annotated"] += 1
+            counts["regions"] += len(rows)
+            text = "".join(row + "\n" for row in rows)
+            future = pool.submit(_ls_write_pair, cloner, candidates,
+                                 os.path.join(images_dir, base + ext), os.path.join(labels_dir, base + ".txt"), text)
+            pending[future] = ref
+            if len(pending) >= workers * 4:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(pending))
+
+    with open(os.path.join(dataset_dir, "classes.txt.tmp"), "w", encoding="utf-8") as f:
+        f.writelines(f"{name}\n" for name in classes)
+    os.replace(os.path.join(dataset_dir, "classes.txt.tmp"), os.path.join(dataset_dir, "classes.txt"))
+
+    removed = 0
+    if owned:
+        for directory in (images_dir, labels_dir):
+            with os.scandir(directory) as it:
+                stale = [entry.path for entry in it if os.path.splitext(entry.name)[0] not in names]
+            for path in stale:
+                try:
+                    os.remove(path)
+                    removed += 1
+                except OSError:
+                    pass
+
+    info = dict(counts, classes=len(classes), removed=removed, bytes_written=cloner.bytes_written, dataset_dir=dataset_dir,
+                seconds=round(time.perf_counter() - started, 3))
+    if owned:
+        with open(marker_path, "w", encoding="utf-8") as f:
+            json.dump(dict(info, export=os.path.abspath(export_path)), f, ensure_ascii=False, indent=2)
+    log(f"Label Studio の書き出しを変換しました: タスク {counts['tasks']}件 / アノテーション済み {counts['annotated']}件 / "
+        f"領域 {counts['regions']}件 / クラス {len(classes)}件 ({info['seconds']:.2f}秒, {cloner.summary()})")
+    if counts["unlabeled"]:
+        log(f"未アノテーションのタスク {counts['unlabeled']}件は除外しました。")
+    if counts["ignored_regions"]:
+        log(f"⚠ 矩形・ポリゴン以外、またはラベルのない領域 {counts['ignored_regions']}件を無視しました。")
+    if counts["unsupported_images"]:
+        log(f"⚠ 対応していない形式 ({', '.join(IMAGE_EXTS)} 以外) の画像 {counts['unsupported_images']}件を除外しました。")
+    if counts["missing_images"]:
+        log(f"⚠ 画像が見つからないタスクが {counts['missing_images']}件あります (探したフォルダ: {', '.join(media_roots)})")
+        for line in missing:
+            log(f"  {line}")
+    return info
+
+
+def _remap_label_text(data, remap, limit=None):
+    """YOLO ラベルのクラス ID を remap (元の ID → 統合後の ID) で振り直し、(テキスト, 除外した行数) を返す
+
+    remap が None のデータセット (classes.txt なし) は ID をそのまま使い、limit があればその範囲外の行を除外する。
+    """
+    rows = []
+    dropped = 0
+    for line in data.decode("utf-8", "replace").splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        try:
+            value = float(parts[0])
+        except ValueError:
+            value = -1.0
+        cls_id = int(value) if value.is_integer() else -1
+        if remap is not None:
+            cls_id = remap[cls_id] if 0 <= cls_id < len(remap) else -1
+        elif limit is not None and cls_id >= limit:
+            cls_id = -1
+        if cls_id < 0:
+            dropped += 1
+            continue
+        rows.append(" ".join([str(cls_id)] + parts[1:]) + "\n")
+    return "".join(rows), dropped
+
+
+def _label_rows_key(text):
+    # 数値の書式 (0.5 と 0.500000 など) と行の順序の違いは同じラベルとみなす
+    rows = []
+    for line in text.splitlines():
+        try:
+            rows.append(tuple(round(float(token), 4) for token in line.split()))
+        except ValueError:
+            rows.append(tuple(line.split()))
+    return sorted(rows)
+
+
+def _merge_pair(cloner, image_path, labels, limit, image_dst, label_dst):
+    """画像を配置し、クラス ID を振り直したラベルを書き出して (除外した行数, ラベルが食い違う重複の数) を返す
+
+    labels は内容が同じ画像の (ラベルのパス, remap) の列で、先頭のラベルを採用し、残りとは中身を比べるだけ。
+    """
+    with open(labels[0][0], "rb") as f:
+        text, dropped = _remap_label_text(f.read(), labels[0][1], limit)
+    _ls_write_pair(cloner, [image_path], image_dst, label_dst, text)
+    conflicts = 0
+    if len(labels) > 1:
+        key = _label_rows_key(text)
+        for label_path, remap in labels[1:]:
+            try:
+                with open(label_path, "rb") as f:
+                    other = _remap_label_text(f.read(), remap, limit)[0]
+            except OSError:
+                continue
+            conflicts += _label_rows_key(other) != key
+    return dropped, conflicts
+
+
+def merge_yolo_datasets(sources, dataset_dir, classes_path=None, clone_strategy="auto", io_workers=None, log=print):
+    """複数の YOLO データセットを、クラスを統合した 1 つのデータセット (dataset_dir の images/labels/classes.txt) にまとめる
+
+    クラスは classes_path (あれば) と各データセットの classes.txt の名前を指定順に並べた和集合とし、ラベルのクラス ID を
+    スレッドプールで並列に振り直す。内容が同じ画像は先に指定したデータセットの 1 枚だけを残す (内容ハッシュはサイズと更新時刻でキャッシュ)。
+    dataset_dir をこの処理で作った場合は、統合元から消えたペアの画像とラベルも削除する。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    started = time.perf_counter()
+    images_dir = os.path.join(dataset_dir, "images")
+    labels_dir = os.path.join(dataset_dir, "labels")
+    marker_path = os.path.join(dataset_dir, MERGE_MARKER)
+    owned = not os.path.exists(images_dir) or os.path.isfile(marker_path)
+
+    classes = []
+    if classes_path:
+        with open(classes_path, "r", encoding="utf-8") as f:
+            classes = [line.strip() for line in f if line.strip()]
+    class_ids = {name: cls_id for cls_id, name in enumerate(classes)}
+    datasets = []
+    for source in sources:
+        index = DatasetIndex(source)
+        if not index.images_dir or not index.labels_dir:
+            log(f"⚠ 'images' または 'labels' フォルダが見つからないため、統合から外します: {source}")
+            continue
+        names = index_classes(index)
+        remap = None
+        if names is None:
+            log(f"⚠ classes.txt が見つからないため、クラス ID をそのまま使います: {source}")
+        else:
+            remap = []
+            for name in names:
+                if name not in class_ids:
+                    class_ids[name] = len(classes)
+                    classes.append(name)
+                remap.append(class_ids[name])
+            moved = sum(1 for old, new in enumerate(remap) if old != new)
+            if moved:
+                log(f"{os.path.basename(os.path.abspath(source))}: クラス {moved}件の ID を振り直します。")
+        datasets.append((source, index, remap))
+    if not datasets:
+        raise ValueError("統合できるデータセットがありません。")
+    limit = len(classes) or None
+    os.makedirs(images_dir, exist_ok=True)
+    os.makedirs(labels_dir, exist_ok=True)
+
+    cache = ValidationCache.load(os.path.join(dataset_dir, MERGE_HASH_CACHE_NAME))
+    hashes, hashed = content_hashes([pair.image for _, index, _ in datasets for pair in index.pairs], cache, io_workers)
+    try:
+        cache.save()
+    except OSError as e:
+        log(f"⚠ 内容ハッシュのキャッシュを保存できませんでした: {e}")
+
+    # 内容が同じ画像は最初に現れたものにまとめ、出力名が重なる場合だけデータセット名を前に付ける
+    groups = {}
+    jobs = []
+    taken = set()
+    per_source = []
+    unreadable = 0
+    for source, index, remap in datasets:
+        prefix = os.path.basename(os.path.abspath(source))
+        stats = {"source": source, "pairs": len(index.pairs), "duplicates": 0, "unpaired_images": len(index.unpaired_images),
+                 "classes": None if remap is None else len(remap)}
+        per_source.append(stats)
+        for pair in index.pairs:
+            digest = hashes[pair.image.path]
+            if digest is None:
+                unreadable += 1
+                continue
+            if digest in groups:
+                groups[digest][2].append((pair.label.path, remap))
+                stats["duplicates"] += 1
+                continue
+            base = pair.base
+            n = 1
+            while base.lower() in taken:
+                base = f"{prefix}_{pair.base}" if n == 1 else f"{prefix}_{pair.base}_{n}"
+                n += 1
+            taken.add(base.lower())
+            groups[digest] = (pair.image.path, base + pair.ext, [(pair.label.path, remap)])
+            jobs.append(groups[digest])
+
+    dropped = conflicts = 0
+    failed = []
+    cloner = FileCloner(clone_strategy)
+
+    def merge(batch):
+        outcomes = []
+        for image_path, name, labels in batch:
+            try:
+                outcomes.append(_merge_pair(cloner, image_path, labels, limit, os.path.join(images_dir, name),
+                                            os.path.join(labels_dir, os.path.splitext(name)[0] + ".txt")))
+            except OSError as e:
+                outcomes.append(e)
+        return outcomes
+
+    batches = [jobs[start:start + FILE_JOB_BATCH] for start in range(0, len(jobs), FILE_JOB_BATCH)]
+    with ThreadPoolExecutor(max_workers=max(1, io_workers or DEFAULT_IO_WORKERS)) as pool:
+        for batch, outcomes in zip(batches, pool.map(merge, batches)):
+            for job, outcome in zip(batch, outcomes):
+                if isinstance(outcome, OSError):
+                    failed.append(f"{job[0]}: {outcome}")
+                    continue
+                dropped += outcome[0]
+                conflicts += outcome[1]
+
+    classes_file = os.path.join(dataset_dir, "classes.txt")
+    if classes:
+        with open(classes_file + ".tmp", "w", encoding="utf-8") as f:
+            f.writelines(f"{name}\n" for name in classes)
+        os.replace(classes_file + ".tmp", classes_file)
+
+    removed = 0
+    if owned:
+        names = {os.path.splitext(job[1])[0] for job in jobs}
+        stale = [classes_file] if not classes and os.path.isfile(classes_file) else []
+        for directory in (images_dir, labels_dir):
+            with os.scandir(directory) as it:
+                stale.extend(entry.path for entry in it if os.path.splitext(entry.name)[0] not in names)
+        for path in stale:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+
+    duplicates = sum(stats["duplicates"] for stats in per_source)
+    info = dict(sources=len(datasets), pairs=sum(stats["pairs"] for stats in per_source), merged=len(jobs) - len(failed),
+                duplicates=duplicates, label_conflicts=conflicts, dropped_rows=dropped, unreadable_images=unreadable, failed=len(failed),
+                classes=len(classes), hashed=hashed, removed=removed, bytes_written=cloner.bytes_written, dataset_dir=dataset_dir,
+                seconds=round(time.perf_counter() - started, 3), per_source=per_source)
+    if owned:
+        with open(marker_path, "w", encoding="utf-8") as f:
+            json.dump(dict(info, class_names=classes), f, ensure_ascii=False, indent=2)
+    log(f"データセットを統合しました: {len(datasets)}件 / ペア {info['merged']}件 / 重複 {duplicates}件 / クラス {len(classes)}件 "
+        f"({info['seconds']:.2f}秒, ハッシュ計算 {hashed}件, {cloner.summary()})")
+    if conflicts:
+        log(f"⚠ 内容が同じ画像でラベルが食い違うものが {conflicts}件あります (先に指定したデータセットのラベルを使いました)。")
+    if dropped:
+        log(f"⚠ classes.txt にないクラス ID の行 {dropped}件を除外しました。")
+    if unreadable or failed:
+        log(f"⚠ 読み込めない・配置できないペア {unreadable + len(failed)}件を除外しました。")
+        for line in failed[:20]:
+            log(f"  {line}")
+    return info
+
+
+def app_dir():
+    """スクリプトまたは EXE のあるフォルダ"""
+    if getattr(sys, "frozen", False):
+        # PyInstallerでEXE化されている場合、EXEのディレクトリを使用
+        return os.path.dirname(os.path.abspath(sys.executable))
+    return os.path.dirname(os.path.abspath(__file__))
+
+
+def env_executables(venv_dir):
+    """conda_env 内の python と label-studio のパス"""
+    python_exe = os.path.join(venv_dir, "python.exe" if os.name == "nt" else "bin/python")
+    label_studio_exe = os.path.join(venv_dir, "Scripts" if os.name == "nt" else "bin", "label-studio" + (".exe" if os.name == "nt" else ""))
+    return python_exe, label_studio_exe
+
+
+def _normalize_package_name(name):
+    return name.lower().replace("-", "_").replace(".", "_")
+
+
+class EnvironmentLock:
+    """conda_env の構築が成功したときに書き出すフィンガープリント
+
+    Python のバージョン、conda-meta と site-packages から求めたパッケージ一覧、その一覧のダイジェストを持つ。
+    起動時はサブプロセスを使わずディレクトリの一覧だけで比較し、古くなった手順だけを実行する。
+    """
+
+    VERSION = 1
+
+    def __init__(self, venv_dir):
+        self.venv_dir = venv_dir
+        self.path = os.path.join(venv_dir, ENV_LOCK_NAME)
+        self.needs_refresh = False
+
+    def _site_packages(self):
+        candidates = [os.path.join(self.venv_dir, "Lib", "site-packages")]
+        candidates += sorted(glob.glob(os.path.join(self.venv_dir, "lib", "python*", "site-packages")))
+        for path in candidates:
+            if os.path.isdir(path):
+                return path
+        return None
+
+    @staticmethod
+    def _listdir(path):
+        try:
+            return sorted(os.listdir(path)) if path else []
+        except OSError:
+            return []
+
+    def fingerprint(self):
+        import hashlib
+
+        conda_meta = [name for name in self._listdir(os.path.join(self.venv_dir, "conda-meta")) if name.endswith(".json")]
+        dist_infos = [name for name in self._listdir(self._site_packages()) if name.endswith(".dist-info")]
+        conda_packages = {}
+        for name in conda_meta:
+            parts = name[:-len(".json")].rsplit("-", 2)
+            if len(parts) == 3:
+                conda_packages[_normalize_package_name(parts[0])] = parts[1]
+        pip_packages = {}
+        for name in dist_infos:
+            package, _, version = name[:-len(".dist-info")].partition("-")
+            pip_packages[_normalize_package_name(package)] = version
+        digest = hashlib.blake2b("\n".join(conda_meta + [""] + dist_infos).encode("utf-8"), digest_size=16).hexdigest()
+        return {"python": conda_packages.get("python"), "conda_packages": conda_packages, "pip_packages": pip_packages, "digest": digest}
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data if data.get("version") == self.VERSION else None
+
+    def plan(self):
+        """実行が必要な構築手順を返す。空なら構築済みでそのまま起動できる"""
+        python_exe, label_studio_exe = env_executables(self.venv_dir)
+        if not os.path.isfile(python_exe):
+            return list(BOOTSTRAP_STEPS)
+        lock = self.load()
+        current = self.fingerprint()
+        # 途中で失敗したときの記録 (complete が False) は、フィンガープリントが同じでも構築済みとはみなさない
+        if (lock and lock.get("spec") == ENV_SPEC and lock.get("complete", True) and lock.get("digest") == current["digest"]
+                and os.path.isfile(label_studio_exe)):
+            return []
+        if current["python"] != ENV_SPEC["python"]:
+            return list(BOOTSTRAP_STEPS)
+
+        steps = []
+        missing_deps = [dep for dep in ENV_SPEC["conda_dependencies"] if _normalize_package_name(dep) not in current["conda_packages"]]
+        needs_label_studio = not os.path.isfile(label_studio_exe) or any(
+            _normalize_package_name(package) not in current["pip_packages"] for package in ENV_SPEC["pip_packages"])
+        # pip のアップグレードはパッケージを入れ直すときだけ、まだ一度も実行していなければ行う
+        if needs_label_studio and not (lock and "pip_upgrade" in lock.get("steps", [])):
+            steps.append("pip_upgrade")
+        if missing_deps:
+            steps.append("conda_deps")
+        if needs_label_studio:
+            steps.append("label_studio")
+        self.needs_refresh = not steps
+        return steps
+
+    def write(self, steps_done, provision=None, complete=True):
+        previous = self.load() or {}
+        steps = set(steps_done)
+        if previous.get("spec") == ENV_SPEC and "create_env" not in steps:
+            steps |= set(previous.get("steps", []))
+        data = {"version": self.VERSION, "spec": ENV_SPEC, "steps": sorted(steps), "complete": complete, "written_at": time.time(),
+                "provision": provision or previous.get("provision")}
+        data.update(self.fingerprint())
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.path)
+        self.needs_refresh = False
+
+
+class OfflineEnvironment:
+    """offline_env フォルダにある conda_env の成果物
+
+    kind は "pack" (conda-pack のアーカイブ)、"channel" (ローカルチャンネルと wheelhouse)、None (成果物なし) のいずれか。
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.pack_path = os.path.join(root, OFFLINE_PACK_NAME)
+        self.channel_dir = os.path.join(root, OFFLINE_CHANNEL_DIR)
+        self.wheelhouse_dir = os.path.join(root, OFFLINE_WHEELHOUSE_DIR)
+        if os.path.isfile(self.pack_path):
+            self.kind = "pack"
+        elif glob.glob(os.path.join(self.channel_dir, "*", "repodata.json")):
+            self.kind = "channel"
+        else:
+            self.kind = None
+
+    def conda_channel_args(self):
+        from pathlib import Path
+
+        if self.kind != "channel":
+            return ["-c", "conda-forge"]
+        return ["--offline", "--override-channels", "-c", Path(self.channel_dir).resolve().as_uri()]
+
+    def pip_index_args(self):
+        if self.kind != "channel":
+            return []
+        return ["--no-index", "--find-links", self.wheelhouse_dir]
+
+    def restore_pack(self, venv_dir, log):
+        """アーカイブを展開して conda-unpack でプレフィックスを書き換え、conda_env と置き換える"""
+        import tarfile
+
+        staging_dir = venv_dir + ".restoring"
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        log(f"{self.pack_path} を展開しています...")
+        with tarfile.open(self.pack_path, "r:*") as archive:
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(staging_dir, filter="data")
+            else:
+                archive.extractall(staging_dir)
+        if os.name == "nt":
+            unpack_cmd = [os.path.join(staging_dir, "Scripts", "conda-unpack.exe")]
+        else:
+            unpack_cmd = [os.path.join(staging_dir, "bin", "python"), os.path.join(staging_dir, "bin", "conda-unpack")]
+        if os.path.isfile(unpack_cmd[-1]):
+            subprocess.run(unpack_cmd, check=True, capture_output=True, text=True, encoding="utf-8")
+        else:
+            log("conda-unpack が見つからないため、プレフィックスの書き換えを省略します。")
+        if os.path.exists(venv_dir):
+            shutil.rmtree(venv_dir)
+        os.replace(staging_dir, venv_dir)
+
+
+def bootstrap_command(step, venv_dir, conda_bin="conda", offline=None):
+    """構築手順 step を実行するコマンドライン。offline が channel ならネットワークを使わない"""
+    python_exe, _ = env_executables(venv_dir)
+    channel_args = offline.conda_channel_args() if offline else ["-c", "conda-forge"]
+    index_args = offline.pip_index_args() if offline else []
+    if step == "create_env":
+        return [conda_bin, "create", "-p", venv_dir, f"python={ENV_SPEC['python']}", "-y"] + channel_args
+    if step == "pip_upgrade":
+        return [python_exe, "-m", "pip", "install", "--upgrade", "pip"] + index_args
+    if step == "conda_deps":
+        return [conda_bin, "install", "-p", venv_dir, "-y"] + channel_args + ENV_SPEC["conda_dependencies"]
+    if step == "label_studio":
+        return [python_exe, "-m", "pip", "install"] + index_args + ENV_SPEC["pip_packages"]
+    raise ValueError(f"不明な構築手順です: {step}")
+
+
+class BootstrapPipeline:
+    """構築手順を依存関係の順に、独立した手順は並行して実行する
+
+    サブプロセスの出力は 1 行ずつ log に渡し、手順ごとの所要時間を timings に記録する。
+    失敗した場合は新しい手順を開始せず、実行中の手順の終了を待ってから CalledProcessError を送出する (failed_step に手順名)。
+    """
+
+    TAIL_LINES = 200
+
+    def __init__(self, venv_dir, steps, conda_bin="conda", offline=None, log=print, metrics=None):
+        self.venv_dir = venv_dir
+        self.steps = [step for step in BOOTSTRAP_STEPS if step in steps]
+        self.conda_bin = conda_bin
+        self.offline = offline
+        self.log = log
+        self.metrics = metrics
+        self.timings = {}
+        self.done = []
+        self.failed_step = None
+
+    def _run_step(self, step):
+        if step == "create_env" and os.path.exists(self.venv_dir):
+            shutil.rmtree(self.venv_dir)
+        cmd = bootstrap_command(step, self.venv_dir, self.conda_bin, self.offline)
+        env = os.environ.copy()
+        env["PYTHONUNBUFFERED"] = "1"
+        creationflags = subprocess.CREATE_NO_WINDOW if os.name == "nt" else 0
+        tail = deque(maxlen=self.TAIL_LINES)
+        started = time.perf_counter()
+        self.log(f"[{step}] {BOOTSTRAP_LABELS[step]}を開始します...")
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8",
+                                   errors="replace", bufsize=1, env=env, creationflags=creationflags)
+        with process.stdout:
+            for line in process.stdout:
+                line = line.rstrip()
+                if line:
+                    tail.append(line)
+                    self.log(f"[{step}] {line}")
+        returncode = process.wait()
+        self.timings[step] = round(time.perf_counter() - started, 3)
+        if self.metrics:
+            self.metrics.add_span(step, time.perf_counter() - started, kind="subprocess", returncode=returncode)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, cmd, output="\n".join(tail))
+        self.log(f"[{step}] {BOOTSTRAP_LABELS[step]}が完了しました ({self.timings[step]:.1f} 秒)")
+
+    def run(self):
+        from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+        pending = list(self.steps)
+        running = {}
+        error = None
+        with ThreadPoolExecutor(max_workers=len(BOOTSTRAP_STEPS)) as pool:
+            while pending or running:
+                if error is None:
+                    for step in list(pending):
+                        waiting = [dep for dep in BOOTSTRAP_DEPENDENCIES[step] if dep in self.steps and dep not in self.done]
+                        if not waiting:
+                            pending.remove(step)
+                            running[pool.submit(self._run_step, step)] = step
+                else:
+                    pending.clear()
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    step = running.pop(future)
+                    if future.exception() is None:
+                        self.done.append(step)
+                    elif error is None:
+                        error = future.exception()
+                        self.failed_step = step
+        if error is not None:
+            raise error
+        return self.timings
+
+
+def _export_local_channel(venv_dir, channel_dir, log):
+    """conda-meta に記録されたパッケージをキャッシュからコピーし、repodata.json を書き出す"""
+    repodata = {}
+    missing = []
+    for meta_path in sorted(glob.glob(os.path.join(venv_dir, "conda-meta", "*.json"))):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        tarball = meta.get("package_tarball_full_path") or ""
+        if not tarball or not os.path.isfile(tarball):
+            # .conda / .tar.bz2 のどちらでキャッシュされているかは環境によって異なる
+            tarball = next((tarball + ext for ext in (".conda", ".tar.bz2") if os.path.isfile(tarball + ext)), "")
+        if not tarball:
+            missing.append(meta.get("name") or os.path.basename(meta_path))
+            continue
+        subdir = meta.get("subdir") or "noarch"
+        os.makedirs(os.path.join(channel_dir, subdir), exist_ok=True)
+        filename = os.path.basename(tarball)
+        shutil.copy2(tarball, os.path.join(channel_dir, subdir, filename))
+        section = "packages.conda" if filename.endswith(".conda") else "packages"
+        entry = {field: meta[field] for field in _REPODATA_FIELDS if field in meta}
+        repodata.setdefault(subdir, {"packages": {}, "packages.conda": {}})[section][filename] = entry
+    if missing:
+        raise RuntimeError(f"パッケージキャッシュに見つからないパッケージがあります: {', '.join(missing)}")
+    # conda は noarch の repodata.json も必ず参照する
+    repodata.setdefault("noarch", {"packages": {}, "packages.conda": {}})
+    for subdir, data in repodata.items():
+        os.makedirs(os.path.join(channel_dir, subdir), exist_ok=True)
+        data["info"] = {"subdir": subdir}
+        with open(os.path.join(channel_dir, subdir, "repodata.json"), "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=1)
+    log(f"ローカルチャンネルに {sum(len(d['packages']) + len(d['packages.conda']) for d in repodata.values())} 件のパッケージを書き出しました。")
+
+
+def export_offline_environment(venv_dir, output_dir, fmt="pack", conda_bin="conda", log=print):
+    """構築済みの conda_env を別の端末でネットワークなしに復元できる形で output_dir に書き出す"""
+    import platform
+
+    python_exe, _ = env_executables(venv_dir)
+    if not os.path.isfile(python_exe):
+        raise FileNotFoundError(f"conda_env が見つかりません: {venv_dir}")
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    if fmt == "pack":
+        pack_path = os.path.join(output_dir, OFFLINE_PACK_NAME)
+        log(f"conda-pack で {pack_path} を作成しています...")
+        try:
+            subprocess.run([conda_bin, "pack", "-p", venv_dir, "-o", pack_path, "--force"],
+                           check=True, capture_output=True, text=True, encoding="utf-8")
+        except subprocess.CalledProcessError as e:
+            raise RuntimeError(f"conda pack に失敗しました。conda-pack がインストールされているか確認してください "
+                               f"(conda install -c conda-forge conda-pack)。\n{e.stderr}") from e
+    elif fmt == "channel":
+        channel_dir = os.path.join(output_dir, OFFLINE_CHANNEL_DIR)
+        wheelhouse_dir = os.path.join(output_dir, OFFLINE_WHEELHOUSE_DIR)
+        _export_local_channel(venv_dir, channel_dir, log)
+        # 環境に入っているバージョンに固定して wheel を集める
+        pip_packages = EnvironmentLock(venv_dir).fingerprint()["pip_packages"]
+        requirements = ["pip"] + [
+            f"{package}=={pip_packages[_normalize_package_name(package)]}" if pip_packages.get(_normalize_package_name(package)) else package
+            for package in ENV_SPEC["pip_packages"]]
+        log(f"wheelhouse に {', '.join(requirements)} をダウンロードしています...")
+        subprocess.run([python_exe, "-m", "pip", "download", "-d", wheelhouse_dir] + requirements,
+                       check=True, capture_output=True, text=True, encoding="utf-8")
+    else:
+        raise ValueError(f"不明な形式です: {fmt}")
+
+    manifest = {"format": fmt, "spec": ENV_SPEC, "platform": sys.platform, "machine": platform.machine(), "created_at": time.time()}
+    with open(os.path.join(output_dir, OFFLINE_MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    seconds = time.perf_counter() - started
+    log(f"オフライン用の環境を書き出しました ({fmt}, {seconds:.1f} 秒): {output_dir}")
+    return seconds
+
+
+def provision_environment(venv_dir, offline, conda_bin="conda", log=print, metrics=None):
+    """conda_env を用意し、ロックファイルに所要時間を記録する。GUI の起動と env-provision の両方で使う
+
+    オフラインの成果物 (offline) があればそこから、無ければネットワーク経由で、足りない構築手順だけを実行する。
+    Conda が必要なのに見つからなければ RuntimeError。構築手順の失敗はそれまでに終わった手順を記録してから送出し、
+    例外の failed_step に失敗した手順名を入れる。
+    """
+    metrics = metrics or RunMetrics("provision")
+    env_lock = EnvironmentLock(venv_dir)
+    with metrics.span("plan"):
+        steps = env_lock.plan()
+    if not steps:
+        if env_lock.needs_refresh:
+            env_lock.write([])
+        log("conda_env は構築済みです。")
+        return {"source": "existing", "seconds": 0.0, "steps": []}
+    log(f"conda_env の構築が必要です ({', '.join(steps)})。")
+    started = time.perf_counter()
+    source = "online"
+    if offline.kind == "pack":
+        log("オフライン用のアーカイブから conda_env を復元しています...")
+        with metrics.span("restore_pack"):
+            offline.restore_pack(venv_dir, log)
+        source = "offline-pack"
+        # アーカイブの内容が ENV_SPEC と食い違う分だけ後続の手順で補う
+        env_lock = EnvironmentLock(venv_dir)
+        steps = env_lock.plan()
+        done = [step for step in BOOTSTRAP_STEPS if step not in steps]
+        log("conda_env の復元が完了しました。")
+    else:
+        done = []
+        if offline.kind == "channel":
+            source = "offline-channel"
+            log(f"ローカルチャンネルと wheelhouse を使ってネットワークなしで構築します: {offline.root}")
+    if ("create_env" in steps or "conda_deps" in steps) and shutil.which(conda_bin) is None:
+        raise RuntimeError("Conda が見つかりません。\nCondaが正しくインストールされているか確認してください。")
+    pipeline = BootstrapPipeline(venv_dir, steps, conda_bin, offline, log, metrics)
+    try:
+        pipeline.run()
+    except (OSError, subprocess.CalledProcessError) as e:
+        if pipeline.done:
+            # 成功した手順は記録し、再試行では失敗した手順以降だけを実行する
+            env_lock.write(done + pipeline.done, complete=False)
+        e.failed_step = pipeline.failed_step
+        raise
+    done += pipeline.done
+    provision = {"source": source, "seconds": round(time.perf_counter() - started, 3), "steps": done,
+                 "step_seconds": pipeline.timings}
+    env_lock.write(done, provision)
+    log(f"conda_env の用意が完了しました ({source}, {provision['seconds']:.1f} 秒)")
+    return provision
+
+
+class DatasetConverter:
+    """画面に依存しない変換処理。ログと進捗はコールバックで通知し、結果は dict で返す"""
+
+    TOTAL_STEPS = 5
+
+    def __init__(self, log=None, progress=None, file_progress=None):
+        self.log = log or (lambda message: None)
+        self.progress = progress
+        self.file_progress = file_progress
+        self.current_step = 0
+        self.result = {}
+        self.metrics = RunMetrics("convert")
+
+    def report_progress(self):
+        if self.progress:
+            self.progress(self.current_step, self.TOTAL_STEPS)
+
+    def _fail(self, message):
+        self.log(message)
+        self.result.update(status="error", error=message)
+        return self.result
+
+    def generate_yaml(self, base_dir, index=None, train_dir="train/images", val_dir="val/images", classes_path=None, yaml_name="data.yaml",
+                      label_store=None):
+        try:
+            import yaml
+        except ImportError as e:
+            self.log(f"❌ yaml モジュールが見つかりません:\n{e}\n仮想環境を再構築してください。")
+            return
+
+        if classes_path is None:
+            classes_path = os.path.join(base_dir, "classes.txt")
+
+        if not os.path.isfile(classes_path):
+            self.log("classes.txt が存在しないため、推測します。")
+            if label_store is not None:
+                label_paths = []
+            elif index is not None:
+                label_paths = [pair.label.path for pair in index.pairs]
+            else:
+                label_dir = os.path.join(base_dir, "train", "labels")
+                label_paths = []
+                if os.path.isdir(label_dir):
+                    label_paths = [os.path.join(label_dir, file) for file in os.listdir(label_dir) if file.endswith(".txt")]
+            labels = set(str(cls_id) for cls_id in label_store.class_ids()) if label_store is not None else set()
+            for file_path in label_paths:
+                try:
+                    with open(file_path, "r", encoding="utf-8") as f:
+                        for line in f:
+                            if line.strip():
+                                cls_id = line.split()[0]
+                                labels.add(cls_id)
+                except Exception as e:
+                    self.log(f"⚠ ファイル {os.path.basename(file_path)} の読み込みに失敗しました: {e}")
+            if labels:
+                labels = sorted(labels, key=lambda x: (0, int(x), "") if x.isdigit() else (1, 0, x))
+                try:
+                    with open(classes_path, "w", encoding="utf-8") as f:
+                        for label in labels:
+                            f.write(f"class_{label}\n")
+                except Exception as e:
+                    self.log(f"⚠ classes.txt の書き込みに失敗しました: {e}")
+                    return
+            else:
+                self.log("⚠ ラベルが見つかりませんでした。classes.txt を作成できません。")
+                return
+
+        classes = []
+        try:
+            with open(classes_path, "r", encoding="utf-8") as f:
+                classes = [line.strip() for line in f if line.strip()]
+        except Exception as e:
+            self.log(f"⚠ classes.txt の読み込みに失敗しました: {e}")
+            return
+
+        if not classes:
+            self.log("⚠ classes.txt が空です。")
+            return
+
+        data = {
+            "path": base_dir.replace("\\", "/"),
+            "train": train_dir,
+            "val": val_dir,
+            "nc": len(classes),
+            "names": classes
+        }
+
+        output_yaml_path = os.path.join(base_dir, yaml_name)
+        try:
+            with open(output_yaml_path, "w", encoding="utf-8") as f:
+                yaml.dump(data, f, allow_unicode=True)
+        except Exception as e:
+            self.log(f"⚠ data.yaml の書き込みに失敗しました: {e}")
+            return
+
+        self.current_step += 1
+        self.report_progress()
+        self.log(f"{yaml_name} output done: {output_yaml_path}")
+        return output_yaml_path
+
+    def find_folders(self, start_dir):
+        index = DatasetIndex(start_dir)
+        return index.images_dir, index.labels_dir
+
+    def split_yolo_dataset_with_clone(self, source_dir, output_base_dir, split_ratio=0.7, clone_strategy="auto", io_workers=None, incremental=True,
+                                      virtual=False, kfold=0, stratify=False, seed=None, metrics_dir=None, validate=False, cpu_workers=None,
+                                      group_duplicates=False, duplicate_distance=DUPLICATE_HAMMING_DISTANCE, shards=None,
+                                      shard_max_bytes=SHARD_MAX_BYTES, preprocess_size=None, preprocess_mode="letterbox", index=None):
+        """段階ごとの所要時間とカウンターを <出力フォルダ>.report.json に、metrics_dir があれば Prometheus の textfile にも書き出す
+
+        validate を指定すると分割の前に画像とラベルを検査し、不正なペアを隔離フォルダへ複製して分割から外す。
+        group_duplicates を指定すると知覚ハッシュで近似重複のクラスタを求め、クラスタ単位で train/val (と fold) に振り分ける。
+        shards ("tar" / "packed") を指定すると、分割後に train/val をシャードにまとめて data_shards.yaml も出力する。
+        preprocess_size を指定すると、画像をその大きさに縮小 (fit) またはレターボックス化したものを配置する。
+        index に走査済みの DatasetIndex (監視モードで変更分だけ更新したもの) を渡すと、変換元を走査し直さない。
+        """
+        original_name = os.path.basename(source_dir.rstrip("\\/"))
+        if not 0 < split_ratio < 1:
+            self.result = {"status": "running", "source_dir": source_dir}
+            return self._fail(f"❌ train の割合は 0 より大きく 1 より小さい値にしてください: {split_ratio}")
+        self.metrics = RunMetrics("convert", dataset=original_name)
+        try:
+            result = self._split_dataset(source_dir, output_base_dir, original_name, split_ratio, clone_strategy, io_workers, incremental,
+                                         virtual, kfold, stratify, seed, validate, cpu_workers, group_duplicates, duplicate_distance,
+                                         preprocess_size, preprocess_mode, index)
+            if shards and result.get("status") == "ok":
+                self.metrics.stage("shards")
+                self._export_shards(source_dir, output_base_dir, original_name, shards, shard_max_bytes, seed, io_workers)
+            return result
+        finally:
+            self._write_metrics(output_base_dir, original_name, metrics_dir or os.environ.get(METRICS_DIR_ENV))
+
+    def convert_label_studio_export(self, export_path, output_base_dir, dataset_dir=None, media_roots=None, classes_path=None,
+                                    use_predictions=False, **options):
+        """Label Studio の JSON / JSON-MIN 書き出しを YOLO データセット (既定: <出力フォルダ>/<JSON の名前>) に変換し、そのまま分割する
+
+        options は split_yolo_dataset_with_clone の引数。結果には変換の件数を "label_studio" として加える。
+        """
+        if dataset_dir is None:
+            dataset_dir = os.path.join(output_base_dir, os.path.splitext(os.path.basename(export_path))[0])
+        self.result = {"status": "running", "source_dir": dataset_dir}
+        try:
+            info = import_label_studio_export(export_path, dataset_dir, media_roots, classes_path, options.get("clone_strategy", "auto"),
+                                              options.get("io_workers"), use_predictions, log=self.log)
+        except (OSError, ValueError) as e:
+            return self._fail(f"❌ Label Studio の書き出しを変換できませんでした: {e}")
+        if not info["annotated"]:
+            return self._fail("❌ アノテーション済みのタスクがありません。")
+        result = self.split_yolo_dataset_with_clone(dataset_dir, output_base_dir, **options)
+        result["label_studio"] = info
+        return result
+
+    def merge_datasets(self, sources, output_base_dir, name="merged", dataset_dir=None, classes_path=None, **options):
+        """複数のデータセットをクラスを統合して 1 つ (既定: <出力フォルダ>/<name>) にまとめ、1 回の分割で val/train と data.yaml を出力する
+
+        options は split_yolo_dataset_with_clone の引数。結果には統合の件数を "merge" として加える。
+        """
+        if dataset_dir is None:
+            dataset_dir = os.path.join(output_base_dir, name)
+        self.result = {"status": "running", "source_dir": dataset_dir}
+        try:
+            info = merge_yolo_datasets(sources, dataset_dir, classes_path, options.get("clone_strategy", "auto"), options.get("io_workers"),
+                                       log=self.log)
+        except (OSError, ValueError) as e:
+            return self._fail(f"❌ データセットを統合できませんでした: {e}")
+        if not info["merged"]:
+            return self._fail("❌ 統合できるペアがありません。")
+        result = self.split_yolo_dataset_with_clone(dataset_dir, output_base_dir, **options)
+        result["merge"] = info
+        return result
+
+    def _export_shards(self, source_dir, output_base_dir, original_name, fmt, max_bytes, seed, io_workers):
+        output_dir = self.result["output_dir"]
+        manifest = ConversionManifest.load(os.path.join(output_base_dir, f"{original_name}_done{MANIFEST_SUFFIX}"))
+        shard_dir = os.path.join(output_dir, SHARD_DIR_NAME)
+        index_path = os.path.join(shard_dir, SHARD_INDEX_NAME)
+        try:
+            with open(index_path, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+        except (OSError, ValueError):
+            previous = {}
+        expected = {"format": fmt, "digest": manifest.digest(), "seed": seed, "max_bytes": max_bytes,
+                    "preprocess": manifest.layout.get("preprocess")}
+        preprocess_cache = self.result.get("preprocess_cache")
+        paths = (lambda key: _shard_source_paths(preprocess_cache, source_dir, manifest, key)) if preprocess_cache else None
+        if (all(previous.get(name) == value for name, value in expected.items())
+                and all(os.path.isfile(os.path.join(shard_dir, name)) for info in previous["subsets"].values() for name in info["shards"])):
+            self.log("シャードは前回から変わっていないため、書き出しをスキップします。")
+            index = previous
+        else:
+            tmp_dir = shard_dir + ".tmp"
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            try:
+                index = export_shards(source_dir, manifest, tmp_dir, fmt, max_bytes, seed, io_workers, paths)
+                index["preprocess"] = expected["preprocess"]
+                with open(os.path.join(tmp_dir, SHARD_INDEX_NAME), "w", encoding="utf-8") as f:
+                    json.dump(index, f, ensure_ascii=False, separators=(",", ":"))
+            except OSError as e:
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                self._fail(f"❌ シャードの書き出しに失敗しました: {e}")
+                return
+            shutil.rmtree(shard_dir, ignore_errors=True)
+            os.replace(tmp_dir, shard_dir)
+            summary = " / ".join(f"{subset} {len(info['shards'])}個 ({format_bytes(info['bytes'])}, {len(info['samples'])}件)"
+                                 for subset, info in index["subsets"].items())
+            self.log(f"シャード出力完了 ({fmt}): {summary}")
+        self.metrics.count("shards", sum(len(info["shards"]) for info in index["subsets"].values()))
+
+        classes_path = os.path.join(source_dir, "classes.txt")
+        if not os.path.isfile(classes_path):
+            classes_path = os.path.join(output_dir, "classes.txt")
+        self.generate_yaml(output_dir, train_dir=_shard_pattern(index["subsets"]["train"]["shards"]),
+                           val_dir=_shard_pattern(index["subsets"]["val"]["shards"]), classes_path=classes_path,
+                           yaml_name="data_shards.yaml")
+        self.result.update(shards=index_path, shard_format=fmt)
+
+    def _write_metrics(self, output_base_dir, original_name, metrics_dir):
+        for name in ("new", "changed", "deleted", "unchanged", "unpaired_images", "quarantined", "duplicate_clusters", "duplicate_images",
+                     "regrouped", "files", "bytes", "train", "val"):
+            if isinstance(self.result.get(name), int):
+                self.metrics.count(name, self.result[name])
+        self.metrics.count("errors", len(self.result.get("errors", [])))
+        self.metrics.finish(self.result.get("status") if self.result.get("status") in ("ok", "skipped") else "error")
+        report_path = os.path.join(output_base_dir, f"{original_name}_done{REPORT_SUFFIX}")
+        try:
+            self.metrics.write_json(report_path)
+            self.result["report"] = report_path
+            if metrics_dir:
+                self.result["metrics_textfile"] = self.metrics.write_prometheus(metrics_dir)
+        except OSError as e:
+            self.log(f"⚠ 実行レポートの書き込みに失敗しました: {e}")
+        stages = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.metrics.stage_totals().items())
+        self.log(f"段階別の所要時間: {stages} (合計 {self.metrics.seconds:.2f}s)")
+
+    def _split_dataset(self, source_dir, output_base_dir, original_name, split_ratio, clone_strategy, io_workers, incremental,
+                       virtual, kfold, stratify, seed, validate=False, cpu_workers=None, group_duplicates=False,
+                       duplicate_distance=DUPLICATE_HAMMING_DISTANCE, preprocess_size=None, preprocess_mode="letterbox", index=None):
+        import random
+
+        self.current_step = 0
+        self.report_progress()
+
+        output_dir = os.path.join(output_base_dir, f"{original_name}_done")
+        os.makedirs(output_dir, exist_ok=True)
+        self.result = {"status": "running", "source_dir": source_dir, "output_dir": output_dir}
+
+        # 複製してから移動するのではなく、元データから train/val の最終位置へ直接配置する
+        self.metrics.stage("index")
+        if index is None:
+            index = DatasetIndex(source_dir)
+        if not index.images_dir or not index.labels_dir:
+            return self._fail("❌ 'images' または 'labels' フォルダが見つかりませんでした。")
+
+        if validate:
+            self.metrics.stage("validate")
+            index = self._validate_dataset(source_dir, output_base_dir, original_name, index, cpu_workers)
+
+        layout = {
+            "source_dir": os.path.abspath(source_dir),
+            "images_dir": os.path.relpath(index.images_dir, source_dir).replace("\\", "/"),
+            "labels_dir": os.path.relpath(index.labels_dir, source_dir).replace("\\", "/"),
+            "mode": "virtual" if virtual else "physical",
+        }
+        # 前処理の設定が変わったら配置済みの画像はすべて置き換える (指定しない場合は従来のマニフェストと同じ形のまま)
+        if preprocess_size:
+            layout["preprocess"] = f"{preprocess_mode}-{preprocess_size}"
+        # 元データと実体を共有するかどうかが変わったら置き直す (以前の auto が hardlink で配置した出力も独立したファイルにする)
+        if not virtual:
+            layout["clone"] = "shared" if clone_strategy in _SHARED_CLONE_STRATEGIES else "independent"
+        image_dir = os.path.join(output_dir, layout["images_dir"])
+        label_dir = os.path.join(output_dir, layout["labels_dir"])
+        train_image_dir = os.path.join(image_dir, "train")
+        val_image_dir = os.path.join(image_dir, "val")
+        train_label_dir = os.path.join(label_dir, "train")
+        val_label_dir = os.path.join(label_dir, "val")
+        subset_dirs = {"train": (train_image_dir, train_label_dir), "val": (val_image_dir, val_label_dir)}
+
+        # 前回のマニフェストがあれば差分だけを処理する。全件やり直す場合は前回の配置結果を消しておく
+        self.metrics.stage("diff")
+        manifest_path = os.path.join(output_base_dir, f"{original_name}_done{MANIFEST_SUFFIX}")
+        manifest = ConversionManifest.load(manifest_path)
+        if not incremental or manifest.layout != layout:
+            self._remove_pair_outputs(output_dir, manifest, list(manifest.pairs))
+            for rel in manifest.extras:
+                self._remove_quietly(os.path.join(output_dir, rel))
+            manifest = ConversionManifest(manifest_path)
+        manifest.layout = layout
+
+        current = {pair.base + pair.ext: pair for pair in index.pairs}
+        unpaired_images = len(index.unpaired_images)
+
+        deleted = [key for key in manifest.pairs if key not in current]
+        self._remove_pair_outputs(output_dir, manifest, deleted)
+        for key in deleted:
+            del manifest.pairs[key]
+
+        new_pairs = []
+        stat_changed = []
+        pending = []
+        for key, pair in current.items():
+            entry = manifest.pairs.get(key)
+            if entry is None:
+                new_pairs.append(pair)
+            elif not ConversionManifest.stat_matches(entry, pair):
+                stat_changed.append(pair)
+            elif not entry["done"]:
+                pending.append(key)
+
+        # サイズか更新時刻が変わったものだけ内容ハッシュで本当に変わったかを確認する
+        self.metrics.stage("hash")
+        hashes = hash_pairs(new_pairs + stat_changed, io_workers)
+        changed = 0
+        for pair in stat_changed:
+            key = pair.base + pair.ext
+            entry = manifest.pairs[key]
+            if hashes[key] is None or hashes[key] != entry["hash"]:
+                changed += 1
+                manifest.record(key, pair, source_dir, hashes[key], entry["subset"])
+                pending.append(key)
+            else:
+                done = entry["done"]
+                manifest.record(key, pair, source_dir, hashes[key], entry["subset"])
+                manifest.pairs[key]["done"] = done
+                if not done:
+                    pending.append(key)
+
+        # 新規ペアは振り分け先を決める前に登録し、ラベル解析の対象に含める
+        for pair in new_pairs:
+            key = pair.base + pair.ext
+            manifest.record(key, pair, source_dir, hashes[key], None)
+            pending.append(key)
+
+        self.metrics.stage("labels")
+        label_store = self._load_label_store(os.path.join(output_base_dir, f"{original_name}_done{LABEL_CACHE_SUFFIX}"),
+                                             manifest, current, io_workers)
+
+        clusters = None
+        if group_duplicates:
+            self.metrics.stage("phash")
+            clusters = self._find_duplicate_clusters(output_base_dir, original_name, current, duplicate_distance, cpu_workers)
+
+        # 既存の振り分けはそのままにし、新規分だけで全体の比率に近づける
+        self.metrics.stage("assign")
+        rng = random.Random(seed)
+        if stratify and label_store is None:
+            self.log("⚠ ラベルの一括解析ができないため、層化分割の代わりにランダム分割します。")
+        if clusters:
+            # 前回の振り分けで train/val をまたいでいるクラスタは多い側に寄せ、移した分は配置し直す
+            regrouped = self._merge_split_clusters(output_dir, manifest, clusters, split_ratio)
+            pending_keys = set(pending)
+            pending.extend(key for key in regrouped if key not in pending_keys)
+            self._assign_grouped(manifest, clusters, label_store if stratify else None, split_ratio, seed, rng)
+            self._write_duplicates_report(output_base_dir, original_name, manifest, clusters, duplicate_distance, regrouped)
+            self._warn_empty_subset(manifest, clusters)
+        elif stratify and label_store is not None:
+            self._assign_stratified(manifest, label_store, split_ratio, seed)
+        else:
+            rng.shuffle(new_pairs)
+            train_count = manifest.subset_counts()["train"]
+            target_train = int(len(current) * split_ratio)
+            need_train = min(max(target_train - train_count, 0), len(new_pairs))
+            for i, pair in enumerate(new_pairs):
+                manifest.pairs[pair.base + pair.ext]["subset"] = "train" if i < need_train else "val"
+
+        self.log(
+            f"差分: 新規 {len(new_pairs)}件 / 変更 {changed}件 / 削除 {len(deleted)}件 / 未処理 {len(pending) - len(new_pairs) - changed}件")
+        if label_store is not None and current:
+            self._log_class_balance(manifest, label_store)
+        self.result.update(new=len(new_pairs), changed=changed, deleted=len(deleted), unpaired_images=unpaired_images,
+                           unchanged=len(current) - len(pending))
+
+        sources = {}
+        if preprocess_size:
+            self.metrics.stage("preprocess")
+            sources = self._preprocess_images(output_base_dir, original_name, manifest, current, preprocess_size, preprocess_mode,
+                                              cpu_workers)
+
+        def source_of(key):
+            # 前処理に失敗した (または前処理しない) ペアは元の画像とラベルをそのまま使う
+            if key in sources:
+                return sources[key]
+            return current[key].image.path, current[key].label.path
+
+        if virtual:
+            self.metrics.stage("virtual_lists")
+            return self._write_virtual_split(source_dir, output_dir, index, manifest, current, unpaired_images, kfold, label_store, rng,
+                                             clusters, source_of)
+
+        cloner = FileCloner(clone_strategy)
+        if clone_strategy in _SHARED_CLONE_STRATEGIES:
+            self.log(f"⚠ 複製方式 {clone_strategy} では出力が元のファイルと同じ実体を指すため、出力を編集すると元データも変わります。")
+        engine = FileTransferEngine(cloner, max_workers=io_workers)
+        placed = {pair.image.path for pair in index.pairs} | {pair.label.path for pair in index.pairs}
+        extras = {}
+        extra_sources = {}
+
+        def other_files():
+            # ペアになった画像・ラベル以外は元と同じ相対位置に配置する
+            for root in index.dirs:
+                dst_root = os.path.join(output_dir, os.path.relpath(root, source_dir))
+                os.makedirs(dst_root, exist_ok=True)
+                for f in index.files[root]:
+                    if f.path in placed:
+                        continue
+                    rel = os.path.relpath(f.path, source_dir).replace("\\", "/")
+                    extras[rel] = [f.size, f.mtime]
+                    extra_sources[f.path] = rel
+                    if manifest.extras.get(rel) != extras[rel]:
+                        yield f.path, os.path.join(dst_root, os.path.basename(f.path)), f.size
+
+        self.metrics.stage("place_extras")
+        try:
+            engine.run(other_files())
+        except Exception as e:
+            return self._fail(f"❌ ファイルの複製に失敗しました: {e}")
+        for src, _ in engine.errors:
+            extras.pop(extra_sources.get(src), None)
+        for rel in manifest.extras.keys() - extras.keys():
+            self._remove_quietly(os.path.join(output_dir, rel))
+        manifest.extras = extras
+
+        self.current_step += 1
+        self.report_progress()
+        self.log("複製完了")
+
+        if unpaired_images > 0:
+            self.log(f"⚠ ラベルがない画像が {unpaired_images} 件見つかりました。（スキップ）")
+
+        if not current:
+            manifest.save()
+            self.log("ラベル付き画像が見つからなかったので終了。")
+            self.result.update(status="skipped", train=0, val=0)
+            return self.result
+
+        for subset_dir in (train_image_dir, val_image_dir, train_label_dir, val_label_dir):
+            os.makedirs(subset_dir, exist_ok=True)
+
+        # 先に振り分け計画を保存しておき、中断時は次回この計画の続きから再開する
+        manifest.save()
+
+        def place_files(keys):
+            for key in keys:
+                pair = current[key]
+                subset_image_dir, subset_label_dir = subset_dirs[manifest.pairs[key]["subset"]]
+                if key in sources:
+                    image_path, label_path = sources[key]
+                    yield image_path, os.path.join(subset_image_dir, key)
+                    yield label_path, os.path.join(subset_label_dir, os.path.basename(pair.label.path))
+                else:
+                    yield pair.image.path, os.path.join(subset_image_dir, key), pair.image.size
+                    yield pair.label.path, os.path.join(subset_label_dir, os.path.basename(pair.label.path)), pair.label.size
+
+        self.metrics.stage("place_pairs")
+        if self.file_progress:
+            placed_before = engine.files + len(engine.errors)
+            engine.progress = lambda count: self.file_progress(count - placed_before, 2 * len(pending))
+        for start in range(0, len(pending), MANIFEST_BATCH_SIZE):
+            batch = pending[start:start + MANIFEST_BATCH_SIZE]
+            errors_before = len(engine.errors)
+            engine.run(place_files(batch))
+            failed = {src for src, _ in engine.errors[errors_before:]}
+            manifest.mark_done([key for key in batch if not failed.intersection(source_of(key))])
+        engine.progress = None
+        manifest.save()
+
+        if engine.errors:
+            self.log(f"⚠ ファイルの配置に失敗しました: {len(engine.errors)}件")
+            for src, e in engine.errors[:5]:
+                self.log(f"⚠ ファイルの配置に失敗しました ({os.path.basename(src)}): {e}")
+
+        counts = manifest.subset_counts()
+        self.current_step += 1
+        self.report_progress()
+        self.log(f"アノテーション処理完了 Train {counts['train']}件 / Val {counts['val']}件 ({cloner.summary()})")
+        self.log(f"I/O スループット: {engine.summary()}")
+
+        self.result.update(train=counts["train"], val=counts["val"], clone=dict(cloner.counts), bytes_written=cloner.bytes_written,
+                           files=engine.files, bytes=engine.bytes, transfer_seconds=round(engine.elapsed, 3),
+                           errors=[f"{src}: {e}" for src, e in engine.errors])
+
+        self.metrics.stage("yaml")
+        data_yaml = self.generate_yaml(output_dir, index=index,
+                                       train_dir=os.path.relpath(train_image_dir, output_dir).replace("\\", "/"),
+                                       val_dir=os.path.relpath(val_image_dir, output_dir).replace("\\", "/"),
+                                       label_store=label_store)
+        if data_yaml is None:
+            return self._fail("❌ data.yaml を生成できませんでした。")
+        self.result.update(status="ok", data_yaml=data_yaml)
+        return self.result
+
+    def _validate_dataset(self, source_dir, output_base_dir, original_name, index, workers):
+        """ペアを検査し、不正なものを隔離フォルダへ複製したうえで、それらを除いた DatasetIndex を返す (元のファイルは変えない)"""
+        cache = ValidationCache.load(os.path.join(output_base_dir, f"{original_name}_done{VALIDATION_CACHE_SUFFIX}"))
+        class_count = self._count_source_classes(index)
+        bad, checked = validate_pairs(index.pairs, cache, class_count, workers)
+        try:
+            cache.save()
+        except OSError as e:
+            self.log(f"⚠ 検査結果のキャッシュを保存できませんでした: {e}")
+        self.metrics.count("validated_files", checked)
+        self.result.update(quarantined=len(bad))
+        self.log(f"検査: {len(index.pairs)}組 (新たに検査したファイル {checked}件) / 不正 {len(bad)}組")
+        if not bad:
+            return index
+        for key, reasons in list(bad.items())[:5]:
+            self.log(f"⚠ {key}: {'; '.join(reasons)}")
+        self.result["quarantine_report"] = self._quarantine_pairs(source_dir, output_base_dir, original_name, index, bad)
+        return index.without(bad)
+
+    def _count_source_classes(self, index):
+        # 最も浅い位置にある classes.txt をクラス一覧とみなす。無ければクラス ID の範囲は検査しない
+        return len(index_classes(index) or ()) or None
+
+    def _quarantine_pairs(self, source_dir, output_base_dir, original_name, index, bad):
+        """不正なペアを元の相対位置のまま隔離フォルダへ複製し、理由を quarantine.json に記録する (同じ画像の前回の記録は置き換える)"""
+        quarantine_dir = os.path.join(output_base_dir, f"{original_name}{QUARANTINE_SUFFIX}")
+        report_path = os.path.join(quarantine_dir, QUARANTINE_REPORT_NAME)
+        try:
+            with open(report_path, "r", encoding="utf-8") as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            report = []
+        quarantined_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        # 元データと実体を共有しないよう、reflink できなければコピーする
+        cloner = FileCloner("auto")
+        entries = []
+        failed = 0
+        for pair in index.pairs:
+            reasons = bad.get(pair.base + pair.ext)
+            if reasons is None:
+                continue
+            entry = {"image": os.path.relpath(pair.image.path, source_dir).replace("\\", "/"),
+                     "label": os.path.relpath(pair.label.path, source_dir).replace("\\", "/"),
+                     "reasons": reasons, "quarantined_at": quarantined_at}
+            try:
+                for f, rel in ((pair.image, entry["image"]), (pair.label, entry["label"])):
+                    dst = os.path.join(quarantine_dir, rel)
+                    os.makedirs(os.path.dirname(dst), exist_ok=True)
+                    cloner.clone(f.path, dst, f.size)
+            except OSError as e:
+                failed += 1
+                entry["error"] = str(e)
+            entries.append(entry)
+        images = {entry["image"] for entry in entries}
+        report = [entry for entry in report if entry.get("image") not in images] + entries
+        os.makedirs(quarantine_dir, exist_ok=True)
+        tmp_path = report_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, report_path)
+        if failed:
+            self.log(f"⚠ 隔離フォルダへの複製に失敗したペアが {failed} 組あります。")
+        self.log(f"不正なペア {len(bad)}組 を分割から外し、{len(bad) - failed}組 を隔離フォルダへ複製しました (元のファイルはそのままです): {quarantine_dir}")
+        return report_path
+
+    def _preprocess_images(self, output_base_dir, original_name, manifest, current, size, mode, workers):
+        """全ペアの前処理結果をキャッシュに用意し、キー -> (画像, ラベル) のパスを返す
+
+        キャッシュは元の画像とラベルの内容ハッシュで引くので、再実行では新しいペアと変更されたペアだけを処理する。
+        使われなくなった結果は消す。Pillow が無い、または失敗したペアは含まれない (元のファイルを使う)。
+        """
+        import importlib.util
+
+        if importlib.util.find_spec("PIL") is None:
+            self.log("⚠ Pillow が見つからないため、画像の前処理をスキップします。")
+            return {}
+        cache_dir = os.path.join(output_base_dir, f"{original_name}_done{PREPROCESS_SUFFIX}", f"{mode}-{size}")
+        for name in ("images", "labels"):
+            os.makedirs(os.path.join(cache_dir, name), exist_ok=True)
+        sources = {}
+        jobs = {}
+        for key, pair in current.items():
+            digest = manifest.pairs[key]["hash"]
+            if digest is None:
+                continue
+            paths = preprocess_cache_paths(cache_dir, key, digest)
+            sources[key] = paths
+            # 内容が同じペアは 1 回だけ処理する
+            if paths[0] not in jobs and not os.path.isfile(paths[0]):
+                jobs[paths[0]] = (pair.image.path, pair.label.path) + paths + (size, mode)
+        errors = dict(zip(jobs, _run_file_jobs(_preprocess_pair, list(jobs.values()), workers)))
+        failed = {image_path for image_path, error in errors.items() if error}
+        for error in [error for error in errors.values() if error][:5]:
+            self.log(f"⚠ 前処理に失敗しました ({error})")
+        if failed:
+            self.log(f"⚠ 前処理に失敗した画像 {len(failed)}件 は元の画像とラベルをそのまま使います。")
+        sources = {key: paths for key, paths in sources.items() if paths[0] not in failed}
+        used = {os.path.basename(path) for paths in sources.values() for path in paths}
+        for name in ("images", "labels"):
+            for file_name in os.listdir(os.path.join(cache_dir, name)):
+                if file_name not in used:
+                    self._remove_quietly(os.path.join(cache_dir, name, file_name))
+        self.metrics.count("preprocessed", len(jobs) - len(failed))
+        self.log(f"前処理 ({mode} {size}px): {len(sources)}件 (新たに処理した画像 {len(jobs) - len(failed)}件)")
+        self.result["preprocess_cache"] = cache_dir
+        return sources
+
+    def _find_duplicate_clusters(self, output_base_dir, original_name, current, distance, workers):
+        import importlib.util
+
+        if importlib.util.find_spec("PIL") is None:
+            self.log("⚠ Pillow が見つからないため、近似重複のグループ化をスキップします。")
+            return None
+        cache = ValidationCache.load(os.path.join(output_base_dir, f"{original_name}_done{PHASH_CACHE_SUFFIX}"))
+        hashes, computed = perceptual_hashes([pair.image for pair in current.values()], cache, workers)
+        try:
+            cache.save()
+        except OSError as e:
+            self.log(f"⚠ 知覚ハッシュのキャッシュを保存できませんでした: {e}")
+        failed = sum(1 for value in hashes.values() if value is None)
+        if failed:
+            self.log(f"⚠ 知覚ハッシュを計算できない画像が {failed} 件ありました (グループ化の対象外)。")
+        clusters = find_near_duplicates({key: hashes[pair.image.path] for key, pair in current.items()}, distance)
+        self.metrics.count("phash_computed", computed)
+        return clusters
+
+    def _merge_split_clusters(self, output_dir, manifest, clusters, split_ratio):
+        """クラスタ内の振り分け済みのペアを片側の subset にそろえ、未割当のペアもそれに合わせる。移動したキーを返す
+
+        train/val をまたいでいるクラスタは、寄せた後の train の件数が目標に近くなる側へ寄せる (同じなら多い側)。
+        """
+        counts = manifest.subset_counts()
+        target_train = len(manifest.pairs) * split_ratio
+        moves = {}
+        for cluster in sorted(clusters, key=len, reverse=True):
+            subsets = [manifest.pairs[key]["subset"] for key in cluster]
+            train, val = subsets.count("train"), subsets.count("val")
+            if not train and not val:
+                continue
+            if train and val:
+                to_train = abs(counts["train"] + val - target_train)
+                to_val = abs(counts["train"] - train - target_train)
+                target = "train" if (to_train, -train) <= (to_val, -val) else "val"
+                counts["train"] += val if target == "train" else -train
+            else:
+                target = "train" if train else "val"
+            for key, subset in zip(cluster, subsets):
+                if subset != target:
+                    moves[key] = target
+        moved = [key for key, target in moves.items() if manifest.pairs[key]["subset"] is not None]
+        self._remove_pair_outputs(output_dir, manifest, moved)
+        for key, target in moves.items():
+            manifest.pairs[key]["subset"] = target
+        for key in moved:
+            manifest.pairs[key]["done"] = False
+        return moved
+
+    def _assign_grouped(self, manifest, clusters, label_store, split_ratio, seed, rng):
+        """近似重複のクラスタを 1 単位として未割当のペアを振り分ける。label_store があれば単位ごとのクラス数で層化する"""
+        clustered = {key for cluster in clusters for key in cluster}
+        units = [list(cluster) for cluster in clusters] + [[key] for key in sorted(manifest.pairs) if key not in clustered]
+        codes = {"train": 1, "val": 0, None: -1}
+        fixed = [codes[manifest.pairs[unit[0]]["subset"]] for unit in units]
+        if label_store is not None:
+            import numpy as np
+
+            matrix, _ = label_store.class_matrix()
+            unit_of = {key: i for i, unit in enumerate(units) for key in unit}
+            unit_matrix = np.zeros((len(units), matrix.shape[1]), dtype=matrix.dtype)
+            np.add.at(unit_matrix, np.array([unit_of[key] for key in label_store.keys.tolist()], dtype=np.int64), matrix)
+            is_train = stratified_split(unit_matrix, split_ratio, seed=seed, fixed=np.array(fixed, dtype=np.int8)).tolist()
+        else:
+            open_units = [i for i, code in enumerate(fixed) if code == -1]
+            rng.shuffle(open_units)
+            need_train = int(len(manifest.pairs) * split_ratio) - manifest.subset_counts()["train"]
+            is_train = [False] * len(units)
+            for i in open_units:
+                # クラスタの半分以上が不足分に収まるなら train に入れる
+                if need_train >= len(units[i]) / 2:
+                    is_train[i] = True
+                    need_train -= len(units[i])
+        for unit, code, train in zip(units, fixed, is_train):
+            if code == -1:
+                for key in unit:
+                    manifest.pairs[key]["subset"] = "train" if train else "val"
+
+    def _warn_empty_subset(self, manifest, clusters):
+        """クラスタをまとめた結果 train か val が空になったら警告し、結果にも残す"""
+        counts = manifest.subset_counts()
+        if len(manifest.pairs) < 2 or (counts["train"] and counts["val"]):
+            return
+        empty = "val" if counts["train"] else "train"
+        message = (f"近似重複をまとめた結果、{empty} が 0 件になりました (最大のクラスタ {max(map(len, clusters))}件 / 全 {len(manifest.pairs)}件)。"
+                   f"近似重複とみなす距離を小さくするか、近似重複のまとめを外してください。")
+        self.log(f"⚠ {message}")
+        self.result["warning"] = message
+
+    def _write_duplicates_report(self, output_base_dir, original_name, manifest, clusters, distance, regrouped):
+        sizes = [len(cluster) for cluster in clusters]
+        histogram = {}
+        for label, low, high in (("2", 2, 2), ("3-5", 3, 5), ("6-10", 6, 10), ("11-50", 11, 50), ("51+", 51, None)):
+            histogram[label] = sum(1 for size in sizes if size >= low and (high is None or size <= high))
+        stats = {"distance": distance, "clusters": len(clusters), "images": sum(sizes), "largest": max(sizes, default=0),
+                 "sizes": histogram, "regrouped": len(regrouped)}
+        self.result.update(duplicate_clusters=stats["clusters"], duplicate_images=stats["images"], regrouped=len(regrouped))
+        self.log(f"近似重複: クラスタ {stats['clusters']}件 (画像 {stats['images']}件, 最大 {stats['largest']}件, "
+                 f"大きさ別 {', '.join(f'{label}: {count}' for label, count in histogram.items())})")
+        if regrouped:
+            self.log(f"train/val をまたいでいたクラスタのペア {len(regrouped)}件 を同じ側へ移します。")
+        report_path = os.path.join(output_base_dir, f"{original_name}_done{DUPLICATES_REPORT_SUFFIX}")
+        report = {"stats": stats,
+                  "clusters": [{"subset": manifest.pairs[cluster[0]]["subset"], "keys": cluster} for cluster in clusters]}
+        try:
+            tmp_path = report_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, separators=(",", ":"))
+            os.replace(tmp_path, report_path)
+            self.result["duplicates_report"] = report_path
+        except OSError as e:
+            self.log(f"⚠ 近似重複のレポートを書き込めませんでした: {e}")
+
+    def _assign_stratified(self, manifest, label_store, split_ratio, seed):
+        import numpy as np
+
+        matrix, _ = label_store.class_matrix()
+        keys = label_store.keys.tolist()
+        codes = {"train": 1, "val": 0, None: -1}
+        fixed = np.array([codes[manifest.pairs[key]["subset"]] for key in keys], dtype=np.int8)
+        is_train = stratified_split(matrix, split_ratio, seed=seed, fixed=fixed)
+        for key, code, train in zip(keys, fixed.tolist(), is_train.tolist()):
+            if code == -1:
+                manifest.pairs[key]["subset"] = "train" if train else "val"
+
+    def _log_class_balance(self, manifest, label_store):
+        import numpy as np
+
+        matrix, class_ids = label_store.class_matrix()
+        is_train = np.array([manifest.pairs[key]["subset"] == "train" for key in label_store.keys.tolist()], dtype=bool)
+        present = matrix > 0
+        train_counts = present[is_train].sum(axis=0).tolist()
+        val_counts = present[~is_train].sum(axis=0).tolist()
+        balance = ", ".join(f"{cls_id}: {t}/{v}" for cls_id, t, v in zip(class_ids, train_counts, val_counts))
+        self.log(f"クラス別画像数 Train/Val ({balance or 'なし'})")
+
+    def _load_label_store(self, cache_root, manifest, current, io_workers):
+        try:
+            label_store = LabelStore.load_or_build(cache_root, manifest, current, io_workers)
+        except ImportError:
+            self.log("⚠ numpy が見つからないため、ラベルの一括解析をスキップします。")
+            return None
+        except Exception as e:
+            self.log(f"⚠ ラベルの一括解析に失敗しました: {e}")
+            return None
+        class_counts = ", ".join(f"{cls_id}: {count}" for cls_id, count in label_store.class_counts().items())
+        self.log(f"ラベル {len(label_store.classes)}件 (クラス別 {class_counts or 'なし'})")
+        if label_store.invalid_rows:
+            self.log(f"⚠ 解析できないラベル行が {label_store.invalid_rows} 件ありました。")
+        return label_store
+
+    def _write_virtual_split(self, source_dir, output_dir, index, manifest, current, unpaired_images, kfold, label_store, rng, clusters=None,
+                             source_of=None):
+        """画像を配置せず、元画像のパスを列挙した train.txt/val.txt (と K-fold 用のリスト) を書き出す"""
+        for entry in manifest.pairs.values():
+            entry["done"] = True
+        # fold 数を減らした場合は前回の余分な fold のリストを消しておく
+        for k in range(max(kfold, 1) + 1, manifest.kfold + 1):
+            for name in (f"fold_{k}_train.txt", f"fold_{k}_val.txt", f"data_fold_{k}.yaml"):
+                self._remove_quietly(os.path.join(output_dir, name))
+        if kfold > 1:
+            # fold もマニフェストに保存し、ペアが増減しても既存ペアの fold は変えない。K が変わった場合だけ全件振り直す
+            if manifest.kfold != kfold:
+                for entry in manifest.pairs.values():
+                    entry.pop("fold", None)
+            # 近似重複のクラスタは fold もまたがないよう、多い側の fold にそろえて 1 単位で配る
+            units = {}
+            for cluster in clusters or ():
+                folds = [manifest.pairs[key]["fold"] for key in cluster if manifest.pairs[key].get("fold") is not None]
+                if folds:
+                    for key in cluster:
+                        manifest.pairs[key]["fold"] = max(set(folds), key=folds.count)
+                else:
+                    units[cluster[0]] = cluster
+            clustered = {key for cluster in clusters or () for key in cluster}
+            fold_sizes = [0] * kfold
+            unassigned = []
+            for key in sorted(manifest.pairs):
+                fold = manifest.pairs[key].get("fold")
+                if fold is not None:
+                    fold_sizes[fold] += 1
+                elif key in units:
+                    unassigned.append(units[key])
+                elif key not in clustered:
+                    unassigned.append([key])
+            rng.shuffle(unassigned)
+            for unit in unassigned:
+                fold = fold_sizes.index(min(fold_sizes))
+                for key in unit:
+                    manifest.pairs[key]["fold"] = fold
+                fold_sizes[fold] += len(unit)
+        manifest.kfold = kfold
+        manifest.save()
+
+        if unpaired_images > 0:
+            self.log(f"⚠ ラベルがない画像が {unpaired_images} 件見つかりました。（スキップ）")
+        if not current:
+            self.log("ラベル付き画像が見つからなかったので終了。")
+            self.result.update(status="skipped", train=0, val=0)
+            return self.result
+
+        def write_list(name, keys):
+            with open(os.path.join(output_dir, name), "w", encoding="utf-8") as f:
+                f.write("".join(os.path.abspath(source_of(key)[0] if source_of else current[key].image.path).replace("\\", "/") + "\n"
+                                for key in sorted(keys)))
+
+        subsets = {"train": [], "val": []}
+        for key, entry in manifest.pairs.items():
+            subsets[entry["subset"]].append(key)
+        write_list("train.txt", subsets["train"])
+        write_list("val.txt", subsets["val"])
+
+        self.current_step += 1
+        self.report_progress()
+        self.log(f"アノテーション処理完了 (仮想分割) Train {len(subsets['train'])}件 / Val {len(subsets['val'])}件")
+
+        # 元データの classes.txt を優先し、無い場合だけ出力先に推測結果を書き出す
+        classes_path = os.path.join(source_dir, "classes.txt")
+        if not os.path.isfile(classes_path):
+            classes_path = os.path.join(output_dir, "classes.txt")
+        self.metrics.stage("yaml")
+        data_yaml = self.generate_yaml(output_dir, index=index, train_dir="train.txt", val_dir="val.txt", classes_path=classes_path,
+                                       label_store=label_store)
+        if data_yaml is None:
+            return self._fail("❌ data.yaml を生成できませんでした。")
+        self.result.update(train=len(subsets["train"]), val=len(subsets["val"]), data_yaml=data_yaml)
+
+        if kfold > 1:
+            folds = [[] for _ in range(kfold)]
+            for key, entry in manifest.pairs.items():
+                folds[entry["fold"]].append(key)
+            for k in range(kfold):
+                write_list(f"fold_{k + 1}_train.txt", [key for i, fold in enumerate(folds) if i != k for key in fold])
+                write_list(f"fold_{k + 1}_val.txt", folds[k])
+                self.generate_yaml(output_dir, index=index, train_dir=f"fold_{k + 1}_train.txt", val_dir=f"fold_{k + 1}_val.txt",
+                                   classes_path=classes_path, yaml_name=f"data_fold_{k + 1}.yaml", label_store=label_store)
+            self.log(f"K-fold リスト出力完了 ({kfold} folds: " + " / ".join(str(len(fold)) for fold in folds) + ")")
+            self.result["folds"] = [len(fold) for fold in folds]
+        self.result["status"] = "ok"
+        return self.result
+
+    def _remove_quietly(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _remove_pair_outputs(self, output_dir, manifest, keys):
+        for key in keys:
+            entry = manifest.pairs[key]
+            self._remove_quietly(os.path.join(output_dir, manifest.layout["images_dir"], entry["subset"], key))
+            self._remove_quietly(os.path.join(output_dir, manifest.layout["labels_dir"], entry["subset"], os.path.basename(entry["label"])))
+
+
+class _InotifyWatch:
+    """Linux の inotify (ctypes 経由) で、フォルダ以下で変更のあったフォルダを受け取る"""
+
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    name = "inotify"
+
+    def __init__(self, root):
+        import ctypes
+        import ctypes.util
+
+        self._ctypes = ctypes
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.root = root
+        self.dirs = {}
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | getattr(os, "O_CLOEXEC", 0))
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 に失敗しました")
+        try:
+            self._add_tree(root)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def _add_tree(self, top):
+        for current, _, _ in os.walk(top):
+            wd = self._libc.inotify_add_watch(self.fd, os.fsencode(current), self.MASK)
+            if wd < 0:
+                # 監視数の上限 (fs.inotify.max_user_watches) に達した場合など
+                raise OSError(self._ctypes.get_errno(), f"inotify_add_watch に失敗しました: {current}")
+            self.dirs[wd] = current
+
+    def wait(self, timeout):
+        import select
+        import struct
+
+        if not select.select([self.fd], [], [], max(0.0, timeout))[0]:
+            return set()
+        changed = set()
+        while True:
+            try:
+                data = os.read(self.fd, 256 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset + 16 <= len(data):
+                wd, mask, _, length = struct.unpack_from("iIII", data, offset)
+                name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+                offset += 16 + length
+                if mask & self.IN_Q_OVERFLOW:
+                    # イベントを取りこぼしたので、すべてのフォルダを読み直させる
+                    changed.update(self.dirs.values())
+                    continue
+                path = self.dirs.get(wd)
+                if path is None:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self.dirs[wd]
+                    continue
+                changed.add(path)
+                if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                    try:
+                        self._add_tree(os.path.join(path, os.fsdecode(name)))
+                    except OSError:
+                        pass
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _PollingWatch:
+    """フォルダごとに中身の (名前, サイズ, 更新時刻) から署名を作り、前回と違うフォルダを返す
+
+    Windows の scandir は属性を一覧と一緒に返すので、ファイル数が多くても 1 回の確認は一覧の取得とほぼ同じ時間で済む。
+    """
+
+    name = "poll"
+
+    def __init__(self, root, interval=WATCH_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.signatures = self._snapshot()
+
+    def _snapshot(self):
+        signatures = {}
+        stack = [self.root]
+        while stack:
+            current = stack.pop()
+            count = total = 0
+            try:
+                with os.scandir(current) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                            total += hash(entry.name)
+                        else:
+                            st = entry.stat()
+                            total += hash((entry.name, st.st_size, st.st_mtime_ns))
+                        count += 1
+            except OSError:
+                continue
+            signatures[current] = (count, total & 0xFFFFFFFFFFFFFFFF)
+        return signatures
+
+    def wait(self, timeout):
+        time.sleep(max(0.0, min(self.interval, timeout)))
+        signatures = self._snapshot()
+        changed = {d for d in signatures.keys() | self.signatures.keys() if signatures.get(d) != self.signatures.get(d)}
+        self.signatures = signatures
+        return changed
+
+    def close(self):
+        pass
+
+
+class DatasetWatcher:
+    """変換元フォルダを監視し、保存が落ち着くたびに変更のあったフォルダだけを読み直して差分を変換する
+
+    Linux では inotify、それ以外 (または inotify を使えない場合) はポーリングで変更を検出する。変更を検出してから
+    debounce 秒間次の変更がなければ変換する (保存が続く場合も max_delay 秒で打ち切る)。options は split_yolo_dataset_with_clone の引数。
+    """
+
+    def __init__(self, source_dir, output_base_dir, options=None, debounce=WATCH_DEBOUNCE_SECONDS, max_delay=WATCH_MAX_DELAY,
+                 poll_interval=WATCH_POLL_INTERVAL, backend="auto", log=None, progress=None, on_cycle=None):
+        self.source_dir = source_dir
+        self.output_base_dir = output_base_dir
+        self.options = dict(options or {})
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.backend = backend
+        self.log = log or (lambda message: None)
+        self.progress = progress
+        self.on_cycle = on_cycle
+        self.cycles = 0
+
+    def _open_watch(self):
+        if self.backend in ("auto", "inotify") and sys.platform.startswith("linux"):
+            try:
+                return _InotifyWatch(self.source_dir)
+            except OSError as e:
+                if self.backend == "inotify":
+                    raise
+                self.log(f"⚠ inotify を使えないため、ポーリングで監視します: {e}")
+        elif self.backend == "inotify":
+            raise OSError(errno.ENOSYS, "inotify はこの OS では使えません")
+        return _PollingWatch(self.source_dir, self.poll_interval)
+
+    def _convert(self, index, detected_at, dirs=(), rescanned=False):
+        started = time.monotonic()
+        converter = DatasetConverter(log=self.log, progress=self.progress)
+        try:
+            result = converter.split_yolo_dataset_with_clone(self.source_dir, self.output_base_dir, index=index, **self.options)
+        except Exception as e:
+            result = {"status": "error", "error": f"{type(e).__name__}: {e}"}
+        # 2 回目以降は必ず差分だけを処理する
+        self.options["incremental"] = True
+        cycle = {"cycle": self.cycles, "status": result.get("status"), "dirs": len(dirs), "rescanned": rescanned,
+                 "convert_seconds": round(time.monotonic() - started, 3), "ready_seconds": round(time.monotonic() - detected_at, 3)}
+        for key in ("new", "changed", "deleted", "train", "val", "error"):
+            if key in result:
+                cycle[key] = result[key]
+        if self.cycles:
+            self.log(f"監視: 変更を反映しました (新規 {cycle.get('new', 0)}件 / 変更 {cycle.get('changed', 0)}件 / 削除 {cycle.get('deleted', 0)}件、"
+                     f"検出から {cycle['ready_seconds']:.2f}秒)")
+        if self.on_cycle:
+            self.on_cycle(cycle)
+        self.cycles += 1
+        return cycle
+
+    def run(self, stop_event=None, max_cycles=None):
+        """stop_event が立つか、初回の変換のあと max_cycles 回変換するまで監視を続ける"""
+        stop_event = stop_event or threading.Event()
+        source = os.path.abspath(self.source_dir)
+        output = os.path.abspath(self.output_base_dir)
+        if not os.path.isdir(source):
+            raise FileNotFoundError(errno.ENOENT, "変換元フォルダが見つかりません", self.source_dir)
+        if path_within(output, source):
+            raise ValueError("出力先が変換元フォルダの中にあるため、監視できません。")
+        # 初回の変換中に保存されたファイルも拾えるよう、先に監視を始めておく
+        watch = self._open_watch()
+        self.log(f"監視を開始しました ({watch.name}): {self.source_dir}")
+        try:
+            index = DatasetIndex(self.source_dir)
+            self._convert(index, time.monotonic())
+            while not stop_event.is_set() and (max_cycles is None or self.cycles <= max_cycles):
+                dirs = watch.wait(WATCH_IDLE_TIMEOUT)
+                if not dirs:
+                    continue
+                detected_at = time.monotonic()
+                while not stop_event.is_set():
+                    remaining = detected_at + self.max_delay - time.monotonic()
+                    more = watch.wait(min(self.debounce, remaining)) if remaining > 0 else set()
+                    if not more:
+                        break
+                    dirs |= more
+                rescanned = index.refresh(dirs)
+                self._convert(index, detected_at, dirs, rescanned)
+        finally:
+            watch.close()
+            self.log("監視を終了しました。")
+
+
+class LogPipeline:
+    """どのスレッドからでも書けるログの受け口
+
+    write() はキューに積むだけで、専用のスレッドが画面用のリングバッファとサイズでローテーションするログファイルに書き出す。
+    画面側は sequence の変化を見て lines() で新しい行だけを取り出す。
+    """
+
+    def __init__(self, log_path=None, capacity=LOG_RING_CAPACITY, max_bytes=LOG_MAX_BYTES, backup_count=LOG_BACKUP_COUNT):
+        self.queue = SimpleQueue()
+        self.ring = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.sequence = 0
+        self.log_path = log_path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.logger = None
+        self.handler = None
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _open_handler(self):
+        # logging の読み込みとファイルのオープンは書き込みスレッドで行い、ウィンドウの表示を待たせない
+        import logging
+        import logging.handlers
+
+        self.logger = logging.Logger("mosaic")
+        try:
+            os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+            self.handler = logging.handlers.RotatingFileHandler(self.log_path, maxBytes=self.max_bytes, backupCount=self.backup_count,
+                                                                encoding="utf-8")
+            self.handler.setFormatter(logging.Formatter("%(asctime)s [%(source)s] %(message)s"))
+            self.logger.addHandler(self.handler)
+        except OSError as e:
+            with self.lock:
+                self.ring.append(("app", f"ログファイルを開けませんでした: {e}"))
+                self.sequence += 1
+
+    def write(self, message, source="app"):
+        for line in str(message).splitlines() or [""]:
+            self.queue.put((source, line))
+
+    def _writer(self):
+        if self.log_path:
+            self._open_handler()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            source, line = item
+            with self.lock:
+                self.ring.append(item)
+                self.sequence += 1
+            if self.handler:
+                self.logger.info(line, extra={"source": source})
+
+    def follow(self, stream, source):
+        """サブプロセスのパイプを 1 行ずつ読み、閉じられるまでログに流すスレッドを開始する"""
+        def pump():
+            with stream:
+                for line in stream:
+                    self.write(line.rstrip("\r\n"), source)
+
+        thread = threading.Thread(target=pump, daemon=True)
+        thread.start()
+        return thread
+
+    def lines(self, since=0, source=None):
+        """sequence が since より後の行と現在の sequence を返す。リングから溢れた行は含まれない"""
+        with self.lock:
+            count = min(self.sequence - since, len(self.ring))
+            items = list(self.ring)[len(self.ring) - count:] if count > 0 else []
+            sequence = self.sequence
+        return sequence, [line for item_source, line in items if source is None or item_source == source]
+
+    def tail(self, source=None, limit=50):
+        _, lines = self.lines(0, source)
+        return lines[-limit:]
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(timeout=2)
+        if self.handler:
+            self.handler.close()
+
+
+def find_free_port(start=LABEL_STUDIO_BASE_PORT, count=LABEL_STUDIO_PORT_RANGE, host="127.0.0.1", exclude=()):
+    """start から順に bind を試し、最初に空いていたポートを返す"""
+    import socket
+
+    for port in range(start, start + count):
+        if port in exclude:
+            continue
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            try:
+                sock.bind((host, port))
+            except OSError:
+                continue
+        return port
+    raise OSError(errno.EADDRINUSE, f"{start}-{start + count - 1} に空いているポートがありません")
+
+
+def wait_for_http(url, timeout, interval=0.5, process=None, stop_event=None):
+    """url が HTTP で応答するまで待ち、かかった秒数を返す。タイムアウト、プロセスの終了、停止要求のときは None"""
+    import urllib.error
+    import urllib.request
+
+    started = time.monotonic()
+    while time.monotonic() - started < timeout:
+        if process is not None and process.poll() is not None:
+            return None
+        if stop_event is not None and stop_event.is_set():
+            return None
+        try:
+            with urllib.request.urlopen(url, timeout=interval * 4):
+                return time.monotonic() - started
+        except urllib.error.HTTPError as e:
+            # ログイン画面へのリダイレクトや 404 でも、サーバーは要求を受け付けている
+            if e.code < 500:
+                return time.monotonic() - started
+        except (urllib.error.URLError, OSError):
+            pass
+        if stop_event is not None:
+            stop_event.wait(interval)
+        else:
+            time.sleep(interval)
+    return None
+
+
+class ServerInstance:
+    """監視下にある Label Studio の 1 インスタンス"""
+
+    def __init__(self, instance_id, port, env=None):
+        self.id = instance_id
+        self.port = port
+        # 監視役の環境変数に上書きする、このインスタンスだけの設定
+        self.env = env
+        self.process = None
+        self.reader = None
+        self.state = "starting"
+        self.started_at = None
+        self.ready_seconds = None
+        self.restarts = 0
+        self.consecutive_failures = 0
+        self.returncode = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def url(self):
+        return f"http://localhost:{self.port}"
+
+    def snapshot(self):
+        return {"id": self.id, "port": self.port, "pid": self.process.pid if self.process else None, "state": self.state,
+                "ready_seconds": self.ready_seconds, "restarts": self.restarts, "returncode": self.returncode}
+
+
+class LabelStudioSupervisor:
+    """Label Studio のインスタンスを起動・監視する
+
+    インスタンスごとに空いているポートを割り当て、HTTP の応答で起動完了を判定する。
+    異常終了したインスタンスは待ち時間を伸ばしながら再起動し、shutdown() ですべてを終了させる。
+    状態の変化は on_event(event, instance) で通知する (監視スレッドから呼ばれる)。
+    """
+
+    def __init__(self, command_factory, log_pipeline, cwd=None, env=None, on_event=None, ready_timeout=LABEL_STUDIO_READY_TIMEOUT,
+                 base_port=LABEL_STUDIO_BASE_PORT, health_path=LABEL_STUDIO_HEALTH_PATH):
+        self.command_factory = command_factory
+        self.log_pipeline = log_pipeline
+        self.cwd = cwd
+        self.env = env
+        self.on_event = on_event or (lambda event, instance: None)
+        self.ready_timeout = ready_timeout
+        self.base_port = base_port
+        self.health_path = health_path
+        self.registry = {}
+        self.lock = threading.Lock()
+        self.next_id = 1
+
+    def _reserved_ports(self, instance=None):
+        return {other.port for other in self.registry.values() if other is not instance and other.state not in ("stopped", "exited", "failed")}
+
+    def start(self, env=None):
+        """新しいインスタンスを起動する。env はこのインスタンスだけに加える環境変数"""
+        with self.lock:
+            port = find_free_port(self.base_port, exclude=self._reserved_ports())
+            instance = ServerInstance(self.next_id, port, env)
+            self.next_id += 1
+            self.registry[instance.id] = instance
+        instance.thread = threading.Thread(target=self._supervise, args=(instance,), daemon=True)
+        instance.thread.start()
+        return instance
+
+    def instances(self, running_only=False):
+        with self.lock:
+            instances = list(self.registry.values())
+        if running_only:
+            instances = [instance for instance in instances if instance.process and instance.process.poll() is None]
+        return instances
+
+    def instance_env(self, instance):
+        if not instance.env:
+            return self.env
+        return dict(os.environ if self.env is None else self.env, **instance.env)
+
+    def _spawn(self, instance):
+        creationflags = 0
+        if os.name == "nt":
+            creationflags = subprocess.CREATE_NO_WINDOW | subprocess.CREATE_NEW_PROCESS_GROUP
+        instance.process = subprocess.Popen(self.command_factory(instance.port), cwd=self.cwd, env=self.instance_env(instance),
+                                            creationflags=creationflags,
+                                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8",
+                                            errors="replace", bufsize=1)
+        instance.reader = self.log_pipeline.follow(instance.process.stdout, f"label-studio:{instance.port}")
+        instance.started_at = time.monotonic()
+        instance.state = "starting"
+        instance.returncode = None
+
+    def _supervise(self, instance):
+        while True:
+            try:
+                # shutdown() と同じロックの中で起動し、停止要求の後にプロセスが残らないようにする
+                with self.lock:
+                    if instance.stop_event.is_set():
+                        instance.state = "stopped"
+                        return
+                    self._spawn(instance)
+            except OSError as e:
+                instance.state = "failed"
+                self.log_pipeline.write(f"Label Studio を起動できませんでした: {e}")
+                self.on_event("failed", instance)
+                return
+            self.on_event("starting", instance)
+            ready_seconds = wait_for_http(instance.url + self.health_path, self.ready_timeout, process=instance.process,
+                                          stop_event=instance.stop_event)
+            if ready_seconds is not None:
+                instance.ready_seconds = round(ready_seconds, 3)
+                instance.state = "ready"
+                self.on_event("ready", instance)
+            elif instance.process.poll() is None and not instance.stop_event.is_set():
+                self.log_pipeline.write(f"Label Studio (port {instance.port}) が {self.ready_timeout} 秒以内に応答しませんでした。")
+                self.on_event("timeout", instance)
+
+            instance.returncode = instance.process.wait()
+            instance.reader.join(timeout=5)
+            if instance.stop_event.is_set():
+                instance.state = "stopped"
+                self.on_event("stopped", instance)
+                return
+            if instance.returncode == 0:
+                instance.state = "exited"
+                self.on_event("exited", instance)
+                return
+
+            instance.state = "crashed"
+            if time.monotonic() - instance.started_at >= RESTART_STABLE_SECONDS:
+                instance.consecutive_failures = 0
+            if instance.consecutive_failures >= RESTART_MAX_ATTEMPTS:
+                instance.state = "failed"
+                self.on_event("failed", instance)
+                return
+            delay = min(RESTART_BACKOFF_MAX, RESTART_BACKOFF_BASE * 2 ** instance.consecutive_failures)
+            instance.consecutive_failures += 1
+            self.log_pipeline.write(f"Label Studio (port {instance.port}) が終了コード {instance.returncode} で終了しました。"
+                                    f"{delay:.0f} 秒後に再起動します ({instance.consecutive_failures}/{RESTART_MAX_ATTEMPTS})")
+            self.on_event("restarting", instance)
+            if instance.stop_event.wait(delay):
+                instance.state = "stopped"
+                self.on_event("stopped", instance)
+                return
+            instance.restarts += 1
+            try:
+                with self.lock:
+                    instance.port = self._restart_port(instance)
+            except OSError as e:
+                instance.state = "failed"
+                self.log_pipeline.write(f"Label Studio を再起動できませんでした: {e}")
+                self.on_event("failed", instance)
+                return
+
+    def _restart_port(self, instance):
+        # 待っている間にポートが他で使われた場合は別のポートに移る
+        try:
+            return find_free_port(instance.port, 1)
+        except OSError:
+            return find_free_port(self.base_port, exclude=self._reserved_ports(instance))
+
+    def _signal_stop(self, process):
+        import signal
+
+        if os.name == "nt":
+            # 新しいプロセスグループで起動しているので CTRL_BREAK で終了を求める
+            process.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            process.terminate()
+
+    def _kill(self, process):
+        if os.name == "nt":
+            subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], check=False, capture_output=True, text=True)
+        else:
+            process.kill()
+
+    def stop(self, instance, timeout=5):
+        self.shutdown(timeout, [instance])
+
+    def shutdown(self, timeout=5, instances=None):
+        """インスタンスに終了を求め、timeout 秒以内に終わらなければ強制終了する"""
+        instances = self.instances() if instances is None else instances
+        with self.lock:
+            for instance in instances:
+                instance.stop_event.set()
+                if instance.process and instance.process.poll() is None:
+                    try:
+                        self._signal_stop(instance.process)
+                    except OSError as e:
+                        self.log_pipeline.write(f"プロセスの終了に失敗しました: {e}")
+        deadline = time.monotonic() + timeout
+        for instance in instances:
+            if not instance.process:
+                continue
+            try:
+                instance.process.wait(timeout=max(0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self.log_pipeline.write(f"プロセスが{timeout}秒以内に終了しませんでした。強制終了します...")
+                self._kill(instance.process)
+                instance.process.wait()
+        for instance in instances:
+            if instance.thread:
+                instance.thread.join(timeout=2)
+
+
+class LabelStudioClient:
+    """Label Studio の REST API の呼び出し。接続はスレッドごとに keep-alive で使い回し、429・5xx・接続エラーは指数バックオフで再試行する
+
+    token が JWT (Personal Access Token) ならアクセストークンに交換して Bearer で、それ以外 (旧来のトークン) は Token で認証する。
+    """
+
+    def __init__(self, url, token, timeout=LS_API_TIMEOUT, retries=LS_API_RETRIES):
+        from urllib.parse import urlsplit
+
+        parts = urlsplit(url.rstrip("/"))
+        self.url = url.rstrip("/")
+        self.scheme = parts.scheme or "http"
+        self.netloc = parts.netloc
+        self.prefix = parts.path
+        self.token = token
+        self.timeout = timeout
+        self.retries = retries
+        self.retried = 0
+        self.requests = 0
+        self._access = None
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._auth_lock = threading.Lock()
+
+    def _connection(self):
+        import http.client
+
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            factory = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+            conn = factory(self.netloc, timeout=self.timeout)
+            self._local.conn = conn
+            with self._lock:
+                self._connections.append(conn)
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+    def _authorization(self, refresh=False):
+        if self.token.count(".") != 2:
+            return f"Token {self.token}"
+        with self._auth_lock:
+            if self._access is None or refresh:
+                self._access = None
+                self._access = self._send("POST", "/api/token/refresh", {"refresh": self.token}, auth=False)["access"]
+            return f"Bearer {self._access}"
+
+    def request(self, method, path, body=None):
+        """JSON を送って JSON を受け取る。再試行しても失敗したときは RuntimeError"""
+        return self._send(method, path, body)
+
+    def _send(self, method, path, body=None, auth=True):
+        import http.client
+        import random
+
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8") if body is not None else None
+        refreshed = False
+        attempt = 0
+        while True:
+            headers = {"Accept": "application/json", "Content-Type": "application/json"}
+            if auth:
+                headers["Authorization"] = self._authorization(refresh=refreshed)
+            conn = self._connection()
+            retry_after = None
+            try:
+                conn.request(method, self.prefix + path, body=data, headers=headers)
+                response = conn.getresponse()
+                payload = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                # 切れた keep-alive 接続は捨てて、次の試行で張り直す
+                self._drop_connection()
+                error = f"{type(e).__name__}: {e}"
+            else:
+                with self._lock:
+                    self.requests += 1
+                if response.status < 300:
+                    return json.loads(payload) if payload.strip() else None
+                detail = payload[:300].decode("utf-8", "replace")
+                if response.status == 401 and auth and self.token.count(".") == 2 and not refreshed:
+                    # アクセストークンの期限切れ。交換し直して 1 回だけやり直す
+                    refreshed = True
+                    continue
+                if response.status not in (408, 429, 500, 502, 503, 504):
+                    raise RuntimeError(f"Label Studio API {method} {path} が失敗しました (HTTP {response.status}): {detail}")
+                error = f"HTTP {response.status}: {detail}"
+                retry_after = response.getheader("Retry-After")
+            if attempt >= self.retries:
+                raise RuntimeError(f"Label Studio API {method} {path} が {attempt + 1} 回失敗しました ({error})")
+            with self._lock:
+                self.retried += 1
+            try:
+                delay = float(retry_after)
+            except (TypeError, ValueError):
+                delay = min(LS_API_BACKOFF_MAX, LS_API_BACKOFF_BASE * 2 ** attempt) * (0.5 + random.random() / 2)
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+    def paginate(self, path):
+        """一覧 API の全件を返す。ページ分けされた応答 ({"results", "next"}) とリストの応答の両方に対応する"""
+        separator = "&" if "?" in path else "?"
+        page = 1
+        while True:
+            data = self.request("GET", f"{path}{separator}page={page}&page_size=100")
+            if isinstance(data, list):
+                yield from data
+                return
+            yield from data.get("results") or ()
+            if not data.get("next"):
+                return
+            page += 1
+
+
+def label_studio_label_config(classes):
+    """classes.txt のクラスで矩形とポリゴンを付けられるラベル設定 (from_name は "label"、to_name は "image")"""
+    from xml.sax.saxutils import quoteattr
+
+    labels = "".join(f"<Label value={quoteattr(name)}/>" for name in classes)
+    return (f'<View><Image name="image" value="$image"/><RectangleLabels name="label" toName="image">{labels}</RectangleLabels>'
+            f'<PolygonLabels name="polygon" toName="image">{labels}</PolygonLabels></View>')
+
+
+def path_within(path, root):
+    """path が root 自身かその下にあるか (ドライブが違う場合は False)"""
+    root = os.path.abspath(root)
+    try:
+        return os.path.commonpath([os.path.abspath(path), root]) == root
+    except ValueError:
+        return False
+
+
+def local_files_root(env):
+    """環境変数でローカルファイルの配信が有効なら LOCAL_FILES_DOCUMENT_ROOT を、無効なら None を返す"""
+    serving, root = (env.get(name) for name in LS_LOCAL_FILES_ENV)
+    if str(serving).lower() not in ("1", "true", "yes") or not root:
+        return None
+    return root
+
+
+def import_state_path(source_dir, url, project):
+    """一括登録の状態ファイル。同じフォルダを別のサーバーの同じ ID のプロジェクトへ送る場合と混ざらないよう、URL も名前に含める"""
+    from urllib.parse import urlsplit
+
+    parts = urlsplit(url)
+    server = "".join(ch if ch.isalnum() or ch in "-." else "_" for ch in parts.netloc + parts.path.rstrip("/"))
+    return os.path.join(source_dir, f"{LS_IMPORT_STATE_PREFIX}{server}_{project}.jsonl")
+
+
+def local_files_url(path, document_root):
+    """Label Studio の LOCAL_FILES_DOCUMENT_ROOT 配下にある画像を指す URL"""
+    from urllib.parse import quote
+
+    return "/data/local-files/?d=" + quote(os.path.relpath(os.path.abspath(path), document_root).replace("\\", "/"))
+
+
+def _yolo_label_path(image_path):
+    """YOLO の慣習どおり、パスの最後の images を labels に置き換えたラベルのパス"""
+    stem = os.path.splitext(image_path)[0]
+    for sep in {os.sep, "/"}:
+        i = stem.rfind(f"{sep}images{sep}")
+        if i >= 0:
+            return f"{stem[:i]}{sep}labels{sep}{stem[i + 8:]}.txt"
+    return stem + ".txt"
+
+
+def _yolo_predictions(label_path, classes):
+    """YOLO のラベルを Label Studio の予測 (座標は %) にする。ラベルが無ければ None"""
+    try:
+        with open(label_path, "r", encoding="utf-8") as f:
+            rows = [line.split() for line in f if line.strip()]
+    except OSError:
+        return None
+    result = []
+    for row in rows:
+        try:
+            cls_id, coords = int(row[0]), [float(v) * 100 for v in row[1:]]
+        except (ValueError, IndexError):
+            continue
+        name = classes[cls_id] if 0 <= cls_id < len(classes) else f"class_{cls_id}"
+        if len(coords) == 4:
+            xc, yc, w, h = coords
+            result.append({"from_name": "label", "to_name": "image", "type": "rectanglelabels",
+                           "value": {"x": xc - w / 2, "y": yc - h / 2, "width": w, "height": h, "rotation": 0, "rectanglelabels": [name]}})
+        elif len(coords) >= 6 and len(coords) % 2 == 0:
+            result.append({"from_name": "polygon", "to_name": "image", "type": "polygonlabels",
+                           "value": {"points": [coords[i:i + 2] for i in range(0, len(coords), 2)], "polygonlabels": [name]}})
+    return [{"model_version": "yolo-import", "result": result}]
+
+
+def _iter_import_images(index):
+    for root in index.dirs:
+        for f in sorted(index.files[root]):
+            if os.path.splitext(f.path)[1].lower() in IMAGE_EXTS:
+                yield f.path
+
+
+def ensure_label_studio_project(client, title, classes):
+    """同じタイトルのプロジェクトがあればその ID を、無ければ classes のラベル設定で作成して ID を返す"""
+    from urllib.parse import quote
+
+    for project in client.paginate(f"/api/projects?title={quote(title)}"):
+        if project.get("title") == title:
+            return project["id"], False
+    if not classes:
+        raise RuntimeError("classes.txt が見つからないため、プロジェクトのラベル設定を作れません (既存のプロジェクトを指定してください)")
+    project = client.request("POST", "/api/projects", {"title": title, "label_config": label_studio_label_config(classes)})
+    return project["id"], True
+
+
+def bulk_import_label_studio(client, source_dir, project=None, title=None, mode="tasks", document_root=None, batch_size=LS_IMPORT_BATCH_SIZE,
+                             workers=4, with_labels=False, restart=False, log=print, progress=None, sync_timeout=LS_STORAGE_SYNC_TIMEOUT):
+    """source_dir 以下の画像を Label Studio のプロジェクトにまとめて登録し、件数と tasks/s を返す
+
+    mode="tasks" は画像を指すタスクの JSON を batch_size 件ずつ、workers 本の接続で並列にインポートする。
+    登録済みの画像は source_dir の状態ファイルに記録し、途中で失敗しても再実行で残りだけを送る (restart で最初から)。
+    mode="storage" は source_dir をローカルファイルのストレージとして登録し、同期 (取り込み) を Label Studio に任せ、sync_timeout 秒まで待つ。
+    どちらも Label Studio 側で LOCAL_FILES_SERVING_ENABLED と、source_dir を含む LOCAL_FILES_DOCUMENT_ROOT
+    (document_root。既定は環境変数、無ければ source_dir) が必要。
+    """
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+    started = time.perf_counter()
+    source_dir = os.path.abspath(source_dir)
+    # クラス一覧と登録する画像の一覧は 1 回の走査で集める
+    index = DatasetIndex(source_dir)
+    classes = index_classes(index) or []
+    if project is None:
+        project, created = ensure_label_studio_project(client, title or os.path.basename(source_dir), classes)
+        log(f"Label Studio のプロジェクト {project} を{'作成しました' if created else '使います'}。")
+    info = {"project": project, "mode": mode, "url": client.url}
+
+    if mode == "storage":
+        storage = client.request("POST", "/api/storages/localfiles", {
+            "project": project, "title": os.path.basename(source_dir), "path": source_dir, "use_blob_urls": True,
+            "regex_filter": r"(?i).*\.(" + "|".join(ext[1:] for ext in IMAGE_EXTS) + ")$"})
+        storage = client.request("POST", f"/api/storages/localfiles/{storage['id']}/sync") or storage
+        # 新しい版の Label Studio は同期をバックグラウンドで行うので、終わるまで待つ
+        deadline = time.monotonic() + sync_timeout
+        while storage.get("status") in ("initialized", "queued", "in_progress"):
+            if time.monotonic() >= deadline:
+                raise RuntimeError(f"ローカルファイルの同期が {sync_timeout:g} 秒以内に終わりませんでした (状態: {storage.get('status')})")
+            time.sleep(1)
+            storage = client.request("GET", f"/api/storages/localfiles/{storage['id']}")
+        if storage.get("status") == "failed":
+            raise RuntimeError(f"ローカルファイルの同期に失敗しました: {storage.get('traceback') or storage.get('meta')}")
+        tasks = storage.get("last_sync_count") or 0
+        seconds = time.perf_counter() - started
+        info.update(storage=storage["id"], tasks=tasks, seconds=round(seconds, 3), tasks_per_second=round(tasks / max(seconds, 1e-9), 1))
+        log(f"ローカルファイルのストレージ {storage['id']} を同期しました: {tasks}件 ({seconds:.2f}秒)")
+        return info
+
+    if document_root is None:
+        document_root = os.environ.get("LOCAL_FILES_DOCUMENT_ROOT") or source_dir
+    if not path_within(source_dir, document_root):
+        raise ValueError(f"{source_dir} が LOCAL_FILES_DOCUMENT_ROOT ({document_root}) の外にあるため、Label Studio から画像を読めません")
+    state_path = import_state_path(source_dir, client.url, project)
+    imported = set()
+    if restart:
+        try:
+            os.remove(state_path)
+        except OSError:
+            pass
+    else:
+        try:
+            with open(state_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        imported.update(json.loads(line))
+                    except ValueError:
+                        pass
+        except OSError:
+            pass
+    pending_files = [path for path in _iter_import_images(index) if os.path.relpath(path, source_dir) not in imported]
+    total = len(pending_files)
+    if imported:
+        log(f"登録済みの {len(imported)}件を除き、{total}件を送ります。")
+
+    def import_batch(paths):
+        tasks = []
+        for path in paths:
+            task = {"data": {"image": local_files_url(path, document_root)}}
+            if with_labels:
+                predictions = _yolo_predictions(_yolo_label_path(path), classes)
+                if predictions:
+                    task["predictions"] = predictions
+            tasks.append(task)
+        response = client.request("POST", f"/api/projects/{project}/import", tasks) or {}
+        return response.get("task_count", len(tasks))
+
+    sent = batches = 0
+    failures = []
+    pending = {}
+    workers = max(1, workers)
+    with open(state_path, "a", encoding="utf-8") as state, ThreadPoolExecutor(max_workers=workers) as pool:
+        def collect(futures):
+            nonlocal sent, batches
+            for future in futures:
+                paths = pending.pop(future)
+                try:
+                    sent += future.result()
+                except RuntimeError as e:
+                    failures.append(str(e))
+                    continue
+                batches += 1
+                # 完了したバッチだけを記録する。失敗したバッチは次回の実行で送り直す
+                state.write(json.dumps([os.path.relpath(path, source_dir) for path in paths], ensure_ascii=False) + "\n")
+                state.flush()
+                if progress:
+                    progress(sent, total)
+
+        for start in range(0, total, batch_size):
+            pending[pool.submit(import_batch, pending_files[start:start + batch_size])] = pending_files[start:start + batch_size]
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(list(pending))
+    client.close()
+
+    seconds = time.perf_counter() - started
+    info.update(tasks=sent, skipped=len(imported), batches=batches, failed_batches=len(failures), retries=client.retried,
+                requests=client.requests, seconds=round(seconds, 3), tasks_per_second=round(sent / max(seconds, 1e-9), 1))
+    log(f"Label Studio に {sent}件のタスクを登録しました ({seconds:.2f}秒, {info['tasks_per_second']:.0f} tasks/s, "
+        f"{batches} バッチ, 再試行 {client.retried}回, {workers} 接続)")
+    if failures:
+        log(f"⚠ {len(failures)} バッチが失敗しました。もう一度実行すると残りだけを送ります: {failures[0]}")
+    return info
+
+
+class UIEventQueue:
+    """ワーカースレッドから Tk のメインループへ渡す画面更新のキュー
+
+    key を付けた更新は最新の 1 件だけを残し (進捗表示など)、key のない呼び出しは順番どおりに実行する。
+    メインループは一定間隔の tick でまとめて処理し、予定時刻からの遅れを応答遅延として記録する。
+    """
+
+    def __init__(self, master, tick_ms=UI_TICK_MS, max_calls=UI_MAX_CALLS_PER_TICK):
+        self.master = master
+        self.tick_ms = tick_ms
+        self.max_calls = max_calls
+        self.lock = threading.Lock()
+        self.calls = deque()
+        self.latest = {}
+        self.tickers = []
+        self.latencies = deque(maxlen=UI_LATENCY_SAMPLES)
+        self.expected = None
+        self.posted = 0
+        self.executed = 0
+
+    def post(self, func, *args, key=None):
+        """どのスレッドからでも呼べる"""
+        with self.lock:
+            self.posted += 1
+            if key is None:
+                self.calls.append((func, args))
+            else:
+                self.latest[key] = (func, args)
+
+    def add_ticker(self, func):
+        """tick ごとにメインループで呼ぶ関数を登録する"""
+        self.tickers.append(func)
+
+    def start(self):
+        self.expected = time.perf_counter() + self.tick_ms / 1000
+        self.master.after(self.tick_ms, self._tick)
+
+    def _tick(self):
+        now = time.perf_counter()
+        self.latencies.append(max(0.0, now - self.expected))
+        self.drain()
+        self.expected = time.perf_counter() + self.tick_ms / 1000
+        self.master.after(self.tick_ms, self._tick)
+
+    def drain(self):
+        with self.lock:
+            count = min(len(self.calls), self.max_calls)
+            calls = [self.calls.popleft() for _ in range(count)]
+            latest, self.latest = self.latest, {}
+        for func, args in calls + list(latest.values()):
+            self._run(func, *args)
+        for func in self.tickers:
+            self._run(func)
+
+    def _run(self, func, *args):
+        try:
+            func(*args)
+        except Exception:
+            self.master.report_callback_exception(*sys.exc_info())
+        self.executed += 1
+
+    def reset_stats(self):
+        self.latencies.clear()
+
+    def stats(self):
+        """tick の遅れ (ms)。メインループが詰まっていなければ数 ms に収まる"""
+        samples = sorted(self.latencies)
+        if not samples:
+            return {"samples": 0, "mean_ms": 0.0, "p95_ms": 0.0, "max_ms": 0.0}
+        return {
+            "samples": len(samples),
+            "mean_ms": round(sum(samples) / len(samples) * 1000, 2),
+            "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 2),
+            "max_ms": round(samples[-1] * 1000, 2),
+        }
+
 
 class DashboardApp:
     def __init__(self, master):
         self.master = master
-        self.process = None
+        # 起動した Label Studio はすべてこの監視役が管理する (最初の起動時に作成)
+        self.supervisor = None
+        # 監視モードの実行中は停止要求の Event を持つ
+        self.watch_stop = None
+        self.launch_metrics = {}
         self.settings = {"labels_before": "", "labels_done": ""}
         self.master.title("Mosaic tool Dashboard")
         self.master.geometry("1000x700")
@@ -30,13 +4315,23 @@ class DashboardApp:
 
         self.TOTAL_STEPS = 5
         self.current_step = 0
+        self.file_done = 0
+        self.file_total = 0
         self.log_text = ""
         self.animation_running = False
         self.animation_chars = [".....", "///"]
         self.animation_index = 0
+        self.animation_suffix = ""
+        self.animation_next = 0.0
 
-        self.original_stdout = sys.stdout
-        self.output_buffer = io.StringIO()
+        # 標準出力は差し替えず、ログはすべてこのパイプラインを通す
+        self.log_pipeline = LogPipeline(os.path.join(app_dir(), LOG_DIR_NAME, LOG_FILE_NAME))
+        self.log_sequence = 0
+        # ワーカースレッドからの画面更新はすべてこのキューを通し、tick ごとにまとめて反映する
+        self.ui_queue = UIEventQueue(self.master)
+        self.ui_queue.add_ticker(self.poll_log)
+        self.ui_queue.add_ticker(self.update_animation)
+        self.ui_queue.start()
 
         self.label_studio_button = None
 
@@ -53,263 +4348,118 @@ class DashboardApp:
             self.label_studio_button.config(state="normal", bg="#8e8ee5")
 
     def start_animation(self):
-        if not self.animation_running:
-            self.animation_running = True
-            self.update_animation()
+        # どのスレッドからでも呼べる。表示は tick の update_animation が行う
+        self.animation_running = True
 
     def stop_animation(self):
         self.animation_running = False
-        self.animation_index = 0
-        self.update_log(self.log_text.rstrip(".....").rstrip("///"))
 
     def update_animation(self):
         if not self.animation_running:
+            if self.animation_suffix:
+                self.animation_suffix = ""
+                self.animation_index = 0
+                self.render_log()
+            return
+        now = time.monotonic()
+        if now < self.animation_next:
             return
-        base_text = self.log_text.rstrip(".....").rstrip("///")
+        self.animation_next = now + UI_ANIMATION_INTERVAL
         self.animation_index = (self.animation_index + 1) % len(self.animation_chars)
-        new_text = base_text + self.animation_chars[self.animation_index]
-        self.update_log(new_text)
-        self.master.after(500, self.update_animation)
+        self.animation_suffix = self.animation_chars[self.animation_index]
+        self.render_log()
 
     def update_log(self, message):
         self.log_text = message
+        self.render_log()
+
+    def render_log(self):
+        # 本文とアニメーションを分けて持ち、表示するときだけ連結する
         if hasattr(self, 'log_label'):
-            self.log_label.config(text=self.log_text)
+            self.log_label.config(text=self.log_text + self.animation_suffix)
+
+    def log(self, message, source="app"):
+        """どのスレッドからでも呼べる。画面には poll_log が最新の行を表示する"""
+        self.log_pipeline.write(message, source)
+
+    def poll_log(self):
+        # tick の間に届いた行はまとめて扱い、最新の 1 行だけを表示する
+        sequence, lines = self.log_pipeline.lines(self.log_sequence)
+        if sequence != self.log_sequence:
+            self.log_sequence = sequence
+            if lines:
+                self.update_log(lines[-1])
 
     def launch_label_studio(self):
         # 変更点: プロセス重複チェックを削除し、複数インスタンスの起動を許可
         # 変更点: スクリプトまたはEXEと同じディレクトリを取得
-        if getattr(sys, 'frozen', False):
-            # PyInstallerでEXE化されている場合、EXEのディレクトリを使用
-            script_dir = os.path.dirname(os.path.abspath(sys.executable))
-        else:
-            # 通常のPython実行時、スクリプトのディレクトリを使用
-            script_dir = os.path.dirname(os.path.abspath(__file__))
+        script_dir = app_dir()
 
         venv_dir = os.path.join(script_dir, "conda_env")
-        label_studio_exe = os.path.join(venv_dir, "Scripts" if os.name == "nt" else "bin", "label-studio" + (".exe" if os.name == "nt" else ""))
-        self.conda_env_exists = os.path.exists(venv_dir) and os.path.isfile(label_studio_exe)
+        # 起動完了までの各段階を計測し、Label Studio が応答した時点でレポートを書き出す
+        metrics = RunMetrics("launch")
+        # ロックファイルと比べて、構築手順が残っているかだけをここで調べる (構築は provision_environment に任せる)
+        self.conda_env_exists = not EnvironmentLock(venv_dir).plan()
 
         # conda_env が存在しない場合、ボタンを無効化
         if not self.conda_env_exists:
-            print("conda_env が見つかりません。仮想環境構築中はボタンを無効化します。")
+            self.log("conda_env が見つかりません。仮想環境構築中はボタンを無効化します。")
             self.disable_button()
 
         self.update_log("Label Studio を起動しています")
         self.start_animation()
-
-        sys.stdout = self.output_buffer
         # 仮想環境構築または起動処理を別スレッドで開始
-        threading.Thread(target=self._launch_label_studio_thread, args=(script_dir,), daemon=True).start()
+        threading.Thread(target=self._launch_label_studio_thread, args=(script_dir, metrics), daemon=True).start()
+
+    @staticmethod
+    def _provision_error_message(e):
+        step = getattr(e, "failed_step", None)
+        if step is None:
+            return str(e) if isinstance(e, RuntimeError) else f"conda_env の用意に失敗しました:\n{e}\n"
+        error_msg = f"{BOOTSTRAP_LABELS[step]}に失敗しました:\n{e}\n"
+        if getattr(e, "output", None):
+            error_msg += f"出力 (末尾):\n{e.output[-2000:]}\n"
+        if step in ("conda_deps", "label_studio"):
+            if os.name == "nt":
+                error_msg += "Windows環境では Microsoft Visual C++ Build Tools が必要です。以下のリンクからインストールしてください:\n"
+                error_msg += "https://visualstudio.microsoft.com/visual-cpp-build-tools/\n"
+            error_msg += "または、Condaで依存パッケージを再インストールしてみてください。"
+        return error_msg
 
-    def _launch_label_studio_thread(self, script_dir):
+    def _launch_label_studio_thread(self, script_dir, metrics):
         try:
             venv_dir = os.path.join(script_dir, "conda_env")
-            label_studio_exe = os.path.join(venv_dir, "Scripts" if os.name == "nt" else "bin", "label-studio" + (".exe" if os.name == "nt" else ""))
-
-            if self.conda_env_exists:
-                print("conda_env が見つかりました。label-studio を直接起動します。")
-                self.output_buffer.seek(0)
-                output = self.output_buffer.getvalue()
-                self.master.after(0, lambda: self.update_log(output.rstrip()))
-                self.output_buffer.truncate(0)
-                self.output_buffer.seek(0)
-                self._start_label_studio(label_studio_exe, script_dir)
-                self.master.after(0, self.enable_button)
-                return
-
-            print("conda_env が見つかりません。Conda 環境を構築します。")
-            self.output_buffer.seek(0)
-            output = self.output_buffer.getvalue()
-            self.master.after(0, lambda: self.update_log(output.rstrip()))
-            self.output_buffer.truncate(0)
-            self.output_buffer.seek(0)
-
-            env_name = "conda_env"
-            conda_bin = "conda"
-
-            try:
-                result = subprocess.run(
-                    [conda_bin, "env", "list"],
-                    capture_output=True,
-                    text=True,
-                    check=True,
-                    encoding="utf-8"
-                )
-                env_list = result.stdout
-                env_exists = any(f"{env_name} " in line or f"/{env_name}" in line for line in env_list.splitlines())
-            except subprocess.CalledProcessError as e:
-                self.master.after(0, lambda: messagebox.showerror("エラー", f"Conda環境の確認に失敗しました:\n{e}\nCondaが正しくインストールされているか確認してください。"))
-                self.stop_animation()
-                sys.stdout = self.original_stdout
-                self.master.after(0, self.disable_button)
-                return
-
-            python_exe = os.path.join(venv_dir, "python.exe" if os.name == "nt" else "bin/python")
-
-            if not env_exists or not os.path.isfile(python_exe):
-                try:
-                    print(f"Python 3.10.9 のConda環境を作成しています: {venv_dir}")
-                    self.output_buffer.seek(0)
-                    output = self.output_buffer.getvalue()
-                    self.master.after(0, lambda: self.update_log(output.rstrip()))
-                    self.output_buffer.truncate(0)
-                    self.output_buffer.seek(0)
-
-                    if os.path.exists(venv_dir):
-                        shutil.rmtree(venv_dir)
-                    subprocess.run(
-                        [conda_bin, "create", "-p", venv_dir, "python=3.10.9", "-c", "conda-forge", "-y"],
-                        check=True,
-                        capture_output=True,
-                        text=True,
-                        encoding="utf-8"
-                    )
-                    print("Conda環境の作成が完了しました。")
-                    self.output_buffer.seek(0)
-                    output = self.output_buffer.getvalue()
-                    self.master.after(0, lambda: self.update_log(output.rstrip()))
-                    self.output_buffer.truncate(0)
-                    self.output_buffer.seek(0)
-                except subprocess.CalledProcessError as e:
-                    error_msg = f"Conda環境の作成に失敗しました:\n{e}\n"
-                    if e.stdout:
-                        error_msg += f"標準出力: {e.stdout}\n"
-                    if e.stderr:
-                        error_msg += f"エラー出力: {e.stderr}\n"
-                    self.master.after(0, lambda: messagebox.showerror("エラー", error_msg))
-                    self.stop_animation()
-                    sys.stdout = self.original_stdout
-                    self.master.after(0, self.disable_button)
-                    return
-
-            try:
-                print("pipをアップグレードしています...")
-                self.output_buffer.seek(0)
-                output = self.output_buffer.getvalue()
-                self.master.after(0, lambda: self.update_log(output.rstrip()))
-                self.output_buffer.truncate(0)
-                self.output_buffer.seek(0)
-
-                result = subprocess.run(
-                    [python_exe, "-m", "pip", "install", "--upgrade", "pip"],
-                    check=True,
-                    capture_output=True,
-                    text=True,
-                    encoding="utf-8"
-                )
-                print("pipのアップグレードが完了しました。")
-                self.output_buffer.seek(0)
-                output = self.output_buffer.getvalue()
-                self.master.after(0, lambda: self.update_log(output.rstrip()))
-                self.output_buffer.truncate(0)
-                self.output_buffer.seek(0)
-            except subprocess.CalledProcessError as e:
-                error_msg = f"pipのアップグレードに失敗しました:\n{e}\n"
-                if e.stdout:
-                    error_msg += f"標準出力: {e.stdout}\n"
-                if e.stderr:
-                    error_msg += f"エラー出力: {e.stderr}"
-                self.master.after(0, lambda: messagebox.showerror("エラー", error_msg))
-                self.stop_animation()
-                sys.stdout = self.original_stdout
-                self.master.after(0, self.disable_button)
-                return
-
+            _, label_studio_exe = env_executables(venv_dir)
+            offline = OfflineEnvironment(os.path.join(script_dir, OFFLINE_DIR_NAME))
             try:
-                print("依存パッケージをCondaでインストールしています...")
-                self.output_buffer.seek(0)
-                output = self.output_buffer.getvalue()
-                self.master.after(0, lambda: self.update_log(output.rstrip()))
-                self.output_buffer.truncate(0)
-                self.output_buffer.seek(0)
-
-                dependencies = ["numpy", "pandas", "psycopg2", "pyyaml"]
-                subprocess.run(
-                    [conda_bin, "install", "-p", venv_dir, "-c", "conda-forge", "-y"] + dependencies,
-                    check=True,
-                    capture_output=True,
-                    text=True,
-                    encoding="utf-8"
-                )
-                print("依存パッケージのインストールが完了しました。")
-                self.output_buffer.seek(0)
-                output = self.output_buffer.getvalue()
-                self.master.after(0, lambda: self.update_log(output.rstrip()))
-                self.output_buffer.truncate(0)
-                self.output_buffer.seek(0)
-            except subprocess.CalledProcessError as e:
-                error_msg = f"依存パッケージのインストールに失敗しました:\n{e}\n"
-                if e.stdout:
-                    error_msg += f"標準出力: {e.stdout}\n"
-                if e.stderr:
-                    error_msg += f"エラー出力: {e.stderr}\n"
-                    error_msg += "Windows環境では Microsoft Visual C++ Build Tools が必要です。以下のリンクからインストールしてください:\n"
-                    error_msg += "https://visualstudio.microsoft.com/visual-cpp-build-tools/\n"
-                error_msg += "または、Condaで依存パッケージを再インストールしてみてください。"
-                self.master.after(0, lambda: messagebox.showerror("エラー", error_msg))
+                # env-provision と同じ経路で、足りない構築手順だけを実行する
+                provision_environment(venv_dir, offline, log=self.log, metrics=metrics)
+            except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+                error_msg = self._provision_error_message(e)
+                self.ui_queue.post(lambda: messagebox.showerror("エラー", error_msg))
                 self.stop_animation()
-                sys.stdout = self.original_stdout
-                self.master.after(0, self.disable_button)
+                self.ui_queue.post(self.disable_button, key="button")
                 return
 
-            if not os.path.isfile(label_studio_exe):
-                try:
-                    print("label-studioをインストールしています...")
-                    self.output_buffer.seek(0)
-                    output = self.output_buffer.getvalue()
-                    self.master.after(0, lambda: self.update_log(output.rstrip()))
-                    self.output_buffer.truncate(0)
-                    self.output_buffer.seek(0)
-
-                    result = subprocess.run(
-                        [python_exe, "-m", "pip", "install", "label-studio"],
-                        check=True,
-                        capture_output=True,
-                        text=True,
-                        encoding="utf-8"
-                    )
-                    print("label-studio のインストールが完了しました。")
-                    self.output_buffer.seek(0)
-                    output = self.output_buffer.getvalue()
-                    self.master.after(0, lambda: self.update_log(output.rstrip()))
-                    self.output_buffer.truncate(0)
-                    self.output_buffer.seek(0)
-                except subprocess.CalledProcessError as e:
-                    error_msg = f"label-studio のインストールに失敗しました:\n{e}\n"
-                    if e.stdout:
-                        error_msg += f"標準出力: {e.stdout}\n"
-                    if e.stderr:
-                        error_msg += f"エラー出力: {e.stderr}\n"
-                    if os.name == "nt":
-                        error_msg += "Windows環境では、Microsoft Visual C++ Build Toolsが必要です。以下のリンクからインストールしてください:\n"
-                        error_msg += "https://visualstudio.microsoft.com/visual-cpp-build-tools/\n"
-                    error_msg += "または、Condaで依存パッケージを再インストールしてみてください。"
-                    self.master.after(0, lambda: messagebox.showerror("エラー", error_msg))
-                    self.stop_animation()
-                    sys.stdout = self.original_stdout
-                    self.master.after(0, self.disable_button)
-                    return
-
-            self.conda_env_exists = os.path.exists(venv_dir) and os.path.isfile(label_studio_exe)
-            self.master.after(0, self.enable_button)
-            self._start_label_studio(label_studio_exe, script_dir)
+            self.conda_env_exists = os.path.isfile(label_studio_exe)
+            self.log("label-studio を起動します。")
+            self.ui_queue.post(self.enable_button, key="button")
+            self._start_label_studio(label_studio_exe, script_dir, metrics)
 
         except Exception as e:
-            self.master.after(0, lambda: messagebox.showerror("エラー", f"予期しないエラーが発生しました:\n{e}"))
-            print(f"デバッグ情報: {e}")
+            error_msg = f"予期しないエラーが発生しました:\n{e}"
+            self.ui_queue.post(lambda: messagebox.showerror("エラー", error_msg))
+            self.log(f"デバッグ情報: {e}")
             self.stop_animation()
-            sys.stdout = self.original_stdout
-            self.master.after(0, self.enable_button)
+            self.ui_queue.post(self.enable_button, key="button")
 
-    def _start_label_studio(self, label_studio_exe, script_dir):
+    def _start_label_studio(self, label_studio_exe, script_dir, metrics=None):
         """Label Studio を起動する共通ロジック"""
         try:
             if not os.path.isfile(label_studio_exe):
-                self.master.after(0, lambda: messagebox.showerror("エラー", f"label-studio 実行ファイルが見つかりません:\n{label_studio_exe}\nインストールが正しく完了していない可能性があります。"))
+                self.ui_queue.post(lambda: messagebox.showerror("エラー", f"label-studio 実行ファイルが見つかりません:\n{label_studio_exe}\nインストールが正しく完了していない可能性があります。"))
                 self.stop_animation()
-                sys.stdout = self.original_stdout
-                self.master.after(0, self.enable_button)
+                self.ui_queue.post(self.enable_button, key="button")
                 return
 
             env = os.environ.copy()
@@ -318,237 +4468,191 @@ class DashboardApp:
             env["LC_ALL"] = "C.UTF-8"
             env["LANG"] = "C.UTF-8"
 
-            creationflags = 0
-            if os.name == 'nt':
-                creationflags = subprocess.CREATE_NO_WINDOW | subprocess.CREATE_NEW_PROCESS_GROUP
-
-            # 変更点: 新しいプロセスを追跡しない（self.process に代入しない）
-            process = subprocess.Popen(
-                [label_studio_exe, "--port", "8081"],
-                cwd=script_dir,
-                env=env,
-                creationflags=creationflags,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-
-            def monitor_process():
-                stdout, stderr = process.communicate()
-                if process.poll() is not None:
-                    if process.returncode != 0:
-                        error_output = stderr if stderr else "不明なエラー"
-                        print(f"Label Studio 起動失敗 (終了コード {process.returncode}):\n{error_output}")
-                        self.master.after(0, lambda: self.update_log(f"Label Studio 起動失敗 (終了コード {process.returncode})"))
-                        self.master.after(0, lambda: messagebox.showerror("起動エラー", f"Label Studio の起動に失敗しました (終了コード {process.returncode}):\n{error_output}"))
-                    else:
-                        print("Label Studio プロセスが終了しました。")
-                        self.master.after(0, lambda: self.update_log("Label Studio プロセスが終了しました。"))
-                else:
-                    self.master.after(0, lambda: self.update_log("Label Studio を起動しました。localhost:8081 をご確認ください。"))
-                    self.master.after(0, lambda: messagebox.showinfo("情報", "Label Studio を起動しました。localhost:8081 をご確認ください。"))
-
-                self.stop_animation()
-                sys.stdout = self.original_stdout
-                self.master.after(0, self.enable_button)
-
-            threading.Thread(target=monitor_process, daemon=True).start()
+            if self.supervisor is None:
+                self.supervisor = LabelStudioSupervisor(None, self.log_pipeline, on_event=self._on_label_studio_event)
+            self.supervisor.command_factory = lambda port: [label_studio_exe, "--port", str(port)]
+            self.supervisor.cwd = script_dir
+            self.supervisor.env = env
+            # 変更点: 起動ごとに空いているポートで新しいインスタンスを起動し、監視役の一覧で追跡する
+            instance = self.supervisor.start()
+            if metrics:
+                self.launch_metrics[instance.id] = metrics
+            self.log(f"Label Studio をポート {instance.port} で起動しています...")
 
         except Exception as e:
-            self.master.after(0, lambda: messagebox.showerror("エラー", f"Label Studio の起動に失敗しました:\n{e}"))
-            print(f"デバッグ情報: {e}")
+            error_msg = f"Label Studio の起動に失敗しました:\n{e}"
+            self.ui_queue.post(lambda: messagebox.showerror("エラー", error_msg))
+            self.log(f"デバッグ情報: {e}")
+            self.stop_animation()
+            self.ui_queue.post(self.enable_button, key="button")
+
+    def _on_label_studio_event(self, event, instance):
+        """監視スレッドから呼ばれる。画面の操作は ui_queue で Tk のスレッドに渡す"""
+        if event == "ready":
+            message = f"Label Studio を起動しました ({instance.ready_seconds:.1f} 秒)。{instance.url} をご確認ください。"
+            self.log(message)
+            self.ui_queue.post(lambda: messagebox.showinfo("情報", message))
+        elif event == "failed":
+            error_output = "\n".join(self.log_pipeline.tail(f"label-studio:{instance.port}", 30)) or "不明なエラー"
+            self.log(f"Label Studio 起動失敗 (終了コード {instance.returncode})")
+            self.ui_queue.post(lambda: messagebox.showerror("起動エラー", f"Label Studio の起動に失敗しました (終了コード {instance.returncode}):\n{error_output}"))
+        elif event == "exited":
+            self.log("Label Studio プロセスが終了しました。")
+        if event in ("ready", "failed", "exited", "timeout"):
+            self._write_launch_metrics(event, instance)
             self.stop_animation()
-            sys.stdout = self.original_stdout
-            self.master.after(0, self.enable_button)
+            self.ui_queue.post(self.enable_button, key="button")
+
+    def _write_launch_metrics(self, event, instance):
+        metrics = self.launch_metrics.pop(instance.id, None)
+        if metrics is None:
+            return
+        if instance.ready_seconds is not None:
+            metrics.add_span("label_studio_ready", instance.ready_seconds)
+        metrics.count("restarts", instance.restarts)
+        metrics.finish("ok" if event == "ready" else event)
+        try:
+            metrics.write_json(os.path.join(app_dir(), LOG_DIR_NAME, f"launch{REPORT_SUFFIX}"))
+            if os.environ.get(METRICS_DIR_ENV):
+                metrics.write_prometheus(os.environ[METRICS_DIR_ENV])
+        except OSError as e:
+            self.log(f"⚠ 実行レポートの書き込みに失敗しました: {e}")
+        self.log(f"起動までの所要時間: {metrics.seconds:.1f} 秒 ("
+                 + ", ".join(f"{name} {seconds:.1f}s" for name, seconds in metrics.stage_totals().items()) + ")")
 
     def print_progress_inline(self):
         filled = int(25 * self.current_step / self.TOTAL_STEPS)
         bar = "█" * filled + "→" + "-" * (25 - filled)
         percent = int(self.current_step / self.TOTAL_STEPS * 100)
         log_message = f"[{bar}] {percent}%"
-        self.master.after(0, self.update_log, log_message)
-
-    def generate_yaml(self, base_dir):
-        try:
-            import yaml
-        except ImportError as e:
-            messagebox.showerror("エラー", f"yaml モジュールが見つかりません:\n{e}\n仮想環境を再構築してください。")
-            return
+        if self.file_total:
+            log_message += f" ({self.file_done:,}/{self.file_total:,} files)"
+        # 進捗は最新の 1 件だけを表示すればよいので key でまとめる
+        self.ui_queue.post(self.update_log, log_message, key="progress")
 
-        classes_path = os.path.join(base_dir, "classes.txt")
+    def _on_converter_progress(self, step, total):
+        self.current_step = step
+        self.TOTAL_STEPS = total
+        self.print_progress_inline()
 
-        if not os.path.isfile(classes_path):
-            self.master.after(0, self.update_log, "classes.txt が存在しないため、推測します。")
-            label_dir = os.path.join(base_dir, "train", "labels")
-            labels = set()
-            if os.path.isdir(label_dir):
-                for file in os.listdir(label_dir):
-                    if file.endswith(".txt"):
-                        file_path = os.path.join(label_dir, file)
-                        try:
-                            with open(file_path, "r", encoding="utf-8") as f:
-                                for line in f:
-                                    if line.strip():
-                                        cls_id = line.split()[0]
-                                        labels.add(cls_id)
-                        except Exception as e:
-                            self.master.after(0, self.update_log, f"⚠ ファイル {file} の読み込みに失敗しました: {e}")
-            if labels:
-                labels = sorted(labels, key=lambda x: int(x) if x.isdigit() else x)
-                try:
-                    with open(classes_path, "w", encoding="utf-8") as f:
-                        for label in labels:
-                            f.write(f"class_{label}\n")
-                except Exception as e:
-                    self.master.after(0, self.update_log, f"⚠ classes.txt の書き込みに失敗しました: {e}")
-                    return
-            else:
-                self.master.after(0, self.update_log, "⚠ ラベルが見つかりませんでした。classes.txt を作成できません。")
-                return
+    def _on_file_progress(self, done, total):
+        self.file_done = done
+        self.file_total = total
+        self.print_progress_inline()
 
-        classes = []
-        try:
-            with open(classes_path, "r", encoding="utf-8") as f:
-                classes = [line.strip() for line in f if line.strip()]
-        except Exception as e:
-            self.master.after(0, self.update_log, f"⚠ classes.txt の読み込みに失敗しました: {e}")
+    def run_label_converter_gui(self, before, after, **options):
+        if not before or not after:
+            messagebox.showerror("エラー", "Before/After のパスが未設定です。")
             return
+        threading.Thread(target=self._run_label_converter_thread, args=(before, after), kwargs=options, daemon=True).start()
 
-        if not classes:
-            self.master.after(0, self.update_log, "⚠ classes.txt が空です。")
+    def run_label_studio_export_gui(self, export_path, after, **options):
+        if not after:
+            messagebox.showerror("エラー", "After のパスが未設定です。")
             return
+        threading.Thread(target=self._run_label_converter_thread, args=(None, after), kwargs=dict(options, export_path=export_path),
+                         daemon=True).start()
 
-        data = {
-            "path": base_dir.replace("\\", "/"),
-            "train": "train/images",
-            "val": "val/images",
-            "nc": len(classes),
-            "names": classes
-        }
+    def run_merge_gui(self, before, after, **options):
+        if not before or not after:
+            messagebox.showerror("エラー", "Before/After のパスが未設定です。")
+            return
+        # Labels Before の直下のフォルダを 1 つずつのデータセットとして、名前順に統合する
+        with os.scandir(before) as it:
+            sources = sorted(entry.path for entry in it if entry.is_dir())
+        if not sources:
+            messagebox.showerror("エラー", "Before のフォルダに統合するデータセット (サブフォルダ) がありません。")
+            return
+        threading.Thread(target=self._run_label_converter_thread, args=(None, after),
+                         kwargs=dict(options, merge_sources=sources, merge_name=os.path.basename(before.rstrip("\\/"))), daemon=True).start()
 
-        output_yaml_path = os.path.join(base_dir, "data.yaml")
+    def _run_label_converter_thread(self, before, after, export_path=None, merge_sources=None, merge_name=None, **options):
+        converter = DatasetConverter(log=self.log,
+                                     progress=self._on_converter_progress,
+                                     file_progress=self._on_file_progress)
+        self.file_done = self.file_total = 0
+        self.ui_queue.reset_stats()
         try:
-            with open(output_yaml_path, "w", encoding="utf-8") as f:
-                yaml.dump(data, f, allow_unicode=True)
+            if export_path:
+                # Label Studio の JSON は Labels Done の下に YOLO データセットとして展開してから分割する
+                result = converter.convert_label_studio_export(export_path, after, **options)
+            elif merge_sources:
+                result = converter.merge_datasets(merge_sources, after, merge_name, **options)
+            else:
+                result = converter.split_yolo_dataset_with_clone(before, after, **options)
+            self._log_ui_latency()
+            if result.get("status") != "error":
+                self.log("変換と分割処理が正常に完了しました。")
         except Exception as e:
-            self.master.after(0, self.update_log, f"⚠ data.yaml の書き込みに失敗しました: {e}")
-            return
-
-        self.current_step += 1
-        self.print_progress_inline()
-        self.master.after(0, self.update_log, f"data.yaml output done: {output_yaml_path}")
+            self.log(f"処理に失敗しました:\n{e}")
+        finally:
+            self.file_total = 0
 
-    def find_folders(self, start_dir):
-        images_dir = None
-        labels_dir = None
-        for root, dirs, files in os.walk(start_dir):
-            if "images" in dirs:
-                images_dir = os.path.join(root, "images")
-            if "labels" in dirs:
-                labels_dir = os.path.join(root, "labels")
-            if images_dir and labels_dir and (images_dir.startswith(root) and labels_dir.startswith(root)):
-                break
-        return images_dir, labels_dir
-
-    def split_yolo_dataset_with_clone(self, source_dir, output_base_dir, split_ratio=0.7):
-        self.current_step = 0
-        self.print_progress_inline()
-        self.master.after(100)
-
-        original_name = os.path.basename(source_dir.rstrip("\\/"))
-        output_dir = os.path.join(output_base_dir, f"{original_name}_done")
-        os.makedirs(output_dir, exist_ok=True)
+    def toggle_watch(self, before, after, button, **options):
+        if self.watch_stop is not None:
+            self.watch_stop.set()
+            self.watch_stop = None
+            button.config(text="Watch: Off")
+            return
+        if not before or not after:
+            messagebox.showerror("エラー", "Before/After のパスが未設定です。")
+            return
+        self.watch_stop = threading.Event()
+        button.config(text="Watch: On")
+        threading.Thread(target=self._watch_thread, args=(before, after, self.watch_stop, button), kwargs=options, daemon=True).start()
 
+    def _watch_thread(self, before, after, stop_event, button, **options):
+        watcher = DatasetWatcher(before, after, options, log=self.log, progress=self._on_converter_progress)
         try:
-            for item in os.listdir(source_dir):
-                s = os.path.join(source_dir, item)
-                d = os.path.join(output_dir, item)
-                if os.path.isdir(s):
-                    shutil.copytree(s, d, dirs_exist_ok=True)
-                else:
-                    shutil.copy2(s, d)
+            watcher.run(stop_event)
         except Exception as e:
-            self.master.after(0, self.update_log, f"❌ ファイルの複製に失敗しました: {e}")
-            return
-
-        self.current_step += 1
-        self.print_progress_inline()
-        self.master.after(0, self.update_log, "複製完了")
+            self.log(f"監視を開始できませんでした:\n{e}")
+        if not stop_event.is_set() and self.watch_stop is stop_event:
+            self.watch_stop = None
+            self.ui_queue.post(lambda: button.winfo_exists() and button.config(text="Watch: Off"))
 
-        image_dir, label_dir = self.find_folders(output_dir)
-        if not image_dir or not label_dir:
-            self.master.after(0, self.update_log, "❌ 'images' または 'labels' フォルダが見つかりませんでした。")
+    def import_to_label_studio(self, source_dir):
+        if not source_dir:
+            messagebox.showerror("エラー", "Before のパスが未設定です。")
             return
-
-        train_image_dir = os.path.join(image_dir, "train")
-        val_image_dir = os.path.join(image_dir, "val")
-        train_label_dir = os.path.join(label_dir, "train")
-        val_label_dir = os.path.join(label_dir, "val")
-
-        valid_exts = (".jpg", ".jpeg", ".png")
-        image_files = [f for f in os.listdir(image_dir) if os.path.isfile(os.path.join(image_dir, f)) and f.lower().endswith(valid_exts)]
-
-        paired_files = []
-        unpaired_images = 0
-        label_files = {os.path.splitext(f)[0] for f in os.listdir(label_dir) if os.path.isfile(os.path.join(label_dir, f)) and f.lower().endswith(".txt")}
-
-        for img in image_files:
-            base, ext = os.path.splitext(img)
-            if base in label_files:
-                paired_files.append((base, ext))
-            else:
-                unpaired_images += 1
-
-        if unpaired_images > 0:
-            self.master.after(0, self.update_log, f"⚠ ラベルがない画像が {unpaired_images} 件見つかりました。（スキップ）")
-
-        if not paired_files:
-            self.master.after(0, self.update_log, "ラベル付き画像が見つからなかったので終了。")
+        token = os.environ.get(LABEL_STUDIO_API_KEY_ENV)
+        if not token:
+            messagebox.showerror("エラー", f"環境変数 {LABEL_STUDIO_API_KEY_ENV} に Label Studio の API トークン (Account & Settings で確認できます) を設定してください。")
             return
-
-        random.shuffle(paired_files)
-        split_idx = int(len(paired_files) * split_ratio)
-        train_set = paired_files[:split_idx]
-        val_set = paired_files[split_idx:]
-
-        def move_files(file_list, subset_image_dir, subset_label_dir, original_image_dir, original_label_dir):
-            os.makedirs(subset_image_dir, exist_ok=True)
-            os.makedirs(subset_label_dir, exist_ok=True)
-            for base, ext in file_list:
-                img_src = os.path.join(original_image_dir, base + ext)
-                lbl_src = os.path.join(original_label_dir, base + ".txt")
-
-                img_dst = os.path.join(subset_image_dir, base + ext)
-                lbl_dst = os.path.join(subset_label_dir, base + ".txt")
-
-                try:
-                    if os.path.exists(img_src):
-                        shutil.move(img_src, img_dst)
-                    if os.path.exists(lbl_src):
-                        shutil.move(lbl_src, lbl_dst)
-                except Exception as e:
-                    self.master.after(0, self.update_log, f"⚠ ファイルの移動に失敗しました ({base}{ext}): {e}")
-
-        move_files(train_set, train_image_dir, train_label_dir, image_dir, label_dir)
-        move_files(val_set, val_image_dir, val_label_dir, image_dir, label_dir)
-        self.current_step += 1
-        self.print_progress_inline()
-        self.master.after(0, self.update_log, f"アノテーション処理完了 Train {len(train_set)}件 / Val {len(val_set)}件")
-
-        self.generate_yaml(output_dir)
-
-    def run_label_converter_gui(self, before, after):
-        if not before or not after:
-            messagebox.showerror("エラー", "Before/After のパスが未設定です。")
+        instances = self.supervisor.instances(running_only=True) if self.supervisor else []
+        if not instances:
+            messagebox.showerror("エラー", "Label Studio が起動していません。")
             return
-        threading.Thread(target=self._run_label_converter_thread, args=(before, after), daemon=True).start()
+        # ローカルファイルの配信は登録するときだけ、登録するフォルダに限って有効にする
+        source_dir = os.path.abspath(source_dir)
+        for instance in reversed(instances):
+            document_root = local_files_root(self.supervisor.instance_env(instance) or os.environ)
+            if document_root and path_within(source_dir, document_root):
+                break
+        else:
+            document_root = source_dir
+            instance = self.supervisor.start(env=dict(zip(LS_LOCAL_FILES_ENV, ("true", source_dir))))
+            self.log(f"{source_dir} をローカルファイルとして配信する Label Studio をポート {instance.port} で起動します。")
+        threading.Thread(target=self._import_to_label_studio_thread, args=(instance, source_dir, token, document_root), daemon=True).start()
 
-    def _run_label_converter_thread(self, before, after):
+    def _import_to_label_studio_thread(self, instance, source_dir, token, document_root):
+        # 起動直後に押された場合は、応答するようになるまで待ってから送る
+        if wait_for_http(instance.url + LABEL_STUDIO_HEALTH_PATH, LABEL_STUDIO_READY_TIMEOUT, process=instance.process) is None:
+            self.log("❌ Label Studio が応答しないため、登録を中止しました。")
+            return
+        self.file_done = self.file_total = 0
         try:
-            self.split_yolo_dataset_with_clone(before, after)
-            self.master.after(0, self.update_log, "変換と分割処理が正常に完了しました。")
-        except Exception as e:
-            self.master.after(0, self.update_log, f"処理に失敗しました:\n{e}")
+            bulk_import_label_studio(LabelStudioClient(instance.url, token), source_dir, document_root=document_root, with_labels=True,
+                                     log=self.log, progress=self._on_file_progress)
+        except (OSError, RuntimeError, ValueError) as e:
+            self.log(f"❌ Label Studio への登録に失敗しました: {e}")
+        finally:
+            self.file_total = 0
+
+    def _log_ui_latency(self):
+        stats = self.ui_queue.stats()
+        self.log(f"UI 応答遅延: 平均 {stats['mean_ms']:.1f} ms / p95 {stats['p95_ms']:.1f} ms / 最大 {stats['max_ms']:.1f} ms "
+                 f"({stats['samples']} tick, 更新要求 {self.ui_queue.posted} 件)")
 
     def build_layout(self):
         self.top_bar = tk.Frame(self.master, bg="#282c34", height=50)
@@ -584,7 +4688,20 @@ class DashboardApp:
         self.clear_main_area()
         vars_ = {
             "labels_before": tk.StringVar(value=""),
-            "labels_done": tk.StringVar(value="")
+            "labels_done": tk.StringVar(value=""),
+            "clone_strategy": tk.StringVar(value="auto"),
+            "io_workers": tk.IntVar(value=DEFAULT_IO_WORKERS),
+            "incremental": tk.BooleanVar(value=True),
+            "virtual": tk.BooleanVar(value=False),
+            "kfold": tk.IntVar(value=0),
+            "split_ratio": tk.DoubleVar(value=0.7),
+            "stratify": tk.BooleanVar(value=False),
+            "validate": tk.BooleanVar(value=False),
+            "group_duplicates": tk.BooleanVar(value=False),
+            "shards": tk.StringVar(value="none"),
+            "preprocess": tk.StringVar(value="none"),
+            "preprocess_size": tk.IntVar(value=640),
+            "seed": tk.StringVar(value="")
         }
 
         def select_folder(var, label):
@@ -609,8 +4726,54 @@ class DashboardApp:
         label2.grid(row=3, column=0, sticky="ew")
         tk.Button(section, text="Select", command=lambda: select_folder(vars_["labels_done"], label2), bg="#3f51b5", fg="white", **btn_style).grid(row=3, column=1, padx=10)
 
+        option_frame = tk.Frame(section, bg="#1e1e2e")
+        option_frame.grid(row=4, column=0, columnspan=2, sticky="w", pady=(20, 0))
+        tk.Label(option_frame, text="Clone Mode", bg="#1e1e2e", fg="white", font=("Quicksand", 12)).pack(side="left")
+        clone_menu = tk.OptionMenu(option_frame, vars_["clone_strategy"], *CLONE_STRATEGIES)
+        clone_menu.config(bg="#2c2f38", fg="white", activebackground="#3b3f51", activeforeground="white", relief="flat", bd=0, highlightthickness=0)
+        clone_menu.pack(side="left", padx=10)
+        tk.Label(option_frame, text="I/O Threads", bg="#1e1e2e", fg="white", font=("Quicksand", 12)).pack(side="left", padx=(20, 0))
+        tk.Spinbox(option_frame, from_=1, to=64, width=4, textvariable=vars_["io_workers"], bg="#2c2f38", fg="white",
+                   buttonbackground="#3b3f51", relief="flat", bd=0).pack(side="left", padx=10)
+        tk.Checkbutton(option_frame, text="Incremental", variable=vars_["incremental"], bg="#1e1e2e", fg="white", selectcolor="#2c2f38",
+                       activebackground="#1e1e2e", activeforeground="white", bd=0, highlightthickness=0).pack(side="left", padx=(20, 0))
+        tk.Checkbutton(option_frame, text="Virtual", variable=vars_["virtual"], bg="#1e1e2e", fg="white", selectcolor="#2c2f38",
+                       activebackground="#1e1e2e", activeforeground="white", bd=0, highlightthickness=0).pack(side="left", padx=(10, 0))
+        tk.Label(option_frame, text="K-Fold", bg="#1e1e2e", fg="white", font=("Quicksand", 12)).pack(side="left", padx=(10, 0))
+        tk.Spinbox(option_frame, from_=0, to=20, width=3, textvariable=vars_["kfold"], bg="#2c2f38", fg="white",
+                   buttonbackground="#3b3f51", relief="flat", bd=0).pack(side="left", padx=10)
+        tk.Label(option_frame, text="Shards", bg="#1e1e2e", fg="white", font=("Quicksand", 12)).pack(side="left", padx=(10, 0))
+        shard_menu = tk.OptionMenu(option_frame, vars_["shards"], "none", *SHARD_FORMATS)
+        shard_menu.config(bg="#2c2f38", fg="white", activebackground="#3b3f51", activeforeground="white", relief="flat", bd=0, highlightthickness=0)
+        shard_menu.pack(side="left", padx=10)
+
+        split_frame = tk.Frame(section, bg="#1e1e2e")
+        split_frame.grid(row=5, column=0, columnspan=2, sticky="w", pady=(10, 0))
+        tk.Label(split_frame, text="Train Ratio", bg="#1e1e2e", fg="white", font=("Quicksand", 12)).pack(side="left")
+        tk.Spinbox(split_frame, from_=0.05, to=0.95, increment=0.05, width=5, textvariable=vars_["split_ratio"], bg="#2c2f38", fg="white",
+                   buttonbackground="#3b3f51", relief="flat", bd=0).pack(side="left", padx=10)
+        tk.Checkbutton(split_frame, text="Stratified", variable=vars_["stratify"], bg="#1e1e2e", fg="white", selectcolor="#2c2f38",
+                       activebackground="#1e1e2e", activeforeground="white", bd=0, highlightthickness=0).pack(side="left", padx=(20, 0))
+        tk.Checkbutton(split_frame, text="Validate", variable=vars_["validate"], bg="#1e1e2e", fg="white", selectcolor="#2c2f38",
+                       activebackground="#1e1e2e", activeforeground="white", bd=0, highlightthickness=0).pack(side="left", padx=(10, 0))
+        tk.Checkbutton(split_frame, text="Group Duplicates", variable=vars_["group_duplicates"], bg="#1e1e2e", fg="white", selectcolor="#2c2f38",
+                       activebackground="#1e1e2e", activeforeground="white", bd=0, highlightthickness=0).pack(side="left", padx=(10, 0))
+        tk.Label(split_frame, text="Seed", bg="#1e1e2e", fg="white", font=("Quicksand", 12)).pack(side="left", padx=(20, 0))
+        tk.Entry(split_frame, textvariable=vars_["seed"], width=8, bg="#2c2f38", fg="white", insertbackground="white",
+                 relief="flat", bd=0).pack(side="left", padx=10)
+
+        preprocess_frame = tk.Frame(section, bg="#1e1e2e")
+        preprocess_frame.grid(row=6, column=0, columnspan=2, sticky="w", pady=(10, 0))
+        tk.Label(preprocess_frame, text="Resize", bg="#1e1e2e", fg="white", font=("Quicksand", 12)).pack(side="left")
+        preprocess_menu = tk.OptionMenu(preprocess_frame, vars_["preprocess"], "none", *PREPROCESS_MODES)
+        preprocess_menu.config(bg="#2c2f38", fg="white", activebackground="#3b3f51", activeforeground="white", relief="flat", bd=0,
+                               highlightthickness=0)
+        preprocess_menu.pack(side="left", padx=10)
+        tk.Spinbox(preprocess_frame, from_=32, to=4096, increment=32, width=5, textvariable=vars_["preprocess_size"], bg="#2c2f38",
+                   fg="white", buttonbackground="#3b3f51", relief="flat", bd=0).pack(side="left", padx=10)
+
         btn_frame = tk.Frame(section, bg="#1e1e2e")
-        btn_frame.grid(row=4, column=0, columnspan=2, pady=40)
+        btn_frame.grid(row=7, column=0, columnspan=2, pady=40)
 
         self.label_studio_button = tk.Button(btn_frame, text="LabelStudio Launch", command=self.launch_label_studio, bg="#8e8ee5", fg="black",
                                             font=("Quicksand", 12, "bold"), relief="flat", bd=0, padx=30, pady=10)
@@ -629,32 +4792,880 @@ class DashboardApp:
         self.label_studio_button.bind("<ButtonPress-1>", on_button_click_press)
         self.label_studio_button.bind("<ButtonRelease-1>", on_button_click_release)
 
-        tk.Button(btn_frame, text="Convert val/train", command=lambda: self.run_label_converter_gui(vars_["labels_before"].get(), vars_["labels_done"].get()), bg="#26c6da", fg="black",
-                  font=("Quicksand", 12, "bold"), relief="flat", bd=0, padx=30, pady=10).pack(pady=10)
+        def split_options():
+            # 入力欄の値を検査し、不正な値があればダイアログで知らせて None を返す
+            try:
+                numbers = {name: vars_[name].get() for name in ("io_workers", "kfold", "split_ratio", "preprocess_size")}
+            except tk.TclError:
+                messagebox.showerror("エラー", "I/O Threads・K-Fold・Train Ratio・Resize には数値を入力してください。")
+                return None
+            seed = vars_["seed"].get().strip()
+            problems = []
+            if not 0 < numbers["split_ratio"] < 1:
+                problems.append("Train Ratio は 0 より大きく 1 より小さい値にしてください。")
+            if numbers["io_workers"] < 1:
+                problems.append("I/O Threads は 1 以上にしてください。")
+            if numbers["kfold"] < 0:
+                problems.append("K-Fold は 0 以上にしてください。")
+            if vars_["preprocess"].get() != "none" and numbers["preprocess_size"] < 1:
+                problems.append("Resize の大きさは 1 以上にしてください。")
+            if seed and not seed.isdigit():
+                problems.append("Seed は空欄か 0 以上の整数にしてください。")
+            if problems:
+                messagebox.showerror("エラー", "\n".join(problems))
+                return None
+            return dict(clone_strategy=vars_["clone_strategy"].get(), io_workers=numbers["io_workers"],
+                        incremental=vars_["incremental"].get(), virtual=vars_["virtual"].get(),
+                        kfold=numbers["kfold"], split_ratio=numbers["split_ratio"],
+                        stratify=vars_["stratify"].get(), validate=vars_["validate"].get(),
+                        group_duplicates=vars_["group_duplicates"].get(),
+                        shards=None if vars_["shards"].get() == "none" else vars_["shards"].get(),
+                        preprocess_size=None if vars_["preprocess"].get() == "none" else numbers["preprocess_size"],
+                        preprocess_mode=vars_["preprocess"].get(),
+                        seed=int(seed) if seed else None)
+
+        def with_split_options(action, *args):
+            options = split_options()
+            if options is not None:
+                action(*args, **options)
+
+        def convert_label_studio_export():
+            options = split_options()
+            if options is None:
+                return
+            export_path = filedialog.askopenfilename(title="Select Label Studio JSON", filetypes=[("JSON", "*.json"), ("All files", "*.*")])
+            if export_path:
+                self.run_label_studio_export_gui(export_path, vars_["labels_done"].get(), **options)
+
+        def toggle_watch():
+            # 監視を止めるときは入力欄の値を使わない
+            if self.watch_stop is not None:
+                self.toggle_watch(None, None, watch_button)
+            else:
+                with_split_options(self.toggle_watch, vars_["labels_before"].get(), vars_["labels_done"].get(), watch_button)
+
+        # 変換系のボタンは 2 列に並べ、画面の高さに収める
+        convert_frame = tk.Frame(btn_frame, bg="#1e1e2e")
+        convert_frame.pack()
+        action_style = {"fg": "black", "font": ("Quicksand", 12, "bold"), "relief": "flat", "bd": 0, "padx": 30, "pady": 10}
+        tk.Button(convert_frame, text="Convert val/train", command=lambda: with_split_options(self.run_label_converter_gui, vars_["labels_before"].get(),
+                                                                         vars_["labels_done"].get()), bg="#26c6da", **action_style).grid(row=0, column=0, padx=8, pady=8, sticky="ew")
+        watch_button = tk.Button(convert_frame, text="Watch: On" if self.watch_stop else "Watch: Off", command=toggle_watch, bg="#26c6da", **action_style)
+        watch_button.grid(row=0, column=1, padx=8, pady=8, sticky="ew")
+        tk.Button(convert_frame, text="Convert Label Studio JSON", command=convert_label_studio_export, bg="#26c6da",
+                  **action_style).grid(row=1, column=0, padx=8, pady=8, sticky="ew")
+        tk.Button(convert_frame, text="Import to Label Studio", command=lambda: self.import_to_label_studio(vars_["labels_before"].get()),
+                  bg="#8e8ee5", **action_style).grid(row=1, column=1, padx=8, pady=8, sticky="ew")
+        tk.Button(convert_frame, text="Merge Subfolders", command=lambda: with_split_options(self.run_merge_gui, vars_["labels_before"].get(),
+                                                                      vars_["labels_done"].get()), bg="#26c6da", **action_style).grid(row=2, column=0, padx=8, pady=8, sticky="ew")
 
         self.log_label = tk.Label(self.main_area, text="", bg="#1e1e2e", fg="white", font=("Quicksand", 10), wraplength=800)
         self.log_label.pack(pady=10)
 
     def on_closing(self):
-        if self.process and self.process.poll() is None:
-            try:
-                if os.name == 'nt':
-                    subprocess.run(["taskkill", "/F", "/T", "/PID", str(self.process.pid)], check=False, capture_output=True, text=True)
-                else:
-                    self.process.terminate()
-                    try:
-                        self.process.wait(timeout=5)
-                    except subprocess.TimeoutExpired:
-                        print(f"プロセスが5秒以内に終了しませんでした。強制終了します...")
-                        self.process.kill()
-                        self.process.wait()
-            except Exception as e:
-                print(f"プロセスの終了に失敗しました: {e}")
+        if self.watch_stop is not None:
+            self.watch_stop.set()
+        if self.supervisor:
+            self.supervisor.shutdown(timeout=5)
+        self.log_pipeline.close()
         self.master.destroy()
 
+
+def _synth_spec(images, image_size=(640, 480), labels_per_image=4.0, classes=10, unpaired_ratio=0.0, nested_depth=0, class_skew=1.0,
+                real_images=False, stub_bytes=4096, extras=3, seed=0):
+    return {"images": images, "image_size": list(image_size), "labels_per_image": labels_per_image, "classes": classes,
+            "unpaired_ratio": unpaired_ratio, "nested_depth": nested_depth, "class_skew": class_skew, "real_images": real_images,
+            "stub_bytes": stub_bytes, "extras": extras, "seed": seed}
+
+
+def _stub_jpeg(width, height, size, rng):
+    """Pillow なしで書ける灰色一色のベースライン JPEG。コメント (COM) で size バイト程度まで水増しする
+
+    各 8x8 ブロックは DC 差分 0 と EOB だけなので、記号が 1 つずつのハフマン表で 1 ブロック 2 ビット (00) になる。
+    """
+    import struct
+
+    def segment(marker, payload):
+        return b"\xff" + bytes([marker]) + struct.pack(">H", len(payload) + 2) + payload
+
+    blocks = -(-width // 8) * -(-height // 8)
+    bits = blocks * 2
+    scan = bytes(bits // 8)
+    if bits % 8:
+        # 最後のバイトの余りは 1 で埋める
+        scan += bytes([0xFF >> (bits % 8)])
+    one_code = bytes([1]) + bytes(15)
+    header = (b"\xff\xd8"
+              + segment(0xDB, b"\x00" + bytes([1]) * 64)
+              + segment(0xC0, struct.pack(">BHHB", 8, height, width, 1) + b"\x01\x11\x00")
+              + segment(0xC4, b"\x00" + one_code + b"\x00")
+              + segment(0xC4, b"\x10" + one_code + b"\x00"))
+    sos = segment(0xDA, b"\x01\x01\x00\x00\x3f\x00")
+    padding = b""
+    remaining = size - len(header) - len(sos) - len(scan) - 2
+    while remaining > 4:
+        chunk = min(remaining - 4, 65533)
+        padding += segment(0xFE, rng.randbytes(chunk))
+        remaining -= chunk + 4
+    return header + padding + sos + scan + b"\xff\xd9"
+
+
+def _synth_image_template(spec):
+    """画像 1 枚分のバイト列。real_images で Pillow があれば色付きの JPEG、それ以外は _stub_jpeg の灰色の JPEG"""
+    import io
+    import random
+
+    if spec["real_images"]:
+        try:
+            from PIL import Image
+        except ImportError:
+            warnings.warn("Pillow が見つからないため、灰色一色の画像を書き出します。")
+        else:
+            rng = random.Random(spec["seed"])
+            width, height = spec["image_size"]
+            image = Image.new("RGB", (width, height), tuple(rng.randrange(256) for _ in range(3)))
+            buffer = io.BytesIO()
+            image.save(buffer, format="JPEG", quality=85)
+            return buffer.getvalue()
+    width, height = spec["image_size"]
+    return _stub_jpeg(width, height, spec["stub_bytes"], random.Random(spec["seed"]))
+
+
+def _write_synth_chunk(images_dir, labels_dir, start, stop, spec, template, weights):
+    import random
+
+    # チャンクごとに乱数を分け、スレッド数によらず同じデータセットになるようにする
+    rng = random.Random(f"{spec['seed']}:{start}")
+    unpaired = 0
+    mean = spec["labels_per_image"]
+    for i in range(start, stop):
+        name = f"img_{i:08d}"
+        with open(os.path.join(images_dir, name + ".jpg"), "wb") as f:
+            # JPEG は EOI 以降を無視するので、末尾に番号を付けて内容ハッシュを画像ごとに変える
+            f.write(template)
+            f.write(i.to_bytes(8, "little"))
+        if rng.random() < spec["unpaired_ratio"]:
+            unpaired += 1
+            continue
+        count = rng.randint(0, max(0, int(round(mean * 2))))
+        rows = []
+        for cls_id in rng.choices(range(spec["classes"]), weights=weights, k=count):
+            w, h = rng.uniform(0.02, 0.5), rng.uniform(0.02, 0.5)
+            rows.append(f"{cls_id} {rng.uniform(w / 2, 1 - w / 2):.6f} {rng.uniform(h / 2, 1 - h / 2):.6f} {w:.6f} {h:.6f}\n")
+        with open(os.path.join(labels_dir, name + ".txt"), "w", encoding="utf-8") as f:
+            f.writelines(rows)
+    return unpaired
+
+
+def generate_synthetic_dataset(root, images=1000, image_size=(640, 480), labels_per_image=4.0, classes=10, unpaired_ratio=0.0,
+                               nested_depth=0, class_skew=1.0, real_images=False, stub_bytes=4096, extras=3, seed=0, io_workers=None):
+    """ベンチマーク用の YOLO データセットを root に作る
+
+    nested_depth 段の入れ子の下に images/labels を置き、浅い位置には labels のない images フォルダ (おとり) も作る。
+    class_skew が大きいほどクラスの出現頻度が偏る。同じ引数で作成済みなら作り直さない。引数が違えば作り直すが、
+    消すのはこのツールの synth.json があるフォルダか空のフォルダだけで、それ以外のフォルダが既にあれば ValueError。
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    spec = _synth_spec(images, image_size, labels_per_image, classes, unpaired_ratio, nested_depth, class_skew, real_images,
+                       stub_bytes, extras, seed)
+    spec_path = os.path.join(root, SYNTH_SPEC_NAME)
+    existing = None
+    try:
+        with open(spec_path, "r", encoding="utf-8") as f:
+            existing = json.load(f)
+    except (OSError, ValueError):
+        pass
+    if isinstance(existing, dict) and "spec" in existing:
+        if existing["spec"] == spec and not existing.get("incomplete"):
+            return existing
+    elif os.path.exists(root) and (not os.path.isdir(root) or os.listdir(root)):
+        # synth.json の無いフォルダはこのツールが作ったものではないので、消さずに止める
+        raise ValueError(f"{root} は合成データセットのフォルダではありません ({SYNTH_SPEC_NAME} がありません)。空のフォルダか新しいパスを指定してください")
+    if os.path.exists(root):
+        shutil.rmtree(root)
+
+    dataset_dir = os.path.join(root, *[f"level_{depth}" for depth in range(nested_depth)])
+    images_dir = os.path.join(dataset_dir, "images")
+    labels_dir = os.path.join(dataset_dir, "labels")
+    os.makedirs(images_dir)
+    os.makedirs(labels_dir)
+    # 作成中の目印を先に置き、中断したフォルダも次回このツールが作ったものとして作り直せるようにする
+    with open(spec_path, "w", encoding="utf-8") as f:
+        json.dump({"spec": spec, "incomplete": True}, f, ensure_ascii=False, indent=2)
+    if nested_depth:
+        os.makedirs(os.path.join(root, "preview", "images"))
+        with open(os.path.join(root, "preview", "images", "cover.png"), "wb") as f:
+            f.write(b"\x89PNG\r\n\x1a\n")
+    with open(os.path.join(dataset_dir, "classes.txt"), "w", encoding="utf-8") as f:
+        f.writelines(f"class_{cls_id}\n" for cls_id in range(classes))
+    for i in range(extras):
+        with open(os.path.join(dataset_dir, f"notes_{i}.txt"), "w", encoding="utf-8") as f:
+            f.write("synthetic dataset\n")
+
+    started = time.perf_counter()
+    template = _synth_image_template(spec)
+    weights = [1 / (cls_id + 1) ** class_skew for cls_id in range(classes)]
+    chunk = 1000
+    with ThreadPoolExecutor(max_workers=io_workers or DEFAULT_IO_WORKERS) as pool:
+        futures = [pool.submit(_write_synth_chunk, images_dir, labels_dir, start, min(start + chunk, images), spec, template, weights)
+                   for start in range(0, images, chunk)]
+        unpaired = sum(future.result() for future in futures)
+    info = {"spec": spec, "dataset_dir": dataset_dir, "unpaired": unpaired, "generate_seconds": round(time.perf_counter() - started, 3)}
+    # 完成した仕様ファイルは最後に書き、途中で中断したデータセットは次回作り直す
+    with open(spec_path, "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    return info
+
+
+def _bench_case(dataset_root, output_base_dir, clone_strategy, io_workers):
+    """1 つの規模について全件変換・差分なしの再変換・classes.txt 推測込みの generate_yaml を計測する。別プロセスで実行される"""
+    if os.path.exists(output_base_dir):
+        shutil.rmtree(output_base_dir)
+    converter = DatasetConverter()
+    started = time.perf_counter()
+    result = converter.split_yolo_dataset_with_clone(dataset_root, output_base_dir, clone_strategy=clone_strategy, io_workers=io_workers,
+                                                     incremental=False)
+    full_seconds = time.perf_counter() - started
+    stages = converter.metrics.stage_totals()
+
+    started = time.perf_counter()
+    converter.split_yolo_dataset_with_clone(dataset_root, output_base_dir, clone_strategy=clone_strategy, io_workers=io_workers)
+    incremental_seconds = time.perf_counter() - started
+
+    yaml_dir = os.path.join(output_base_dir, "yaml_bench")
+    os.makedirs(yaml_dir, exist_ok=True)
+    index = DatasetIndex(dataset_root)
+    started = time.perf_counter()
+    converter.generate_yaml(yaml_dir, index=index)
+    yaml_seconds = time.perf_counter() - started
+
+    metrics = {"full": full_seconds, "incremental": incremental_seconds, "generate_yaml": yaml_seconds}
+    metrics.update({f"stage.{name}": seconds for name, seconds in stages.items()})
+    return {
+        "status": result.get("status"),
+        "files": result.get("files", 0),
+        "files_per_sec": round(result.get("files", 0) / max(full_seconds, 1e-9), 1),
+        "peak_rss_bytes": peak_rss_bytes(),
+        "metrics": {name: round(seconds, 4) for name, seconds in metrics.items()},
+    }
+
+
+def _bench_machine():
+    import platform
+
+    return {"platform": platform.platform(), "machine": platform.machine(), "python": platform.python_version(), "cpus": os.cpu_count()}
+
+
+def compare_with_baseline(results, baseline, tolerance=BENCH_TOLERANCE, min_delta=BENCH_MIN_DELTA):
+    """規模ごとの計測値をベースラインと比べ、劣化した項目の一覧を返す"""
+    regressions = []
+    for size, case in results.items():
+        reference = baseline.get("cases", {}).get(str(size))
+        if not reference:
+            continue
+        for name, seconds in case["metrics"].items():
+            base = reference["metrics"].get(name)
+            if base is None:
+                continue
+            if seconds > base * (1 + tolerance) and seconds - base > min_delta:
+                regressions.append({"size": size, "metric": name, "baseline": base, "current": seconds,
+                                    "ratio": round(seconds / max(base, 1e-9), 2)})
+    return regressions
+
+
+def run_benchmark(sizes=BENCH_DEFAULT_SIZES, work_dir="mosaic-bench", baseline_path=None, update_baseline=False, tolerance=BENCH_TOLERANCE,
+                  clone_strategy="auto", io_workers=None, dataset_options=None, emit=print):
+    """規模ごとに合成データセットを用意して変換を計測し、ベースラインと比較する
+
+    各規模は新しいプロセスで計測するので、peak_rss_bytes はその規模だけの値になる。戻り値は (結果, 劣化の一覧)。
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    dataset_options = dataset_options or {}
+    results = {}
+    for size in sizes:
+        dataset_root = os.path.join(work_dir, f"synth_{size}")
+        info = generate_synthetic_dataset(dataset_root, images=size, io_workers=io_workers, **dataset_options)
+        emit({"event": "dataset", "size": size, "root": dataset_root, "generate_seconds": info["generate_seconds"]})
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            case = pool.submit(_bench_case, dataset_root, os.path.join(work_dir, f"out_{size}"), clone_strategy, io_workers).result()
+        results[size] = case
+        emit(dict(case, event="case", size=size))
+
+    baseline = {}
+    if baseline_path and os.path.isfile(baseline_path):
+        with open(baseline_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("machine") != _bench_machine():
+            emit({"event": "warning", "warning": "ベースラインは別の環境で計測されています。", "baseline_machine": baseline.get("machine")})
+    regressions = compare_with_baseline(results, baseline, tolerance)
+    for regression in regressions:
+        emit(dict(regression, event="regression"))
+
+    if baseline_path and update_baseline:
+        cases = dict(baseline.get("cases", {}))
+        cases.update({str(size): case for size, case in results.items()})
+        data = {"machine": _bench_machine(), "updated_at": time.time(), "dataset_options": dataset_options, "cases": cases}
+        tmp_path = baseline_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, baseline_path)
+    return results, regressions
+
+
+def _parse_size(text):
+    text = text.strip().lower()
+    scale = {"k": 1000, "m": 1000000}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+# CLI のワーカープロセスからイベントを親プロセスへ送るキュー
+_cli_queue = None
+
+
+def _emit_event(event):
+    if _cli_queue is not None:
+        _cli_queue.put(event)
+    else:
+        print(json.dumps(event, ensure_ascii=False), flush=True)
+
+
+def _init_cli_worker(queue):
+    global _cli_queue
+    _cli_queue = queue
+
+
+def _convert_dataset_job(source_dir, output_base_dir, options, quiet):
+    def log(message):
+        if not quiet:
+            _emit_event({"event": "log", "source": source_dir, "message": message})
+
+    def progress(step, total):
+        if not quiet:
+            _emit_event({"event": "progress", "source": source_dir, "step": step, "total": total})
+
+    started = time.perf_counter()
+    try:
+        result = DatasetConverter(log=log, progress=progress).split_yolo_dataset_with_clone(source_dir, output_base_dir, **options)
+    except Exception as e:
+        result = {"status": "error", "source_dir": source_dir, "error": f"{type(e).__name__}: {e}"}
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    # 結果も同じキューで送り、そのデータセットのログより後に出力されるようにする
+    _emit_event({"event": "result", **result})
+    return result
+
+
+def _drain_events(queue, results):
+    while True:
+        try:
+            event = queue.get_nowait()
+        except Exception:
+            return
+        if event.get("event") == "result":
+            results.append(event)
+        print(json.dumps(event, ensure_ascii=False), flush=True)
+
+
+def _cli_convert(args):
+    """複数のデータセットをプロセスプールで並列に変換し、進捗と結果を JSON Lines で標準出力に書く"""
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+    names = [os.path.basename(os.path.abspath(source)) for source in args.sources]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        _emit_event({"event": "error", "error": f"出力先が重複するフォルダ名があります: {', '.join(duplicates)}"})
+        return 2
+
+    options = _split_options(args)
+    jobs = max(1, args.jobs or min(len(args.sources), os.cpu_count() or 1))
+    os.makedirs(args.output, exist_ok=True)
+    started = time.perf_counter()
+    results = []
+    queue = multiprocessing.Queue()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_cli_worker, initargs=(queue,)) as pool:
+        futures = {pool.submit(_convert_dataset_job, source, args.output, options, args.quiet): source for source in args.sources}
+        remaining = set(futures)
+        while remaining:
+            done, remaining = wait(remaining, timeout=0.2, return_when=FIRST_COMPLETED)
+            _drain_events(queue, results)
+            for future in done:
+                if future.exception() is not None:
+                    result = {"event": "result", "status": "error", "source_dir": futures[future],
+                              "error": f"{type(future.exception()).__name__}: {future.exception()}"}
+                    results.append(result)
+                    print(json.dumps(result, ensure_ascii=False), flush=True)
+        # ワーカーからの送信が遅れて届く分を待つ
+        deadline = time.monotonic() + 5
+        while len(results) < len(futures) and time.monotonic() < deadline:
+            time.sleep(0.05)
+            _drain_events(queue, results)
+
+    failed = [result for result in results if result.get("status") == "error"]
+    print(json.dumps({
+        "event": "summary",
+        "total": len(results),
+        "ok": len(results) - len(failed),
+        "failed": len(failed),
+        "warnings": sum(1 for result in results if result.get("warning")),
+        "jobs": jobs,
+        "seconds": round(time.perf_counter() - started, 3),
+    }, ensure_ascii=False), flush=True)
+    return 1 if failed else 0
+
+
+def _split_options(args):
+    return {
+        "split_ratio": args.ratio,
+        "clone_strategy": args.clone_strategy,
+        "io_workers": args.io_workers,
+        "incremental": not args.full,
+        "virtual": args.virtual,
+        "kfold": args.kfold,
+        "stratify": args.stratify,
+        "seed": args.seed,
+        "metrics_dir": args.metrics_dir,
+        "validate": args.validate,
+        "cpu_workers": args.cpu_workers,
+        "group_duplicates": args.group_duplicates,
+        "duplicate_distance": args.duplicate_distance,
+        "shards": args.shards,
+        "shard_max_bytes": args.shard_mb * 1024 * 1024,
+        "preprocess_size": args.resize,
+        "preprocess_mode": args.resize_mode,
+    }
+
+
+def _cli_ls_convert(args):
+    """Label Studio の JSON / JSON-MIN 書き出しを YOLO データセットにし、続けて val/train に分割して結果を JSON Lines で出力する"""
+    log = (lambda message: None) if args.quiet else (lambda message: _emit_event({"event": "log", "message": message}))
+    progress = None if args.quiet else (lambda step, total: _emit_event({"event": "progress", "step": step, "total": total}))
+    options = _split_options(args)
+    dataset_dir = args.dataset or os.path.join(args.output, os.path.splitext(os.path.basename(args.export))[0])
+    if args.no_split:
+        try:
+            info = import_label_studio_export(args.export, dataset_dir, args.media_root or None, args.classes, options["clone_strategy"],
+                                              options["io_workers"], args.predictions, log=log)
+        except (OSError, ValueError) as e:
+            _emit_event({"event": "error", "error": str(e)})
+            return 1
+        _emit_event(dict(info, event="result", status="ok"))
+        return 0
+    result = DatasetConverter(log=log, progress=progress).convert_label_studio_export(args.export, args.output, dataset_dir,
+                                                                                      args.media_root or None, args.classes,
+                                                                                      args.predictions, **options)
+    _emit_event(dict(result, event="result"))
+    return 1 if result.get("status") == "error" else 0
+
+
+def _cli_merge(args):
+    """複数のデータセットをクラスを統合して 1 つにまとめ、続けて val/train に分割して結果を JSON Lines で出力する"""
+    log = (lambda message: None) if args.quiet else (lambda message: _emit_event({"event": "log", "message": message}))
+    progress = None if args.quiet else (lambda step, total: _emit_event({"event": "progress", "step": step, "total": total}))
+    options = _split_options(args)
+    if args.no_split:
+        try:
+            info = merge_yolo_datasets(args.sources, args.dataset or os.path.join(args.output, args.name), args.classes,
+                                       options["clone_strategy"], options["io_workers"], log=log)
+        except (OSError, ValueError) as e:
+            _emit_event({"event": "error", "error": str(e)})
+            return 1
+        _emit_event(dict(info, event="result", status="ok"))
+        return 0
+    result = DatasetConverter(log=log, progress=progress).merge_datasets(args.sources, args.output, args.name, args.dataset, args.classes,
+                                                                         **options)
+    _emit_event(dict(result, event="result"))
+    return 1 if result.get("status") == "error" else 0
+
+
+def _cli_ls_import(args):
+    """起動済みの Label Studio が応答するのを待ってから画像をまとめて登録し、結果と tasks/s を JSON Lines で出力する"""
+    token = args.token or os.environ.get(LABEL_STUDIO_API_KEY_ENV)
+    if not token:
+        _emit_event({"event": "error", "error": f"API トークンを --token か環境変数 {LABEL_STUDIO_API_KEY_ENV} で指定してください"})
+        return 2
+    waited = wait_for_http(args.url.rstrip("/") + LABEL_STUDIO_HEALTH_PATH, args.wait)
+    if waited is None:
+        _emit_event({"event": "error", "error": f"Label Studio が応答しません: {args.url}"})
+        return 1
+    log = (lambda message: None) if args.quiet else (lambda message: _emit_event({"event": "log", "message": message}))
+    progress = None if args.quiet else (lambda done, total: _emit_event({"event": "progress", "step": done, "total": total}))
+    client = LabelStudioClient(args.url, token, retries=args.retries)
+    try:
+        info = bulk_import_label_studio(client, args.source, args.project, args.title, args.mode, args.document_root, args.batch_size,
+                                        args.workers, args.with_labels, args.restart, log=log, progress=progress,
+                                        sync_timeout=args.sync_timeout)
+    except (OSError, RuntimeError, ValueError) as e:
+        _emit_event({"event": "error", "error": str(e)})
+        return 1
+    _emit_event(dict(info, event="result", status="error" if info.get("failed_batches") else "ok", wait_seconds=round(waited, 3)))
+    return 1 if info.get("failed_batches") else 0
+
+
+def _cli_watch(args):
+    """変換元フォルダを監視し、変換のたびに cycle イベント (検出から反映までの秒数を含む) を JSON Lines で出力する。Ctrl+C で終了"""
+    log = (lambda message: None) if args.quiet else (lambda message: _emit_event({"event": "log", "message": message}))
+    watcher = DatasetWatcher(args.source, args.output, _split_options(args), args.debounce, args.max_delay, args.poll_interval, args.backend,
+                             log=log, on_cycle=lambda cycle: _emit_event(dict(cycle, event="cycle")))
+    os.makedirs(args.output, exist_ok=True)
+    try:
+        watcher.run(max_cycles=args.cycles)
+    except KeyboardInterrupt:
+        pass
+    except (OSError, ValueError) as e:
+        _emit_event({"event": "error", "error": str(e)})
+        return 1
+    return 0
+
+
+def _default_venv_dir():
+    return os.path.join(app_dir(), "conda_env")
+
+
+def _cli_env_export(args):
+    venv_dir = args.env or _default_venv_dir()
+    output_dir = args.output or os.path.join(os.path.dirname(venv_dir), OFFLINE_DIR_NAME)
+    try:
+        seconds = export_offline_environment(venv_dir, output_dir, args.format, args.conda, log=lambda message: print(message, file=sys.stderr))
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+        _emit_event({"event": "error", "error": str(e)})
+        return 1
+    _emit_event({"event": "result", "status": "ok", "format": args.format, "output_dir": output_dir, "seconds": round(seconds, 3)})
+    return 0
+
+
+def _cli_env_provision(args):
+    venv_dir = args.env or _default_venv_dir()
+    offline = OfflineEnvironment(args.source or os.path.join(os.path.dirname(venv_dir), OFFLINE_DIR_NAME))
+    if offline.kind is None and not args.allow_online:
+        _emit_event({"event": "error", "error": f"オフライン用の成果物が見つかりません: {offline.root}"})
+        return 1
+    metrics = RunMetrics("provision")
+    status = "error"
+    try:
+        provision = provision_environment(venv_dir, offline, args.conda, log=lambda message: print(message, file=sys.stderr), metrics=metrics)
+        status = "ok"
+    except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+        _emit_event({"event": "error", "error": str(e)})
+        return 1
+    finally:
+        metrics.finish(status)
+        metrics_dir = args.metrics_dir or os.environ.get(METRICS_DIR_ENV)
+        if metrics_dir:
+            metrics.write_prometheus(metrics_dir)
+    _emit_event(dict(provision, event="result", status="ok", env=venv_dir, report=metrics.report()))
+    return 0
+
+
+def _synth_options(args):
+    return {"image_size": tuple(args.image_size), "labels_per_image": args.labels_per_image, "classes": args.classes,
+            "unpaired_ratio": args.unpaired_ratio, "nested_depth": args.nested_depth, "class_skew": args.class_skew,
+            "real_images": args.real_images, "seed": args.seed}
+
+
+def _cli_synth(args):
+    try:
+        info = generate_synthetic_dataset(args.output, images=_parse_size(args.images), io_workers=args.io_workers, **_synth_options(args))
+    except (OSError, ValueError) as e:
+        _emit_event({"event": "error", "error": str(e)})
+        return 1
+    _emit_event(dict(info, event="result", status="ok", root=args.output))
+    return 0
+
+
+def _cli_bench_startup(args):
+    """GUI を --runs 回起動し、プロセス開始からウィンドウ表示までの時間を JSON Lines で出力する"""
+    import shlex
+    import statistics
+    import tempfile
+
+    if args.command:
+        command = shlex.split(args.command, posix=os.name != "nt")
+    elif getattr(sys, "frozen", False):
+        command = [sys.executable]
+    else:
+        command = [sys.executable, os.path.abspath(__file__)]
+    timings = []
+    failures = 0
+    with tempfile.TemporaryDirectory(prefix="mosaic-startup-") as work_dir:
+        for run in range(1, args.runs + 1):
+            probe_path = os.path.join(work_dir, f"probe-{run}.json")
+            env = dict(os.environ, **{STARTUP_PROBE_ENV: probe_path})
+            launched = time.time()
+            process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                       text=True, encoding="utf-8", errors="replace")
+            try:
+                _, stderr = process.communicate(timeout=args.timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                _, stderr = process.communicate()
+            exited = time.time()
+            try:
+                with open(probe_path, "r", encoding="utf-8") as f:
+                    probe = json.load(f)
+            except (OSError, ValueError):
+                failures += 1
+                tail = stderr.strip().splitlines()[-5:]
+                _emit_event({"event": "error", "run": run, "returncode": process.returncode,
+                             "error": "ウィンドウが表示されませんでした (ディスプレイがない、または起動に失敗)", "stderr": tail})
+                continue
+            first_window_ms = round((probe["window_at"] - launched) * 1000, 1)
+            timings.append(first_window_ms)
+            _emit_event({"event": "run", "run": run, "first_window_ms": first_window_ms,
+                         "module_to_window_ms": probe["since_module_ms"], "exit_ms": round((exited - launched) * 1000, 1),
+                         "modules": probe["modules"], "heavy_modules": probe["heavy_modules"]})
+    summary = {"event": "summary", "command": command, "runs": args.runs, "failures": failures}
+    if timings:
+        summary.update(cold_ms=timings[0], min_ms=min(timings), median_ms=round(statistics.median(timings), 1), max_ms=max(timings))
+    _emit_event(summary)
+    return 0 if timings and not failures else 1
+
+
+def _cli_bench_shards(args):
+    """変換元を (既定では仮想分割で) 変換してシャードを作り、元のファイル配置とランダム読み込みの速度を比べる"""
+    log = (lambda message: None) if args.quiet else (lambda message: _emit_event({"event": "log", "message": message}))
+    converter = DatasetConverter(log=log)
+    result = converter.split_yolo_dataset_with_clone(args.source, args.output, virtual=not args.physical, seed=args.seed, shards=args.format,
+                                                     shard_max_bytes=args.shard_mb * 1024 * 1024)
+    if result.get("status") != "ok" or not result.get("shards"):
+        _emit_event({"event": "error", "error": result.get("error") or "シャードを作成できませんでした"})
+        return 1
+    original_name = os.path.basename(args.source.rstrip("\\/"))
+    manifest = ConversionManifest.load(os.path.join(args.output, f"{original_name}_done{MANIFEST_SUFFIX}"))
+    results = benchmark_shard_reads(result["shards"], args.source, manifest, args.samples, args.threads, args.repeat, args.seed)
+    for row in results:
+        _emit_event(dict(row, event="bench-shards", format=args.format, threads=args.threads))
+    last = {row["layout"]: row for row in results if row["run"] == args.repeat}
+    _emit_event({"event": "summary", "format": args.format, "samples": last["shards"]["samples"],
+                 "speedup": round(last["shards"]["samples_per_second"] / last["loose"]["samples_per_second"], 2)})
+    return 0
+
+
+def _cli_bench(args):
+    sizes = [_parse_size(size) for size in args.sizes.split(",") if size.strip()]
+    _, regressions = run_benchmark(sizes, args.work_dir, args.baseline, args.update_baseline, args.tolerance, args.clone_strategy,
+                                   args.io_workers, _synth_options(args), emit=_emit_event)
+    _emit_event({"event": "summary", "sizes": sizes, "regressions": len(regressions), "baseline": args.baseline})
+    return 1 if regressions and not args.update_baseline else 0
+
+
+def _add_synth_arguments(parser):
+    parser.add_argument("--image-size", type=int, nargs=2, default=(640, 480), metavar=("W", "H"), help="画像サイズ")
+    parser.add_argument("--labels-per-image", type=float, default=4.0, help="画像 1 枚あたりの平均ボックス数")
+    parser.add_argument("--classes", type=int, default=10)
+    parser.add_argument("--class-skew", type=float, default=1.0, help="クラス頻度の偏り (0 で均等)")
+    parser.add_argument("--unpaired-ratio", type=float, default=0.0, help="ラベルのない画像の割合")
+    parser.add_argument("--nested-depth", type=int, default=0, help="images/labels を置く入れ子の深さ")
+    parser.add_argument("--real-images", action="store_true", help="Pillow で色付きの JPEG を書き出す (既定は Pillow なしで書ける灰色一色の JPEG)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--io-workers", type=int, default=None)
+
+
+def _split_ratio(text):
+    import argparse
+
+    try:
+        value = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"数値ではありません: {text}")
+    if not 0 < value < 1:
+        raise argparse.ArgumentTypeError(f"0 より大きく 1 より小さい値にしてください: {text}")
+    return value
+
+
+def _add_split_arguments(parser):
+    parser.add_argument("--clone-strategy", choices=CLONE_STRATEGIES, default="auto",
+                        help="auto: reflink、できなければコピー / hardlink・symlink は元のファイルと実体を共有する")
+    parser.add_argument("--io-workers", type=int, default=None, help="データセットごとの I/O スレッド数")
+    parser.add_argument("--ratio", type=_split_ratio, default=0.7, help="train の割合 (0 より大きく 1 より小さい)")
+    parser.add_argument("--stratify", action="store_true", help="クラス別に層化して分割する")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--virtual", action="store_true", help="画像を配置せず train.txt/val.txt を出力する")
+    parser.add_argument("--kfold", type=int, default=0, help="--virtual 時に K-fold のリストも出力する")
+    parser.add_argument("--full", action="store_true", help="マニフェストを無視して全件やり直す")
+    parser.add_argument("--validate", action="store_true", help="分割の前に画像とラベルを検査し、不正なペアを <名前>_quarantine に複製して分割から外す")
+    parser.add_argument("--cpu-workers", type=int, default=None, help="検査・知覚ハッシュ・前処理に使うプロセス数 (既定: CPU 数)")
+    parser.add_argument("--resize", type=int, default=None, metavar="SIZE", help="画像をこの大きさ (px) に前処理してから配置する")
+    parser.add_argument("--resize-mode", choices=PREPROCESS_MODES, default="letterbox",
+                        help="letterbox: 正方形に縮小して余白を付けラベルも補正 / fit: 長辺を SIZE 以下に縮小")
+    parser.add_argument("--group-duplicates", action="store_true", help="近似重複の画像をまとめて同じ側 (train/val) に振り分ける")
+    parser.add_argument("--duplicate-distance", type=int, default=DUPLICATE_HAMMING_DISTANCE,
+                        help="近似重複とみなす知覚ハッシュのハミング距離")
+    parser.add_argument("--shards", choices=SHARD_FORMATS, default=None, help="分割後に train/val をシャードにまとめる (tar: WebDataset / packed: mmap 用)")
+    parser.add_argument("--shard-mb", type=int, default=SHARD_MAX_BYTES // (1024 * 1024), help="シャード 1 個の上限サイズ (MB)")
+    parser.add_argument("--metrics-dir", default=None, help=f"Prometheus の textfile を書き出すフォルダ (既定: 環境変数 {METRICS_DIR_ENV})")
+
+
+def build_cli_parser():
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="gui_runner", description="Mosaic Developer Tool (引数なしで GUI を起動します)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert = subparsers.add_parser("convert", help="YOLO データセットを val/train に分割して data.yaml を出力する")
+    convert.add_argument("sources", nargs="+", help="変換元フォルダ (Labels Before)。複数指定可")
+    convert.add_argument("-o", "--output", required=True, help="出力先フォルダ (Labels Done)")
+    convert.add_argument("-j", "--jobs", type=int, default=None, help="同時に処理するデータセット数 (プロセス数)")
+    _add_split_arguments(convert)
+    convert.add_argument("--quiet", action="store_true", help="log/progress イベントを出力しない")
+    convert.set_defaults(func=_cli_convert)
+
+    watch = subparsers.add_parser("watch", help="変換元フォルダを監視し、画像やラベルが保存されるたびに差分を val/train に反映する")
+    watch.add_argument("source", help="監視する変換元フォルダ (Labels Before)")
+    watch.add_argument("-o", "--output", required=True, help="出力先フォルダ (Labels Done)")
+    watch.add_argument("--backend", choices=WATCH_BACKENDS, default="auto", help="変更の検出方法 (auto: Linux では inotify、それ以外はポーリング)")
+    watch.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE_SECONDS, help="最後の変更からこの秒数だけ待ってから変換する")
+    watch.add_argument("--max-delay", type=float, default=WATCH_MAX_DELAY, help="保存が続いても、最初の変更からこの秒数で変換する")
+    watch.add_argument("--poll-interval", type=float, default=WATCH_POLL_INTERVAL, help="ポーリングの間隔 (秒)")
+    watch.add_argument("--cycles", type=int, default=None, help="初回の変換のあと、この回数だけ変換したら終了する")
+    _add_split_arguments(watch)
+    watch.add_argument("--quiet", action="store_true", help="log イベントを出力しない")
+    watch.set_defaults(func=_cli_watch)
+
+    merge = subparsers.add_parser("merge", help="複数の YOLO データセットをクラスを統合して 1 つにまとめ、続けて val/train に分割する")
+    merge.add_argument("sources", nargs="+", help="統合する変換元フォルダ。内容が同じ画像は先に指定したもののラベルを使う")
+    merge.add_argument("-o", "--output", required=True, help="出力先フォルダ (Labels Done)")
+    merge.add_argument("--name", default="merged", help="統合したデータセットの名前 (<出力先>/<名前> と <名前>_done を作る)")
+    merge.add_argument("--dataset", default=None, help="統合した YOLO データセットの置き場所 (既定: <出力先>/<名前>)")
+    merge.add_argument("--classes", default=None, help="クラス ID の順序を決める classes.txt (載っていないクラスは指定順に追加)")
+    merge.add_argument("--no-split", action="store_true", help="YOLO データセットへの統合だけ行う")
+    _add_split_arguments(merge)
+    merge.add_argument("--quiet", action="store_true", help="log/progress イベントを出力しない")
+    merge.set_defaults(func=_cli_merge)
+
+    ls_convert = subparsers.add_parser("ls-convert", help="Label Studio の JSON / JSON-MIN 書き出しを YOLO に変換し、続けて val/train に分割する")
+    ls_convert.add_argument("export", help="Label Studio で書き出した JSON / JSON-MIN ファイル")
+    ls_convert.add_argument("-o", "--output", required=True, help="出力先フォルダ (Labels Done)")
+    ls_convert.add_argument("--dataset", default=None, help="変換した YOLO データセットの置き場所 (既定: <出力先>/<JSON の名前>)")
+    ls_convert.add_argument("--media-root", action="append", default=[],
+                            help="画像を探すフォルダ。複数指定可 (既定: JSON のフォルダ、LOCAL_FILES_DOCUMENT_ROOT、Label Studio のデータフォルダ)")
+    ls_convert.add_argument("--classes", default=None, help="クラス ID の順序を決める classes.txt (載っていないクラスは出現順に追加)")
+    ls_convert.add_argument("--predictions", action="store_true", help="アノテーションのないタスクは予測 (predictions) を使う")
+    ls_convert.add_argument("--no-split", action="store_true", help="YOLO データセットへの変換だけ行う")
+    _add_split_arguments(ls_convert)
+    ls_convert.add_argument("--quiet", action="store_true", help="log/progress イベントを出力しない")
+    ls_convert.set_defaults(func=_cli_ls_convert)
+
+    ls_import = subparsers.add_parser("ls-import", help="画像フォルダを起動済みの Label Studio のプロジェクトにまとめて登録する")
+    ls_import.add_argument("source", help="登録する画像のフォルダ (labels と classes.txt があれば予測として取り込める)")
+    ls_import.add_argument("--url", default=f"http://localhost:{LABEL_STUDIO_BASE_PORT}", help="Label Studio の URL")
+    ls_import.add_argument("--token", default=None, help=f"API トークン (既定: 環境変数 {LABEL_STUDIO_API_KEY_ENV})")
+    ls_import.add_argument("--project", type=int, default=None, help="登録先のプロジェクト ID (既定: --title のプロジェクト、無ければ作成)")
+    ls_import.add_argument("--title", default=None, help="プロジェクト名 (既定: フォルダ名)")
+    ls_import.add_argument("--mode", choices=("tasks", "storage"), default="tasks",
+                           help="tasks: 画像を指すタスクをまとめてインポート / storage: ローカルファイルのストレージを登録して同期")
+    ls_import.add_argument("--document-root", default=None, help="Label Studio の LOCAL_FILES_DOCUMENT_ROOT (既定: 環境変数、無ければ登録するフォルダ)")
+    ls_import.add_argument("--sync-timeout", type=float, default=LS_STORAGE_SYNC_TIMEOUT, help="--mode storage で同期の完了を待つ秒数")
+    ls_import.add_argument("--batch-size", type=int, default=LS_IMPORT_BATCH_SIZE, help="1 リクエストで送るタスク数")
+    ls_import.add_argument("--workers", type=int, default=4, help="同時に送るリクエスト数 (接続数)")
+    ls_import.add_argument("--retries", type=int, default=LS_API_RETRIES, help="429・5xx・接続エラー時の再試行回数")
+    ls_import.add_argument("--with-labels", action="store_true", help="YOLO のラベルを予測 (predictions) として一緒に登録する")
+    ls_import.add_argument("--restart", action="store_true", help="登録済みの記録を無視して最初から送る")
+    ls_import.add_argument("--wait", type=float, default=LABEL_STUDIO_READY_TIMEOUT, help="Label Studio の応答を待つ秒数")
+    ls_import.add_argument("--quiet", action="store_true", help="log/progress イベントを出力しない")
+    ls_import.set_defaults(func=_cli_ls_import)
+
+    synth = subparsers.add_parser("synth", help="ベンチマーク用の合成 YOLO データセットを作成する")
+    synth.add_argument("output", help="作成先フォルダ")
+    synth.add_argument("-n", "--images", default="1k", help="画像数 (1k, 10k, 1M のように指定可)")
+    _add_synth_arguments(synth)
+    synth.set_defaults(func=_cli_synth)
+
+    bench = subparsers.add_parser("bench", help="合成データセットで変換を計測し、ベースラインと比較する")
+    bench.add_argument("--sizes", default=",".join(str(size) for size in BENCH_DEFAULT_SIZES), help="画像数のカンマ区切り (例: 1k,10k,100k,1M)")
+    bench.add_argument("--work-dir", default="mosaic-bench", help="データセットと出力の作業フォルダ")
+    bench.add_argument("--baseline", default="mosaic-bench-baseline.json", help="ベースラインの JSON")
+    bench.add_argument("--update-baseline", action="store_true", help="今回の結果でベースラインを更新する")
+    bench.add_argument("--tolerance", type=float, default=BENCH_TOLERANCE, help="劣化とみなす増加率")
+    bench.add_argument("--clone-strategy", choices=CLONE_STRATEGIES, default="auto")
+    _add_synth_arguments(bench)
+    bench.set_defaults(func=_cli_bench)
+
+    bench_shards = subparsers.add_parser("bench-shards", help="シャードと元のファイル配置のランダム読み込み速度を比べる")
+    bench_shards.add_argument("source", help="変換元フォルダ")
+    bench_shards.add_argument("-o", "--output", default=os.path.join("mosaic-bench", "shards"), help="変換とシャードの出力先")
+    bench_shards.add_argument("--format", choices=SHARD_FORMATS, default="packed")
+    bench_shards.add_argument("--shard-mb", type=int, default=SHARD_MAX_BYTES // (1024 * 1024), help="シャード 1 個の上限サイズ (MB)")
+    bench_shards.add_argument("--physical", action="store_true", help="仮想分割ではなく通常の変換 (ファイルの配置) を行う")
+    bench_shards.add_argument("--samples", type=int, default=5000, help="ランダムに読むサンプル数")
+    bench_shards.add_argument("--threads", type=int, default=1, help="読み込みのスレッド数 (DataLoader のワーカー数に相当)")
+    bench_shards.add_argument("--repeat", type=int, default=2, help="計測の回数 (2 回目以降はページキャッシュに載った状態)")
+    bench_shards.add_argument("--seed", type=int, default=0)
+    bench_shards.add_argument("--quiet", action="store_true", help="変換のログを出力しない")
+    bench_shards.set_defaults(func=_cli_bench_shards)
+
+    bench_startup = subparsers.add_parser("bench-startup", help="GUI を繰り返し起動し、ウィンドウ表示までの時間を計測する")
+    bench_startup.add_argument("--runs", type=int, default=5, help="起動する回数 (1 回目をコールドスタートとして別に出力)")
+    bench_startup.add_argument("--command", default=None, help="起動するコマンド (既定: このスクリプト、または EXE 自身)")
+    bench_startup.add_argument("--timeout", type=float, default=60, help="1 回あたりの待ち時間 (秒)")
+    bench_startup.set_defaults(func=_cli_bench_startup)
+
+    env_export = subparsers.add_parser("env-export", help="構築済みの conda_env をオフライン用の成果物として書き出す")
+    env_export.add_argument("--env", default=None, help="書き出す conda_env (既定: 実行ファイルと同じフォルダの conda_env)")
+    env_export.add_argument("-o", "--output", default=None, help=f"出力先フォルダ (既定: {OFFLINE_DIR_NAME})")
+    env_export.add_argument("--format", choices=("pack", "channel"), default="pack",
+                            help="pack: conda-pack のアーカイブ / channel: ローカルチャンネルと wheelhouse")
+    env_export.add_argument("--conda", default="conda", help="conda の実行ファイル")
+    env_export.set_defaults(func=_cli_env_export)
+
+    env_provision = subparsers.add_parser("env-provision", help="オフライン用の成果物から conda_env を用意し、所要時間を出力する")
+    env_provision.add_argument("--env", default=None, help="用意する conda_env (既定: 実行ファイルと同じフォルダの conda_env)")
+    env_provision.add_argument("--source", default=None, help=f"成果物のフォルダ (既定: {OFFLINE_DIR_NAME})")
+    env_provision.add_argument("--allow-online", action="store_true", help="成果物がなければ conda-forge と PyPI から構築する")
+    env_provision.add_argument("--conda", default="conda", help="conda の実行ファイル")
+    env_provision.add_argument("--metrics-dir", default=None, help=f"Prometheus の textfile を書き出すフォルダ (既定: 環境変数 {METRICS_DIR_ENV})")
+    env_provision.set_defaults(func=_cli_env_provision)
+    return parser
+
+
+def run_cli(argv):
+    args = build_cli_parser().parse_args(argv)
+    return args.func(args)
+
+
+def _load_tk():
+    """tkinter は GUI を開くときにだけ読み込む (CLI では読み込まない)"""
+    global tk, filedialog, messagebox, Font
+    import tkinter as tk
+    from tkinter import filedialog, messagebox
+    from tkinter.font import Font
+
+
+def _watch_first_window(root, app):
+    """ウィンドウが最初に表示されるまでの時間をログに残す。STARTUP_PROBE_ENV があれば結果を書き出して終了する"""
+    probe_path = os.environ.get(STARTUP_PROBE_ENV)
+
+    def on_map(event):
+        if event.widget is not root:
+            return
+        root.unbind("<Map>", binding)
+        since_module_ms = round((time.perf_counter() - _MODULE_STARTED) * 1000, 1)
+        heavy_modules = [name for name in STARTUP_HEAVY_MODULES if name in sys.modules]
+        app.log(f"ウィンドウ表示まで {since_module_ms:.0f} ms (読み込み済みモジュール {len(sys.modules)} 個)")
+        if not probe_path:
+            return
+        probe = {"window_at": time.time(), "since_module_ms": since_module_ms, "modules": len(sys.modules),
+                 "heavy_modules": heavy_modules, "frozen": bool(getattr(sys, "frozen", False))}
+        tmp_path = probe_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(probe, f)
+        os.replace(tmp_path, probe_path)
+        root.after(100, app.on_closing)
+
+    binding = root.bind("<Map>", on_map, add="+")
+
+
 def main():
+    if len(sys.argv) > 1:
+        import multiprocessing
+
+        multiprocessing.freeze_support()
+        sys.exit(run_cli(sys.argv[1:]))
+    _load_tk()
     root = tk.Tk()
     app = DashboardApp(root)
+    _watch_first_window(root, app)
     root.mainloop()
 
 if __name__ == "__main__":
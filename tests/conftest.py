@@ -0,0 +1,52 @@
+import importlib.util
+import os
+import random
+import socket
+import sys
+
+import pytest
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "gui_runner.Source.py")
+
+
+@pytest.fixture(scope="session")
+def gr():
+    """gui_runner.Source.py はファイル名にドットを含み import 文では読めないので、パスから読み込む"""
+    spec = importlib.util.spec_from_file_location("gui_runner", SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def free_port():
+    """OS に空いているポートを選ばせる (LABEL_STUDIO_BASE_PORT 付近の実際の Label Studio とぶつからないように)"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def jpeg(gr):
+    """Pillow なしでもデコードできる小さな JPEG を返す。seed ごとにコメント部分の内容 (ファイルのハッシュ) が変わる"""
+    return lambda seed=0, width=32, height=24: gr._stub_jpeg(width, height, 512, random.Random(seed))
+
+
+@pytest.fixture
+def make_dataset():
+    """root/images と root/labels にペアを書き出す。pairs は {画像のファイル名: (画像の bytes, ラベルの文字列)}"""
+    def make(root, pairs, classes=("a", "b", "c")):
+        for sub in ("images", "labels"):
+            os.makedirs(os.path.join(root, sub), exist_ok=True)
+        for name, (image, label) in pairs.items():
+            with open(os.path.join(root, "images", name), "wb") as f:
+                f.write(image)
+            with open(os.path.join(root, "labels", os.path.splitext(name)[0] + ".txt"), "w", encoding="utf-8") as f:
+                f.write(label)
+        if classes is not None:
+            with open(os.path.join(root, "classes.txt"), "w", encoding="utf-8") as f:
+                f.write("".join(name + "\n" for name in classes))
+        return str(root)
+
+    return make
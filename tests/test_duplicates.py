@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+
+def _brute_force_clusters(hashes, max_distance):
+    keys = [key for key, value in hashes.items() if value is not None]
+    parent = {key: key for key in keys}
+
+    def find(key):
+        while parent[key] != key:
+            key = parent[key]
+        return key
+
+    for a, first in enumerate(keys):
+        for second in keys[a + 1:]:
+            if bin(hashes[first] ^ hashes[second]).count("1") <= max_distance:
+                parent[find(second)] = find(first)
+    clusters = {}
+    for key in keys:
+        clusters.setdefault(find(key), []).append(key)
+    return sorted((sorted(members) for members in clusters.values() if len(members) > 1), key=lambda members: members[0])
+
+
+def _near_duplicate_hashes(seed, count=300):
+    # ランダムなハッシュに、数ビットだけ変えたもの・全く同じもの・読めなかった画像 (None) を混ぜる
+    rng = random.Random(seed)
+    hashes = {}
+    for i in range(count):
+        roll = rng.random()
+        if hashes and roll < 0.4:
+            value = rng.choice([value for value in hashes.values() if value is not None])
+            for _ in range(rng.randint(0, 12)):
+                value ^= 1 << rng.randrange(64)
+        elif roll < 0.45:
+            value = None
+        else:
+            value = rng.getrandbits(64)
+        hashes[f"img{i:03d}.jpg"] = value
+    return hashes
+
+
+@pytest.mark.parametrize("max_distance", [0, 1, 3, 6, 10])
+@pytest.mark.parametrize("seed", [0, 1, 2])
+def test_near_duplicates_match_brute_force(gr, seed, max_distance):
+    hashes = _near_duplicate_hashes(seed)
+
+    assert gr.find_near_duplicates(hashes, max_distance) == _brute_force_clusters(hashes, max_distance)
+
+
+def test_near_duplicates_chain_transitively(gr):
+    # a-b, b-c はそれぞれ距離 2 だが a-c は距離 4 でも、同じクラスタにまとまる
+    hashes = {"a": 0b0000, "b": 0b0011, "c": 0b1111, "far": (1 << 64) - 1, "broken": None}
+
+    assert gr.find_near_duplicates(hashes, 2) == [["a", "b", "c"]]
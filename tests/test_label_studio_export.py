@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+ITEMS = [
+    {"id": 1, "data": {"image": "/data/local-files/?d=a/b],c.jpg"}, "note": "括弧 [ ] と { } と \"引用符\" と \\ を含む"},
+    [],
+    {},
+    "], {",
+    1234567890.125,
+    -0.5e-10,
+    [True, False, None, {"nested": [1, [2, [3]]]}],
+    {"emoji": "\U0001F600", "escaped": "é\n\t"},
+]
+
+
+@pytest.mark.parametrize("chunk_chars", [1, 2, 3, 5, 7, 16, 4096])
+def test_iter_json_array_handles_tokens_split_across_chunks(gr, tmp_path, chunk_chars):
+    path = tmp_path / "export.json"
+    # 読み込みは utf-8-sig なので BOM 付きでも読める
+    path.write_text("\ufeff [\n" + " ,\r\n ".join(json.dumps(item, ensure_ascii=False) for item in ITEMS) + "\n] \n", encoding="utf-8")
+
+    assert list(gr.iter_json_array(str(path), chunk_chars)) == ITEMS
+
+
+@pytest.mark.parametrize("text", ["[]", " [ ] "])
+def test_iter_json_array_reads_empty_arrays(gr, tmp_path, text):
+    path = tmp_path / "export.json"
+    path.write_text(text, encoding="utf-8")
+
+    assert list(gr.iter_json_array(str(path), 1)) == []
+
+
+@pytest.mark.parametrize("text, message", [
+    ('{"id": 1}', "配列ではありません"),
+    ('[{"id": 1}, {"id": 2', "途中で終わっています|解析できません"),
+    ('[{"id": 1}, 12', "途中で終わっています|解析できません"),
+    ('[{"id": 1} {"id": 2}]', "解析できません"),
+])
+def test_iter_json_array_rejects_broken_files(gr, tmp_path, text, message):
+    path = tmp_path / "export.json"
+    path.write_text(text, encoding="utf-8")
+
+    with pytest.raises(ValueError, match=message):
+        list(gr.iter_json_array(str(path), 3))
+
+
+def _task(task_id, image, label):
+    return {"id": task_id, "data": {"image": f"/data/local-files/?d={image}"},
+            "annotations": [{"id": task_id, "result": [{"type": "rectanglelabels", "original_width": 32, "original_height": 24,
+                                                         "value": {"x": 0, "y": 0, "width": 50, "height": 50, "rectanglelabels": [label]}}]}]}
+
+
+def test_import_gives_each_task_a_unique_name(gr, tmp_path, jpeg):
+    # 同じ ID のタスクやフォルダ違いの同名画像が、既に使われた名前 (2_a) とぶつかっても上書きせずに別名で書き出す
+    media = tmp_path / "media"
+    images = {"x/2_a.jpg": jpeg(0), "x/a.jpg": jpeg(1), "y/a.jpg": jpeg(2), "z/a.jpg": jpeg(3)}
+    for ref, data in images.items():
+        (media / os.path.dirname(ref)).mkdir(parents=True, exist_ok=True)
+        (media / ref).write_bytes(data)
+    tasks = [_task(2, "x/2_a.jpg", "p"), _task(1, "x/a.jpg", "q"), _task(2, "y/a.jpg", "r"), _task(2, "z/a.jpg", "s")]
+    (tmp_path / "export.json").write_text(json.dumps(tasks), encoding="utf-8")
+    dataset = tmp_path / "dataset"
+
+    info = gr.import_label_studio_export(str(tmp_path / "export.json"), str(dataset), [str(media)], io_workers=2, log=lambda message: None)
+
+    assert info["tasks"] == 4
+    written = sorted(os.listdir(dataset / "images"))
+    assert len(written) == 4
+    assert sorted(os.listdir(dataset / "labels")) == sorted(name.replace(".jpg", ".txt") for name in written)
+    # 画像とラベルの組み合わせが入れ替わっていない (クラス ID はラベル名の出現順)
+    class_of_image = {data: class_id for class_id, data in enumerate(images.values())}
+    for name in written:
+        label = (dataset / "labels" / name.replace(".jpg", ".txt")).read_text(encoding="utf-8")
+        assert int(label.split()[0]) == class_of_image[(dataset / "images" / name).read_bytes()]
@@ -0,0 +1,230 @@
+import http.server
+import json
+import os
+import threading
+
+import pytest
+
+
+class StubLabelStudio:
+    """Label Studio の API のうち一括登録で使う部分だけをまねる HTTP サーバー
+
+    failures に積んだ (ステータス, ヘッダ) を import の呼び出しに先頭から順に返し、fail_images に含まれる画像のバッチは毎回 500 で失敗させる。
+    token が JWT のときは /api/token/refresh で発行した最新のアクセストークンだけを受け付ける。
+    """
+
+    def __init__(self, token="secret"):
+        self.token = token
+        self.access = None
+        self.refreshes = 0
+        self.failures = []
+        self.fail_images = set()
+        self.import_calls = 0
+        self.imported = []
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def expire_access(self):
+        with self.lock:
+            self.access = None
+
+    def images(self):
+        return sorted(os.path.basename(image) for image in self.imported)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, headers=None):
+                payload = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _authorized(self):
+                header = self.headers.get("Authorization", "")
+                with stub.lock:
+                    if stub.token.count(".") == 2:
+                        return stub.access is not None and header == f"Bearer {stub.access}"
+                    return header == f"Token {stub.token}"
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"null")
+                if self.path == "/api/token/refresh":
+                    if body.get("refresh") != stub.token:
+                        return self._reply(401, {"detail": "invalid refresh token"})
+                    with stub.lock:
+                        stub.refreshes += 1
+                        stub.access = f"access-{stub.refreshes}"
+                        return self._reply(200, {"access": stub.access})
+                if not self._authorized():
+                    return self._reply(401, {"detail": "token expired"})
+                if self.path.startswith("/api/projects/") and self.path.endswith("/import"):
+                    with stub.lock:
+                        stub.import_calls += 1
+                        failure = stub.failures.pop(0) if stub.failures else None
+                        images = [task["data"]["image"] for task in body]
+                        if failure is None and stub.fail_images.intersection(os.path.basename(image) for image in images):
+                            failure = (500, {})
+                        if failure is None:
+                            stub.imported.extend(images)
+                    if failure is not None:
+                        return self._reply(failure[0], {"detail": "failure"}, failure[1])
+                    return self._reply(201, {"task_count": len(body)})
+                self._reply(404, {"detail": "not found"})
+
+        return Handler
+
+
+@pytest.fixture
+def stub_server():
+    servers = []
+
+    def start(token="secret"):
+        server = StubLabelStudio(token)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+@pytest.fixture(autouse=True)
+def fast_backoff(gr, monkeypatch):
+    monkeypatch.setattr(gr, "LS_API_BACKOFF_BASE", 0.01)
+
+
+@pytest.fixture
+def image_dir(tmp_path):
+    images = tmp_path / "batch01" / "images"
+    images.mkdir(parents=True)
+    for i in range(7):
+        (images / f"img{i}.jpg").write_bytes(b"\xff\xd8\xff\xd9")
+    return images.parent
+
+
+def _import(gr, server, source_dir, **kwargs):
+    client = gr.LabelStudioClient(server.url, server.token, retries=kwargs.pop("retries", 0))
+    return gr.bulk_import_label_studio(client, str(source_dir), project=1, document_root=str(source_dir), batch_size=2, workers=1,
+                                       log=lambda message: None, **kwargs)
+
+
+def test_client_retries_rate_limit_and_server_errors(gr, stub_server):
+    server = stub_server()
+    server.failures = [(429, {"Retry-After": "0"}), (503, {}), (502, {})]
+    client = gr.LabelStudioClient(server.url, "secret", retries=3)
+
+    response = client.request("POST", "/api/projects/1/import", [{"data": {"image": "a.jpg"}}])
+
+    assert response == {"task_count": 1}
+    assert client.retried == 3
+    assert server.import_calls == 4
+    assert server.imported == ["a.jpg"]
+
+
+def test_client_gives_up_after_retries(gr, stub_server):
+    server = stub_server()
+    server.failures = [(503, {})] * 3
+    client = gr.LabelStudioClient(server.url, "secret", retries=2)
+
+    with pytest.raises(RuntimeError, match="3 回失敗"):
+        client.request("POST", "/api/projects/1/import", [{"data": {"image": "a.jpg"}}])
+    assert server.import_calls == 3
+    assert server.imported == []
+
+
+def test_client_does_not_retry_client_errors(gr, stub_server):
+    server = stub_server()
+    server.failures = [(400, {})]
+    client = gr.LabelStudioClient(server.url, "secret", retries=3)
+
+    with pytest.raises(RuntimeError, match="HTTP 400"):
+        client.request("POST", "/api/projects/1/import", [{"data": {"image": "a.jpg"}}])
+    assert server.import_calls == 1
+    assert client.retried == 0
+
+
+def test_client_refreshes_expired_access_token(gr, stub_server):
+    server = stub_server(token="header.payload.signature")
+    client = gr.LabelStudioClient(server.url, server.token, retries=0)
+
+    client.request("POST", "/api/projects/1/import", [{"data": {"image": "a.jpg"}}])
+    server.expire_access()
+    client.request("POST", "/api/projects/1/import", [{"data": {"image": "b.jpg"}}])
+
+    # 401 を受けたらアクセストークンを交換し直し、再試行の回数は使わずにやり直す
+    assert server.refreshes == 2
+    assert client.retried == 0
+    assert server.imported == ["a.jpg", "b.jpg"]
+
+
+def test_bulk_import_resumes_failed_batches(gr, stub_server, image_dir):
+    server = stub_server()
+    server.fail_images = {"img2.jpg"}
+
+    first = _import(gr, server, image_dir)
+
+    assert first["failed_batches"] == 1
+    assert first["tasks"] == 5
+    assert os.path.exists(gr.import_state_path(str(image_dir), server.url, 1))
+
+    server.fail_images = set()
+    second = _import(gr, server, image_dir)
+
+    assert second["skipped"] == 5
+    assert second["tasks"] == 2
+    assert second["failed_batches"] == 0
+    assert server.images() == [f"img{i}.jpg" for i in range(7)]
+
+
+def test_bulk_import_restart_sends_everything_again(gr, stub_server, image_dir):
+    server = stub_server()
+    _import(gr, server, image_dir)
+
+    info = _import(gr, server, image_dir, restart=True)
+
+    assert info["skipped"] == 0
+    assert info["tasks"] == 7
+    assert len(server.imported) == 14
+
+
+def test_bulk_import_state_is_kept_per_server(gr, stub_server, image_dir):
+    first, second = stub_server(), stub_server()
+    _import(gr, first, image_dir)
+
+    # 別のサーバーの同じ ID のプロジェクトへは、登録済みの記録を使わずに全件を送る
+    info = _import(gr, second, image_dir)
+
+    assert info["skipped"] == 0
+    assert info["tasks"] == 7
+    assert second.images() == [f"img{i}.jpg" for i in range(7)]
+
+
+def test_bulk_import_retries_transient_errors_within_a_run(gr, stub_server, image_dir):
+    server = stub_server()
+    server.failures = [(429, {"Retry-After": "0"}), (503, {})]
+
+    info = _import(gr, server, image_dir, retries=2)
+
+    assert info["failed_batches"] == 0
+    assert info["tasks"] == 7
+    assert info["retries"] == 2
+    assert server.images() == [f"img{i}.jpg" for i in range(7)]
@@ -0,0 +1,197 @@
+import os
+import signal
+import sys
+import threading
+import time
+import urllib.request
+
+import pytest
+
+# Label Studio の代わりに起動する HTTP サーバー。カウンタファイルで起動回数を数え、crashes 回目までは終了コード 3 で落ちる
+FAKE_SERVER = '''
+import http.server
+import os
+import signal
+import sys
+import time
+
+port, counter, crashes, mode = int(sys.argv[1]), sys.argv[2], int(sys.argv[3]), sys.argv[4]
+with open(counter, "a") as f:
+    f.write("x")
+runs = os.path.getsize(counter)
+print(f"run {runs}", flush=True)
+if runs <= crashes:
+    sys.exit(3)
+if mode == "ignore-term":
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+# 起動に時間がかかる様子をまねる
+time.sleep(0.3)
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+http.server.HTTPServer(("127.0.0.1", port), Handler).serve_forever()
+'''
+
+
+class EventRecorder:
+    """on_event の呼び出しを時刻つきで記録し、特定のイベントを待てるようにする"""
+
+    def __init__(self):
+        self.items = []
+        self.condition = threading.Condition()
+
+    def __call__(self, event, instance):
+        with self.condition:
+            self.items.append((event, time.monotonic()))
+            self.condition.notify_all()
+
+    def names(self):
+        return [event for event, _ in self.items]
+
+    def times(self, event):
+        return [at for name, at in self.items if name == event]
+
+    def wait_for(self, event, count=1, timeout=30):
+        with self.condition:
+            reached = self.condition.wait_for(lambda: self.names().count(event) >= count, timeout)
+        assert reached, f"{event} を {count} 回待ちましたが届きませんでした: {self.names()}"
+
+
+@pytest.fixture
+def make_supervisor(gr, tmp_path, free_port):
+    script = tmp_path / "fake_label_studio.py"
+    script.write_text(FAKE_SERVER, encoding="utf-8")
+    created = []
+
+    def make(crashes=0, mode="serve"):
+        counter = tmp_path / f"runs-{len(created)}"
+        events = EventRecorder()
+        pipeline = gr.LogPipeline()
+        supervisor = gr.LabelStudioSupervisor(lambda port: [sys.executable, str(script), str(port), str(counter), str(crashes), mode],
+                                              pipeline, on_event=events, ready_timeout=20, base_port=free_port)
+        created.append((supervisor, pipeline))
+        return supervisor, events, pipeline
+
+    yield make
+    for supervisor, pipeline in created:
+        supervisor.shutdown(timeout=5)
+        pipeline.close()
+
+
+def test_start_reports_ready_once_health_responds(make_supervisor, free_port):
+    supervisor, events, _ = make_supervisor()
+    instance = supervisor.start()
+    events.wait_for("ready")
+
+    assert events.names()[:2] == ["starting", "ready"]
+    assert instance.state == "ready"
+    assert instance.port == free_port
+    assert instance.ready_seconds is not None and instance.ready_seconds > 0
+    assert instance.snapshot()["pid"] == instance.process.pid
+    with urllib.request.urlopen(instance.url + "/health", timeout=5) as response:
+        assert response.status == 200
+
+
+def test_crashed_instance_restarts_with_backoff(gr, make_supervisor, monkeypatch):
+    monkeypatch.setattr(gr, "RESTART_BACKOFF_BASE", 0.2)
+    supervisor, events, pipeline = make_supervisor(crashes=2)
+    instance = supervisor.start()
+    events.wait_for("ready")
+
+    assert events.names().count("restarting") == 2
+    assert instance.restarts == 2
+    assert instance.consecutive_failures == 2
+    # 再起動までの待ち時間は 0.2 秒, 0.4 秒と倍になる
+    restarting, starting = events.times("restarting"), events.times("starting")
+    for delay, crashed_at, restarted_at in zip((0.2, 0.4), restarting, starting[1:]):
+        assert restarted_at - crashed_at >= delay * 0.9
+    pipeline.close()
+    assert any("終了コード 3" in line for line in pipeline.tail(source="app"))
+
+
+def test_gives_up_after_max_restart_attempts(gr, make_supervisor, monkeypatch):
+    monkeypatch.setattr(gr, "RESTART_BACKOFF_BASE", 0.05)
+    monkeypatch.setattr(gr, "RESTART_MAX_ATTEMPTS", 2)
+    supervisor, events, _ = make_supervisor(crashes=100)
+    instance = supervisor.start()
+    events.wait_for("failed")
+    instance.thread.join(timeout=5)
+
+    assert instance.state == "failed"
+    assert instance.restarts == 2
+    assert instance.returncode == 3
+    assert "ready" not in events.names()
+
+
+def test_fails_when_no_port_is_free_for_restart(gr, make_supervisor, monkeypatch):
+    monkeypatch.setattr(gr, "RESTART_BACKOFF_BASE", 0.5)
+    supervisor, events, pipeline = make_supervisor(crashes=100)
+    instance = supervisor.start()
+    events.wait_for("restarting")
+
+    def no_free_port(*args, **kwargs):
+        raise OSError("空いているポートがありません")
+
+    # 最初の起動の後は元のポートも範囲内の他のポートも使えない
+    monkeypatch.setattr(gr, "find_free_port", no_free_port)
+    events.wait_for("failed")
+    instance.thread.join(timeout=5)
+
+    assert instance.state == "failed"
+    assert not instance.thread.is_alive()
+    assert events.names().count("starting") == 1
+    pipeline.close()
+    assert any("再起動できませんでした" in line for line in pipeline.tail(source="app"))
+
+
+def test_shutdown_stops_ready_instance(make_supervisor):
+    supervisor, events, _ = make_supervisor()
+    instance = supervisor.start()
+    events.wait_for("ready")
+
+    supervisor.shutdown(timeout=5)
+
+    assert instance.process.poll() is not None
+    assert instance.state == "stopped"
+    assert events.names()[-1] == "stopped"
+    assert not instance.thread.is_alive()
+    assert supervisor.instances(running_only=True) == []
+
+
+def test_shutdown_during_backoff_does_not_restart(gr, make_supervisor, monkeypatch):
+    monkeypatch.setattr(gr, "RESTART_BACKOFF_BASE", 30.0)
+    supervisor, events, _ = make_supervisor(crashes=100)
+    instance = supervisor.start()
+    events.wait_for("restarting")
+
+    started = time.monotonic()
+    supervisor.shutdown(timeout=5)
+
+    assert time.monotonic() - started < 5
+    assert instance.state == "stopped"
+    assert instance.restarts == 0
+    assert events.names().count("starting") == 1
+
+
+@pytest.mark.skipif(os.name == "nt", reason="SIGTERM を無視するプロセスは POSIX でのみ再現できる")
+def test_shutdown_kills_instance_that_ignores_terminate(make_supervisor):
+    supervisor, events, pipeline = make_supervisor(mode="ignore-term")
+    instance = supervisor.start()
+    events.wait_for("ready")
+
+    supervisor.shutdown(timeout=0.5)
+
+    assert instance.process.returncode == -signal.SIGKILL
+    assert instance.state == "stopped"
+    pipeline.close()
+    assert any("強制終了" in line for line in pipeline.tail(source="app"))
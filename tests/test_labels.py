@@ -0,0 +1,79 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+def test_parse_yolo_labels_fast_path(gr):
+    counts, classes, boxes, invalid = gr.parse_yolo_labels([b"0 0.5 0.5 0.2 0.2\r\n3 0.1 0.2 0.3 0.4\n", b"", b"\n  \n", b"32767 1 1 1 1"])
+
+    assert counts == [2, 0, 0, 1]
+    assert classes.dtype == np.int16
+    assert classes.tolist() == [0, 3, 32767]
+    assert boxes.dtype == np.float32 and boxes.flags.c_contiguous
+    assert np.allclose(boxes, [[0.5, 0.5, 0.2, 0.2], [0.1, 0.2, 0.3, 0.4], [1, 1, 1, 1]])
+    assert invalid == 0
+
+
+def test_parse_yolo_labels_converts_polygons_to_boxes(gr):
+    counts, classes, boxes, invalid = gr.parse_yolo_labels([b"1 0.5 0.5 0.2 0.2\n", b"2 0.1 0.2 0.5 0.2 0.3 0.6\n"])
+
+    assert counts == [1, 1]
+    assert classes.tolist() == [1, 2]
+    assert np.allclose(boxes, [[0.5, 0.5, 0.2, 0.2], [0.3, 0.4, 0.4, 0.4]])
+    assert invalid == 0
+
+
+@pytest.mark.parametrize("row", [
+    b"0 0.5 0.5 0.2",
+    b"0 0.5 0.5 0.2 0.2 0.3",
+    b"0 0.1 0.2 0.5 0.2 0.3 0.6 0.7",
+    b"0 0.5 abc 0.2 0.2",
+    b"0 nan 0.5 0.2 0.2",
+    b"0 0.5 inf 0.2 0.2",
+    b"-1 0.5 0.5 0.2 0.2",
+    b"1.5 0.5 0.5 0.2 0.2",
+    # int16 に収まらないクラス ID は折り返して負の ID にならないよう除く
+    b"32768 0.5 0.5 0.2 0.2",
+    b"65537 0.5 0.5 0.2 0.2",
+])
+def test_parse_yolo_labels_drops_malformed_rows(gr, row):
+    counts, classes, boxes, invalid = gr.parse_yolo_labels([b"4 0.5 0.5 0.2 0.2\n" + row + b"\n", b"5 0.1 0.1 0.1 0.1\n"])
+
+    assert counts == [1, 1]
+    assert classes.tolist() == [4, 5]
+    assert boxes.shape == (2, 4)
+    assert invalid == 1
+
+
+def test_parse_yolo_labels_without_rows(gr):
+    counts, classes, boxes, invalid = gr.parse_yolo_labels([b"", b"\n"])
+
+    assert counts == [0, 0]
+    assert classes.shape == (0,) and classes.dtype == np.int16
+    assert boxes.shape == (0, 4)
+    assert invalid == 0
+
+
+def test_label_store_reuses_unchanged_files(gr, jpeg, make_dataset, tmp_path):
+    root = make_dataset(tmp_path / "ds", {f"img{i}.jpg": (jpeg(i), f"{i % 4} 0.5 0.5 0.1 0.1\n" * (i % 3)) for i in range(12)})
+
+    def build(cache_root):
+        pairs = {pair.base + pair.ext: pair for pair in gr.DatasetIndex(root).pairs}
+        manifest = gr.ConversionManifest(str(tmp_path / "manifest.json"))
+        for key, pair in pairs.items():
+            manifest.record(key, pair, root, gr.hash_pair(pair), "train")
+        return gr.LabelStore.load_or_build(str(cache_root), manifest, pairs, max_workers=2)
+
+    build(tmp_path / "cache")
+    (tmp_path / "ds" / "labels" / "img3.txt").write_text("7 0.5 0.5 0.1 0.1\n", encoding="utf-8")
+    (tmp_path / "ds" / "images" / "img5.jpg").unlink()
+    (tmp_path / "ds" / "images" / "new.jpg").write_bytes(jpeg(20))
+    (tmp_path / "ds" / "labels" / "new.txt").write_text("1 0.5 0.5 0.1 0.1\n2 0.5 0.5 0.1 0.1\n", encoding="utf-8")
+
+    # 前回のキャッシュの行を使い回して作ったものと、最初から解析したものが一致する
+    reused, fresh = build(tmp_path / "cache"), build(tmp_path / "fresh")
+
+    assert len(reused.keys) == 12
+    for name in gr.LabelStore.ARRAYS:
+        assert np.array_equal(getattr(reused, name), getattr(fresh, name)), name
+    assert reused.class_counts() == {0: 3, 1: 2, 2: 4, 3: 3, 7: 1}
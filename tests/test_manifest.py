@@ -0,0 +1,102 @@
+import os
+
+import pytest
+
+
+@pytest.fixture
+def dataset(jpeg, make_dataset, tmp_path):
+    return make_dataset(tmp_path / "src" / "ds", {f"img{i:02d}.jpg": (jpeg(i), f"{i % 3} 0.5 0.5 0.1 0.1\n") for i in range(20)})
+
+
+def _convert(gr, dataset, out, **options):
+    return gr.DatasetConverter(log=lambda message: None).split_yolo_dataset_with_clone(dataset, str(out), seed=0, **options)
+
+
+def _placed(out):
+    return {subset: sorted(os.listdir(out / "ds_done" / "images" / subset)) for subset in ("train", "val")}
+
+
+def test_manifest_restores_done_pairs_from_journal(gr, dataset, tmp_path):
+    path = str(tmp_path / "manifest.json")
+    manifest = gr.ConversionManifest(path)
+    for pair in gr.DatasetIndex(dataset).pairs:
+        manifest.record(pair.base + pair.ext, pair, dataset, gr.hash_pair(pair), "train")
+    manifest.save()
+    manifest.mark_done(["img00.jpg", "img01.jpg"])
+
+    loaded = gr.ConversionManifest.load(path)
+
+    assert sorted(key for key, entry in loaded.pairs.items() if entry["done"]) == ["img00.jpg", "img01.jpg"]
+    assert loaded.digest() == manifest.digest()
+    loaded.save()
+    assert not os.path.exists(loaded.journal_path)
+    assert gr.ConversionManifest.load(path).pairs == loaded.pairs
+
+
+def test_hash_pair_covers_image_and_label(gr, dataset):
+    first, second = gr.DatasetIndex(dataset).pairs[:2]
+
+    assert gr.hash_pair(first) == gr.hash_file(first.image.path, first.label.path)
+    assert gr.hash_pair(first) != gr.hash_pair(second)
+    os.remove(first.label.path)
+    assert gr.hash_pair(first) is None
+
+
+def test_interrupted_conversion_resumes_from_journal(gr, dataset, tmp_path, monkeypatch):
+    monkeypatch.setattr(gr, "MANIFEST_BATCH_SIZE", 4)
+    mark_done = gr.ConversionManifest.mark_done
+    calls = []
+
+    def interrupt_after_first_batch(self, keys):
+        calls.append(list(keys))
+        if len(calls) > 1:
+            raise KeyboardInterrupt
+        mark_done(self, keys)
+
+    monkeypatch.setattr(gr.ConversionManifest, "mark_done", interrupt_after_first_batch)
+    with pytest.raises(KeyboardInterrupt):
+        _convert(gr, dataset, tmp_path / "out")
+    monkeypatch.setattr(gr.ConversionManifest, "mark_done", mark_done)
+    plan = {key: entry["subset"] for key, entry in gr.ConversionManifest.load(str(tmp_path / "out" / f"ds_done{gr.MANIFEST_SUFFIX}")).pairs.items()}
+
+    result = _convert(gr, dataset, tmp_path / "out")
+
+    # 中断前に配置し終えた 1 バッチ分は配置し直さず、保存済みの振り分け計画の続きから再開する
+    assert result["status"] == "ok"
+    assert result["unchanged"] == 4
+    assert result["new"] == 0
+    assert result["files"] == 2 * 16
+    manifest = gr.ConversionManifest.load(str(tmp_path / "out" / f"ds_done{gr.MANIFEST_SUFFIX}"))
+    assert {key: entry["subset"] for key, entry in manifest.pairs.items()} == plan
+    assert all(entry["done"] for entry in manifest.pairs.values())
+    assert _placed(tmp_path / "out") == {subset: sorted(key for key, value in plan.items() if value == subset) for subset in ("train", "val")}
+
+
+def test_incremental_conversion_processes_only_changes(gr, dataset, tmp_path):
+    out = tmp_path / "out"
+    first = _convert(gr, dataset, out)
+    before = _placed(out)
+
+    assert (first["new"], first["train"], first["val"]) == (20, 14, 6)
+
+    # 更新時刻だけが変わったペアは内容ハッシュで変わっていないと分かる
+    label = os.path.join(dataset, "labels", "img00.txt")
+    os.utime(label, (1, 1))
+    with open(os.path.join(dataset, "labels", "img01.txt"), "w", encoding="utf-8") as f:
+        f.write("2 0.4 0.4 0.1 0.1\n")
+    os.remove(os.path.join(dataset, "images", "img02.jpg"))
+    os.remove(os.path.join(dataset, "labels", "img02.txt"))
+
+    second = _convert(gr, dataset, out)
+
+    assert (second["new"], second["changed"], second["deleted"], second["unchanged"]) == (0, 1, 1, 18)
+    assert second["files"] == 2
+    after = _placed(out)
+    assert {subset: [key for key in keys if key != "img02.jpg"] for subset, keys in before.items()} == after
+    subset = "train" if "img01.jpg" in after["train"] else "val"
+    assert (out / "ds_done" / "labels" / subset / "img01.txt").read_text(encoding="utf-8") == "2 0.4 0.4 0.1 0.1\n"
+
+    third = _convert(gr, dataset, out)
+
+    assert third["unchanged"] == 19
+    assert third["files"] == 0
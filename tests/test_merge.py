@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+
+def _labels(dataset):
+    return {name[:-4]: (dataset / "labels" / name).read_text(encoding="utf-8")
+            for name in sorted(os.listdir(dataset / "labels"))}
+
+
+@pytest.fixture
+def sources(jpeg, make_dataset, tmp_path):
+    shared = jpeg(100)
+    a = make_dataset(tmp_path / "a", {
+        "img0.jpg": (jpeg(0), "0 0.5 0.5 0.1 0.1\n1 0.2 0.2 0.1 0.1\n"),
+        "same.jpg": (shared, "1 0.5 0.5 0.2 0.2\n"),
+    }, classes=("cat", "dog"))
+    b = make_dataset(tmp_path / "b", {
+        # a と同じ名前で中身の違う画像と、a と中身が同じ画像 (名前もラベルの書式も違う)
+        "img0.jpg": (jpeg(1), "0 0.5 0.5 0.1 0.1\n1 0.3 0.3 0.1 0.1\n5 0.1 0.1 0.1 0.1\n"),
+        "copy.jpg": (shared, "0 0.500000 0.500000 0.200000 0.200000\n"),
+        "img2.jpg": (jpeg(2), "1 0.4 0.4 0.1 0.1\n"),
+    }, classes=("dog", "bird"))
+    return a, b
+
+
+def test_merge_remaps_classes_and_drops_duplicates(gr, sources, tmp_path):
+    dataset = tmp_path / "merged"
+
+    info = gr.merge_yolo_datasets(list(sources), str(dataset), log=lambda message: None)
+
+    assert (dataset / "classes.txt").read_text(encoding="utf-8") == "cat\ndog\nbird\n"
+    assert _labels(dataset) == {
+        "img0": "0 0.5 0.5 0.1 0.1\n1 0.2 0.2 0.1 0.1\n",
+        "same": "1 0.5 0.5 0.2 0.2\n",
+        # b の dog (0) と bird (1) は 1 と 2 になり、b の classes.txt にない 5 の行は除かれる
+        "b_img0": "1 0.5 0.5 0.1 0.1\n2 0.3 0.3 0.1 0.1\n",
+        "img2": "2 0.4 0.4 0.1 0.1\n",
+    }
+    assert (dataset / "images" / "same.jpg").read_bytes() == (tmp_path / "a" / "images" / "same.jpg").read_bytes()
+    assert info["merged"] == 4
+    assert info["duplicates"] == 1
+    # 書式が違うだけの同じラベルは食い違いとみなさない
+    assert info["label_conflicts"] == 0
+    assert info["dropped_rows"] == 1
+    assert [stats["duplicates"] for stats in info["per_source"]] == [0, 1]
+
+
+def test_merge_counts_conflicting_labels_of_duplicates(gr, sources, tmp_path):
+    (tmp_path / "b" / "labels" / "copy.txt").write_text("1 0.5 0.5 0.2 0.2\n", encoding="utf-8")
+
+    info = gr.merge_yolo_datasets(list(sources), str(tmp_path / "merged"), log=lambda message: None)
+
+    # b の 1 は bird なので、a の dog のラベルとは食い違う。先に指定した a のラベルを使う
+    assert info["label_conflicts"] == 1
+    assert _labels(tmp_path / "merged")["same"] == "1 0.5 0.5 0.2 0.2\n"
+
+
+def test_merge_without_classes_keeps_ids_within_the_known_range(gr, sources, jpeg, make_dataset, tmp_path):
+    plain = make_dataset(tmp_path / "plain", {"p.jpg": (jpeg(3), "2 0.5 0.5 0.1 0.1\n3 0.5 0.5 0.1 0.1\n")}, classes=None)
+
+    info = gr.merge_yolo_datasets([*sources, plain], str(tmp_path / "merged"), log=lambda message: None)
+
+    assert _labels(tmp_path / "merged")["p"] == "2 0.5 0.5 0.1 0.1\n"
+    assert info["dropped_rows"] == 2
+
+
+def test_merge_removes_pairs_that_left_the_sources(gr, sources, tmp_path):
+    dataset = tmp_path / "merged"
+    gr.merge_yolo_datasets(list(sources), str(dataset), log=lambda message: None)
+    os.remove(tmp_path / "b" / "images" / "img2.jpg")
+
+    info = gr.merge_yolo_datasets(list(sources), str(dataset), log=lambda message: None)
+
+    assert info["removed"] == 2
+    assert info["hashed"] == 0
+    assert sorted(os.listdir(dataset / "images")) == ["b_img0.jpg", "img0.jpg", "same.jpg"]
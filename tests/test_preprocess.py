@@ -0,0 +1,55 @@
+import os
+
+import pytest
+
+
+def _rows(data):
+    return [[float(token) for token in row.split()] if row.strip() else [] for row in data.decode("utf-8").splitlines()]
+
+
+def test_letterbox_labels_rewrites_boxes(gr):
+    # 横長の画像を正方形に収めると縦が半分になり、上下に 1/4 ずつ余白が入る
+    data = gr._letterbox_labels(b"0 0.5 0.5 0.2 0.2\n3 0 1 1 0.4\n", 1.0, 0.5, 0.0, 0.25)
+
+    assert _rows(data) == [[0, 0.5, 0.5, 0.2, 0.1], [3, 0.0, 0.75, 1.0, 0.2]]
+
+
+def test_letterbox_labels_rewrites_polygons(gr):
+    data = gr._letterbox_labels(b"1 0.1 0.2 0.9 0.2 0.5 1.0\n", 0.5, 1.0, 0.25, 0.0)
+
+    assert _rows(data) == [[1, 0.3, 0.2, 0.7, 0.2, 0.5, 1.0]]
+
+
+def test_letterbox_labels_keeps_rows_it_cannot_parse(gr):
+    data = b"\xef\xbb\xbf0 0.5 0.5 0.2 0.2\n\n0 0.5 oops 0.2 0.2\n2 0.5 0.5\n"
+
+    assert gr._letterbox_labels(data, 0.5, 0.5, 0.25, 0.25) == b"0 0.500000 0.500000 0.100000 0.100000\n\n0 0.5 oops 0.2 0.2\n2 0.5 0.5\n"
+
+
+def test_preprocess_pair_letterboxes_image_and_labels(gr, tmp_path):
+    Image = pytest.importorskip("PIL.Image")
+    Image.new("RGB", (200, 100), (10, 20, 30)).save(tmp_path / "wide.png")
+    (tmp_path / "wide.txt").write_text("0 0.5 0.5 0.2 0.2\n", encoding="utf-8")
+    job = (str(tmp_path / "wide.png"), str(tmp_path / "wide.txt"), str(tmp_path / "out.png"), str(tmp_path / "out.txt"), 100, "letterbox")
+
+    assert gr._preprocess_pair(job) is None
+    with Image.open(tmp_path / "out.png") as image:
+        assert image.size == (100, 100)
+        assert image.getpixel((50, 10)) == gr.LETTERBOX_COLOR
+        assert image.getpixel((50, 50)) == (10, 20, 30)
+    assert _rows((tmp_path / "out.txt").read_bytes()) == [[0, 0.5, 0.5, 0.2, 0.1]]
+
+
+def test_shard_source_paths_prefer_preprocessed_files(gr, tmp_path):
+    manifest = gr.ConversionManifest(str(tmp_path / "manifest.json"))
+    manifest.pairs = {key: {"image": f"images/{key}", "label": f"labels/{key[:-4]}.txt", "hash": digest}
+                      for key, digest in (("a.jpg", "aaaa"), ("b.jpg", "bbbb"))}
+    cache = tmp_path / "cache"
+    image, label = gr.preprocess_cache_paths(str(cache), "a.jpg", "aaaa")
+    (cache / "images").mkdir(parents=True)
+    open(image, "wb").close()
+
+    assert gr._shard_source_paths(str(cache), "src", manifest, "a.jpg") == (image, label)
+    # 前処理に失敗した画像は元のファイルを詰める
+    assert gr._shard_source_paths(str(cache), "src", manifest, "b.jpg") == (os.path.join("src", "images", "b.jpg"),
+                                                                           os.path.join("src", "labels", "b.txt"))
@@ -0,0 +1,81 @@
+import json
+import os
+import tarfile
+
+import pytest
+
+
+@pytest.fixture
+def manifest(gr, tmp_path):
+    """images/labels に 30 組のファイルを書き、そのうち 10 組を val に振り分けたマニフェストを返す"""
+    root = tmp_path / "src"
+    (root / "images").mkdir(parents=True)
+    (root / "labels").mkdir()
+    manifest = gr.ConversionManifest(str(tmp_path / "manifest.json"))
+    for i in range(30):
+        key = f"img{i:02d}.jpg"
+        (root / "images" / key).write_bytes(bytes([i]) * (100 + 37 * i))
+        (root / "labels" / f"img{i:02d}.txt").write_text(f"{i % 3} 0.5 0.5 0.1 0.1\n", encoding="utf-8")
+        manifest.pairs[key] = {"image": f"images/{key}", "label": f"labels/img{i:02d}.txt", "hash": str(i),
+                               "subset": "val" if i % 3 == 0 else "train"}
+    return manifest
+
+
+def _export(gr, tmp_path, manifest, fmt):
+    shard_dir = tmp_path / "shards"
+    shard_dir.mkdir(exist_ok=True)
+    index = gr.export_shards(str(tmp_path / "src"), manifest, str(shard_dir), fmt=fmt, max_bytes=2048, seed=0, max_workers=2)
+    (shard_dir / gr.SHARD_INDEX_NAME).write_text(json.dumps(index), encoding="utf-8")
+    return shard_dir, index
+
+
+def test_shard_writer_tar_is_readable_by_tarfile(gr, tmp_path):
+    writer = gr.ShardWriter(str(tmp_path), "train", "tar", max_bytes=4096)
+    samples = {f"{i:08d}": [("jpg", os.urandom(300 + 211 * i)), ("txt", f"{i} 0.5 0.5 0.1 0.1\n".encode())] for i in range(8)}
+    locations = {name: writer.add(name, parts) for name, parts in samples.items()}
+    names = writer.close()
+
+    assert len(names) > 1
+    members = {}
+    for shard, name in enumerate(names):
+        path = tmp_path / name
+        assert path.stat().st_size % tarfile.RECORDSIZE == 0
+        with tarfile.open(path) as archive:
+            for member in archive.getmembers():
+                members[member.name] = (shard, member.offset_data, archive.extractfile(member).read())
+    for name, parts in samples.items():
+        for (ext, data), location in zip(parts, locations[name]):
+            # 返したオフセットが tarfile から見たメンバーの中身の位置と一致する
+            assert members[f"{name}.{ext}"] == (location[0], location[1], data)
+
+
+@pytest.mark.parametrize("fmt", ["tar", "packed"])
+def test_export_shards_round_trip(gr, tmp_path, manifest, fmt):
+    shard_dir, index = _export(gr, tmp_path, manifest, fmt)
+
+    assert len(index["subsets"]["train"]["shards"]) > 1
+    with gr.ShardReader(str(shard_dir / gr.SHARD_INDEX_NAME)) as reader:
+        assert len(reader) == 30
+        assert sorted(reader.keys("val")) == sorted(key for key, entry in manifest.pairs.items() if entry["subset"] == "val")
+        for key, image, label in reader:
+            entry = manifest.pairs[key]
+            assert image == (tmp_path / "src" / entry["image"]).read_bytes()
+            assert label == (tmp_path / "src" / entry["label"]).read_bytes()
+            assert reader.read_key(key) == (image, label)
+
+
+def test_export_shards_is_reproducible_with_a_seed(gr, tmp_path, manifest):
+    _, first = _export(gr, tmp_path, manifest, "packed")
+    _, second = _export(gr, tmp_path, manifest, "packed")
+
+    assert first == second
+    assert first["digest"] == manifest.digest()
+
+
+def test_export_shards_fails_on_unreadable_sample(gr, tmp_path, manifest):
+    (tmp_path / "src" / "images" / "img05.jpg").unlink()
+    (tmp_path / "shards").mkdir()
+
+    with pytest.raises(OSError, match="読み込めないファイルが 1件あります") as excinfo:
+        gr.export_shards(str(tmp_path / "src"), manifest, str(tmp_path / "shards"), fmt="tar", seed=0)
+    assert "img05.jpg" in str(excinfo.value)
@@ -0,0 +1,75 @@
+import argparse
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+
+def _skewed_matrix(seed, images=2000):
+    # 多いクラスから少ないクラスまで偏りのあるラベル数と、ラベルの無い画像を混ぜる
+    rng = np.random.default_rng(seed)
+    rates = np.array([2.0, 0.8, 0.3, 0.05, 0.01])
+    return rng.poisson(rates, size=(images, rates.size)).astype(np.int32)
+
+
+@pytest.mark.parametrize("split_ratio", [0.5, 0.7, 0.9])
+def test_stratified_split_keeps_the_ratio_per_class(gr, split_ratio):
+    matrix = _skewed_matrix(0)
+
+    train = gr.stratified_split(matrix, split_ratio, seed=0)
+
+    assert train.dtype == bool and train.shape == (len(matrix),)
+    assert abs(train.mean() - split_ratio) < 0.01
+    share = matrix[train].sum(axis=0) / matrix.sum(axis=0)
+    assert np.all(np.abs(share - split_ratio) < 0.05), share
+
+
+def test_stratified_split_places_rare_classes_on_both_sides(gr):
+    matrix = np.zeros((100, 3), dtype=np.int32)
+    matrix[:, 0] = 1
+    # クラス 1 は 2 枚、クラス 2 は 3 枚にしか写っていない
+    matrix[[10, 60], 1] = 1
+    matrix[[20, 40, 80], 2] = 1
+
+    for seed in range(20):
+        train = gr.stratified_split(matrix, 0.7, seed=seed)
+        assert train[[10, 60]].sum() == 1
+        assert train[[20, 40, 80]].sum() == 2
+        assert train.sum() == 70
+
+
+def test_stratified_split_is_reproducible_and_keeps_fixed_images(gr):
+    matrix = _skewed_matrix(1, images=300)
+    fixed = np.full(len(matrix), -1, dtype=np.int8)
+    fixed[:50] = 1
+    fixed[50:80] = 0
+
+    first = gr.stratified_split(matrix, 0.7, seed=3, fixed=fixed)
+
+    assert np.array_equal(first, gr.stratified_split(matrix, 0.7, seed=3, fixed=fixed))
+    assert first[:50].all() and not first[50:80].any()
+    assert abs(first.mean() - 0.7) < 0.02
+
+
+def test_converter_stratifies_and_rejects_invalid_ratios(gr, jpeg, make_dataset, tmp_path):
+    # クラス 2 のラベルは 4 枚にしか無いが、train と val の両方に入る
+    pairs = {f"img{i:02d}.jpg": (jpeg(i), f"{2 if i % 10 == 0 else i % 2} 0.5 0.5 0.1 0.1\n") for i in range(40)}
+    dataset = make_dataset(tmp_path / "ds", pairs)
+    converter = gr.DatasetConverter(log=lambda message: None)
+
+    result = converter.split_yolo_dataset_with_clone(dataset, str(tmp_path / "out"), split_ratio=0.75, stratify=True, seed=0)
+
+    assert (result["status"], result["train"], result["val"]) == ("ok", 30, 10)
+    manifest = gr.ConversionManifest.load(str(tmp_path / "out" / f"ds_done{gr.MANIFEST_SUFFIX}"))
+    assert sorted(manifest.pairs[f"img{i:02d}.jpg"]["subset"] for i in range(0, 40, 10)) == ["train", "train", "train", "val"]
+
+    for split_ratio in (0, 1, 1.5):
+        result = converter.split_yolo_dataset_with_clone(dataset, str(tmp_path / "out"), split_ratio=split_ratio)
+        assert result["status"] == "error"
+        assert "train の割合" in result["error"]
+
+
+@pytest.mark.parametrize("text", ["abc", "0", "1", "-0.2"])
+def test_cli_rejects_invalid_ratios(gr, text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        gr._split_ratio(text)
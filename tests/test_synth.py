@@ -0,0 +1,34 @@
+import json
+
+import pytest
+
+
+def test_synth_refuses_to_replace_a_foreign_folder(gr, tmp_path):
+    root = tmp_path / "datasets"
+    root.mkdir()
+    (root / "important.txt").write_text("keep", encoding="utf-8")
+
+    with pytest.raises(ValueError, match="synth.json"):
+        gr.generate_synthetic_dataset(str(root), images=5)
+    assert (root / "important.txt").read_text(encoding="utf-8") == "keep"
+
+
+def test_synth_regenerates_its_own_folder_when_the_spec_changes(gr, tmp_path):
+    root = tmp_path / "synth"
+    first = gr.generate_synthetic_dataset(str(root), images=5)
+    assert gr.generate_synthetic_dataset(str(root), images=5) == first
+
+    second = gr.generate_synthetic_dataset(str(root), images=8, seed=1)
+
+    assert second["spec"]["images"] == 8
+    assert len(list((root / "images").iterdir())) == 8
+    assert json.loads((root / gr.SYNTH_SPEC_NAME).read_text(encoding="utf-8"))["spec"] == second["spec"]
+
+
+def test_synth_images_pass_validation(gr, tmp_path):
+    gr.generate_synthetic_dataset(str(tmp_path / "synth"), images=3, image_size=(37, 21))
+
+    for path in (tmp_path / "synth" / "images").iterdir():
+        result = gr.check_image_bytes(path.read_bytes())
+        assert result["error"] is None
+        assert (result["width"], result["height"]) == (37, 21)
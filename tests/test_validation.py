@@ -0,0 +1,75 @@
+import json
+import os
+
+import pytest
+
+BAD_LABELS = {
+    "range.jpg": "0 1.5 0.5 0.1 0.1\n",
+    "columns.jpg": "0 0.5 0.5\n",
+    "unknown_class.jpg": "7 0.5 0.5 0.1 0.1\n",
+}
+
+
+@pytest.fixture
+def dataset(jpeg, make_dataset, tmp_path):
+    good = jpeg()
+    pairs = {f"good{i}.jpg": (jpeg(i), f"{i % 3} 0.5 0.5 0.2 0.2\n") for i in range(6)}
+    pairs["background.jpg"] = (good, "")
+    pairs["zero.jpg"] = (b"", "0 0.5 0.5 0.1 0.1\n")
+    pairs["truncated.jpg"] = (good[:len(good) // 2], "0 0.5 0.5 0.1 0.1\n")
+    pairs.update((name, (good, label)) for name, label in BAD_LABELS.items())
+    return make_dataset(tmp_path / "src" / "ds", pairs)
+
+
+def _validate(gr, root, cache_path):
+    cache = gr.ValidationCache.load(str(cache_path))
+    bad, checked = gr.validate_pairs(gr.DatasetIndex(root).pairs, cache, class_count=3, max_workers=1)
+    cache.save()
+    return bad, checked
+
+
+def test_validate_pairs_reports_broken_images_and_labels(gr, dataset, tmp_path):
+    bad, checked = _validate(gr, dataset, tmp_path / "cache.json")
+
+    assert sorted(bad) == sorted(["zero.jpg", "truncated.jpg", *BAD_LABELS])
+    assert checked == 24
+    assert bad["zero.jpg"] == ["画像: 0 バイトのファイルです"]
+    assert bad["truncated.jpg"][0].startswith("画像: ")
+    assert "座標が 0〜1 の範囲外" in bad["range.jpg"][0]
+    assert "列数が不正" in bad["columns.jpg"][0]
+    assert "classes.txt にないクラス ID があります (7)" in bad["unknown_class.jpg"][0]
+
+
+def test_validation_cache_keeps_results_per_kind(gr, make_dataset, tmp_path):
+    # 0 バイトの画像と空のラベルは内容ハッシュが同じでも、キャッシュから読んだ結果で正常扱いにならない
+    root = make_dataset(tmp_path / "ds", {"zero.jpg": (b"", "")})
+    first, _ = _validate(gr, root, tmp_path / "cache.json")
+    second, checked = _validate(gr, root, tmp_path / "cache.json")
+
+    assert checked == 0
+    assert first == second == {"zero.jpg": ["画像: 0 バイトのファイルです"]}
+
+
+def test_quarantine_copies_bad_pairs_and_leaves_the_source(gr, dataset, tmp_path):
+    out = tmp_path / "out"
+    sources = {path: open(path, "rb").read() for path in (os.path.join(dataset, sub, name) for sub in ("images", "labels")
+                                                           for name in sorted(os.listdir(os.path.join(dataset, sub))))}
+
+    result = gr.DatasetConverter(log=lambda message: None).split_yolo_dataset_with_clone(dataset, str(out), validate=True, seed=0)
+
+    assert result["status"] == "ok"
+    assert result["quarantined"] == 5
+    assert result["train"] + result["val"] == 7
+    assert {path: open(path, "rb").read() for path in sources} == sources
+    quarantine = out / f"ds{gr.QUARANTINE_SUFFIX}"
+    for name in ("zero.jpg", "truncated.jpg", *BAD_LABELS):
+        assert (quarantine / "images" / name).read_bytes() == sources[os.path.join(dataset, "images", name)]
+        assert (quarantine / "labels" / name.replace(".jpg", ".txt")).exists()
+        assert not any((out / "ds_done" / subset / "images" / name).exists() for subset in ("train", "val"))
+
+    # 再実行しても同じペアが報告に重複して載らない
+    result = gr.DatasetConverter(log=lambda message: None).split_yolo_dataset_with_clone(dataset, str(out), validate=True, seed=0)
+    report = json.loads((quarantine / gr.QUARANTINE_REPORT_NAME).read_text(encoding="utf-8"))
+
+    assert result["quarantined"] == 5
+    assert sorted(entry["image"] for entry in report) == sorted(f"images/{name}" for name in ("zero.jpg", "truncated.jpg", *BAD_LABELS))
@@ -0,0 +1,102 @@
+import os
+import sys
+import threading
+
+import pytest
+
+
+def _state(index):
+    return (index.images_dir, index.labels_dir, index.pairs, sorted(index.unpaired_images),
+            {root: sorted(files) for root, files in index.files.items()})
+
+
+@pytest.fixture
+def dataset(jpeg, make_dataset, tmp_path):
+    return make_dataset(tmp_path / "src", {f"img{i}.jpg": (jpeg(i), f"{i % 3} 0.5 0.5 0.1 0.1\n") for i in range(5)})
+
+
+def _refresh(gr, index, *dirs):
+    rescanned = index.refresh([os.path.join(index.root, d) if d else index.root for d in dirs])
+    assert _state(index) == _state(gr.DatasetIndex(index.root))
+    return rescanned
+
+
+def test_refresh_picks_up_added_and_removed_files(gr, dataset, jpeg):
+    index = gr.DatasetIndex(dataset)
+    with open(os.path.join(dataset, "images", "new.jpg"), "wb") as f:
+        f.write(jpeg(10))
+    with open(os.path.join(dataset, "images", "lonely.jpg"), "wb") as f:
+        f.write(jpeg(11))
+    with open(os.path.join(dataset, "labels", "new.txt"), "w", encoding="utf-8") as f:
+        f.write("1 0.5 0.5 0.1 0.1\n")
+    os.remove(os.path.join(dataset, "labels", "img1.txt"))
+    os.remove(os.path.join(dataset, "images", "img2.jpg"))
+
+    assert not _refresh(gr, index, "images", "labels")
+    assert [pair.base for pair in index.pairs] == ["img0", "img3", "img4", "new"]
+    assert sorted(os.path.basename(f.path) for f in index.unpaired_images) == ["img1.jpg", "lonely.jpg"]
+
+
+def test_refresh_picks_up_renamed_files(gr, dataset):
+    index = gr.DatasetIndex(dataset)
+    os.rename(os.path.join(dataset, "images", "img0.jpg"), os.path.join(dataset, "images", "renamed.jpg"))
+    os.rename(os.path.join(dataset, "labels", "img0.txt"), os.path.join(dataset, "labels", "renamed.txt"))
+
+    assert not _refresh(gr, index, "images", "labels")
+    assert [pair.base for pair in index.pairs] == ["img1", "img2", "img3", "img4", "renamed"]
+
+
+def test_refresh_rescans_when_folders_change(gr, dataset, tmp_path):
+    index = gr.DatasetIndex(dataset)
+    os.makedirs(os.path.join(dataset, "images", "extra"))
+
+    assert _refresh(gr, index, "images")
+
+    # images/labels を入れ替えた (リネームした) 場合は、消えたフォルダを読み直せないので全体を走査し直す
+    os.rename(os.path.join(dataset, "labels"), os.path.join(dataset, "labels_old"))
+    assert _refresh(gr, index, "", "labels")
+    assert index.pairs == []
+
+    os.rename(os.path.join(dataset, "labels_old"), os.path.join(dataset, "labels"))
+    assert _refresh(gr, index, "", "labels_old")
+    assert len(index.pairs) == 5
+
+
+def test_polling_watch_reports_changed_folders(gr, dataset):
+    watch = gr._PollingWatch(dataset, interval=0)
+    with open(os.path.join(dataset, "labels", "img0.txt"), "a", encoding="utf-8") as f:
+        f.write("2 0.2 0.2 0.1 0.1\n")
+    os.makedirs(os.path.join(dataset, "images", "sub"))
+
+    assert watch.wait(0) == {os.path.join(dataset, "labels"), os.path.join(dataset, "images"), os.path.join(dataset, "images", "sub")}
+    assert watch.wait(0) == set()
+
+
+@pytest.mark.parametrize("backend", ["poll", pytest.param("inotify", marks=pytest.mark.skipif(not sys.platform.startswith("linux"),
+                                                                                        reason="inotify は Linux でのみ使える"))])
+def test_watcher_converts_only_the_changes(gr, dataset, jpeg, tmp_path, backend):
+    cycles = []
+    converted = threading.Event()
+
+    def on_cycle(cycle):
+        cycles.append(cycle)
+        converted.set()
+
+    watcher = gr.DatasetWatcher(dataset, str(tmp_path / "out"), options={"seed": 0}, debounce=0.2, poll_interval=0.05, backend=backend,
+                                on_cycle=on_cycle)
+    thread = threading.Thread(target=watcher.run, kwargs={"max_cycles": 1}, daemon=True)
+    thread.start()
+    assert converted.wait(30)
+    converted.clear()
+
+    with open(os.path.join(dataset, "images", "new.jpg"), "wb") as f:
+        f.write(jpeg(10))
+    with open(os.path.join(dataset, "labels", "new.txt"), "w", encoding="utf-8") as f:
+        f.write("1 0.5 0.5 0.1 0.1\n")
+    thread.join(timeout=30)
+
+    assert not thread.is_alive()
+    assert [cycle["status"] for cycle in cycles] == ["ok", "ok"]
+    assert cycles[1]["new"] == 1
+    assert cycles[1]["rescanned"] is False
+    assert cycles[1]["train"] + cycles[1]["val"] == 6